@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import nibabel as nib
+import numpy as np
 
 
 def get_reference_info(reference):
@@ -49,3 +50,50 @@ def assert_same_resolution(images):
         shape, aff = get_reference_info(i)
         if not (ref[0] == shape) and (ref[1] == aff).any():
             raise Exception("Images are not of the same resolution/affine")
+
+
+def create_memmap_nifti(filename, shape, affine, dtype=np.float32):
+    """
+    Create a zero-filled, uncompressed NIFTI file and map its data in memory.
+
+    The data can then be written by blocks (e.g voxel chunks), the file
+    is complete once the memmap is flushed or deleted.
+
+    Parameters
+    ----------
+    filename : string
+        Output filename, must be an uncompressed NIFTI (.nii).
+    shape : tuple
+        Shape of the image.
+    affine : ndarray
+        Affine of the image.
+    dtype : numpy dtype, optional
+        Type of the data (default float32).
+
+    Returns
+    -------
+    data : numpy.memmap
+        Data of the image (in Fortran order, as stored in the file).
+    """
+    if not filename.endswith('.nii'):
+        raise ValueError('Only uncompressed NIFTI (.nii) can be '
+                         'memory-mapped, got {0}.'.format(filename))
+
+    header = nib.Nifti1Header()
+    header.set_data_shape(shape)
+    header.set_data_dtype(dtype)
+    header.set_qform(affine, code=1)
+    header.set_sform(affine, code=1)
+    header.set_data_offset(352)
+
+    dtype = np.dtype(dtype)
+    with open(filename, 'wb') as f:
+        header.write_to(f)
+        # The 4 bytes extension flag, then sparse zeros for the data
+        f.write(b'\x00' * (header.get_data_offset() - f.tell()))
+        f.truncate(header.get_data_offset() +
+                   int(np.prod(shape)) * dtype.itemsize)
+
+    return np.memmap(filename, dtype=dtype.newbyteorder(header.endianness),
+                     mode='r+', offset=header.get_data_offset(),
+                     shape=tuple(shape), order='F')
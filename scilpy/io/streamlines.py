@@ -4,10 +4,15 @@
 from itertools import islice
 import os
 import six
+from six.moves.queue import Queue
+import threading
 
 from dipy.io.streamline import load_tractogram
+import h5py
 import nibabel as nib
-from nibabel.streamlines import Field, Tractogram
+from nibabel.affines import apply_affine
+from nibabel.streamlines import ArraySequence, Field, Tractogram
+import numpy as np
 from nibabel.streamlines.trk import (get_affine_rasmm_to_trackvis,
                                      get_affine_trackvis_to_rasmm)
 
@@ -71,6 +76,49 @@ def load_trk_in_voxel_space(trk_file, anat=None, grid_res=None,
     return streamlines
 
 
+def ichunk_trk_in_voxel_space(trk_file, anat=None, chunk_size=10000):
+    """
+    Lazily load streamlines in voxel space, corner aligned, one chunk at a
+    time. Only the streamlines of the current chunk are held in memory.
+
+    :param trk_file: path of the tractogram file
+    :param anat: path or nibabel image (optional)
+    :param chunk_size: maximal number of streamlines in each chunk
+    :return: generator of ArraySequence (float32), each containing at most
+             chunk_size streamlines in voxel space
+    """
+    trk_file = nib.streamlines.load(trk_file, lazy_load=True)
+
+    if anat:
+        if isinstance(anat, six.string_types):
+            anat = nib.load(anat)
+        spacing = anat.header['pixdim'][1:4]
+    else:
+        spacing = trk_file.header[Field.VOXEL_SIZES]
+
+    affine_to_voxmm = get_affine_rasmm_to_trackvis(trk_file.header)
+
+    for chunk in ichunk(trk_file.tractogram.streamlines, chunk_size):
+        # Same operations (and float32 roundings) as load_trk_in_voxel_space
+        streamlines = ArraySequence(
+            [apply_affine(affine_to_voxmm,
+                          s.astype(np.float32)).astype(np.float32)
+             for s in chunk])
+        streamlines._data /= spacing
+        yield streamlines
+
+
+def _save_from_voxel_space(streamlines, spacing, header, out_name):
+    affine_to_rasmm = get_affine_trackvis_to_rasmm(header)
+
+    tracto = Tractogram(streamlines=streamlines,
+                        affine_to_rasmm=affine_to_rasmm)
+
+    tracto.streamlines._data *= spacing
+
+    nib.streamlines.save(tracto, out_name, header=header)
+
+
 def save_from_voxel_space(streamlines, anat, ref_tracts, out_name):
     if isinstance(ref_tracts, six.string_types):
         nib_object = nib.streamlines.load(ref_tracts, lazy_load=True)
@@ -80,15 +128,219 @@ def save_from_voxel_space(streamlines, anat, ref_tracts, out_name):
     if isinstance(anat, six.string_types):
         anat = nib.load(anat)
 
-    affine_to_rasmm = get_affine_trackvis_to_rasmm(nib_object.header)
-
-    tracto = Tractogram(streamlines=streamlines,
-                        affine_to_rasmm=affine_to_rasmm)
-
     spacing = anat.header['pixdim'][1:4]
-    tracto.streamlines._data *= spacing
+    _save_from_voxel_space(streamlines, spacing, nib_object.header, out_name)
+
+
+class VoxelSpaceStreamlinesWriter(object):
+    def __init__(self, anat, ref_tracts, max_queue_size=16):
+        """
+        Save many files of streamlines in voxel space, as
+        save_from_voxel_space would, but reading the reference header and
+        anatomy only once. Files are written in order by a background
+        thread, so saving overlaps with the computation. The thread is only
+        started on the first save, so process pools can be forked before.
+
+        Parameters
+        ----------
+        anat : str or nibabel image
+            Anatomy defining the voxel space.
+        ref_tracts : str or nibabel TractogramFile
+            Tractogram whose header is used for all saved files.
+        max_queue_size : int
+            Maximal number of files waiting to be written, the caller blocks
+            when the queue is full to bound memory usage.
+        """
+        if isinstance(ref_tracts, six.string_types):
+            ref_tracts = nib.streamlines.load(ref_tracts, lazy_load=True)
+        if isinstance(anat, six.string_types):
+            anat = nib.load(anat)
 
-    nib.streamlines.save(tracto, out_name, header=nib_object.header)
+        self.header = ref_tracts.header
+        self.spacing = anat.header['pixdim'][1:4]
+
+        self._queue = Queue(maxsize=max_queue_size)
+        self._error = None
+        self._thread = None
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+
+            streamlines, out_name = item
+            if self._error is None:
+                try:
+                    _save_from_voxel_space(streamlines, self.spacing,
+                                           self.header, out_name)
+                except Exception as e:
+                    self._error = e
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def save(self, streamlines, out_name):
+        """
+        Queue streamlines (in voxel space) to be saved in out_name.
+        """
+        self._raise_if_failed()
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._write_loop)
+            self._thread.daemon = True
+            self._thread.start()
+
+        self._queue.put((streamlines, out_name))
+
+    def close(self):
+        """
+        Wait for all queued files to be written.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self._raise_if_failed()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+class ConnectionsHdf5Writer(object):
+    def __init__(self, out_name, anat, ref_tracts):
+        """
+        Save the segments of all connections in a single HDF5 file.
+        The points of all segments are stored once, in voxel space (corner
+        aligned), in the 'data' dataset. Each connection is a group named
+        'in_label_out_label' containing the 'offsets' and 'lengths' of its
+        segments in 'data' and the 'streamline_indices' of their source
+        streamline in the tractogram. The 'affine_to_rasmm' attribute brings
+        the points to RASmm.
+
+        Parameters
+        ----------
+        out_name : str
+            Output HDF5 filename.
+        anat : str or nibabel image
+            Anatomy defining the voxel space.
+        ref_tracts : str or nibabel TractogramFile
+            Tractogram whose header defines the RASmm space.
+        """
+        if isinstance(ref_tracts, six.string_types):
+            ref_tracts = nib.streamlines.load(ref_tracts, lazy_load=True)
+        if isinstance(anat, six.string_types):
+            anat = nib.load(anat)
+
+        spacing = anat.header['pixdim'][1:4]
+        affine_to_rasmm = np.dot(
+            get_affine_trackvis_to_rasmm(ref_tracts.header),
+            np.diag(np.append(spacing, 1.)))
+
+        self.hdf5_file = h5py.File(out_name, 'w')
+        self.hdf5_file.attrs['affine_to_rasmm'] = affine_to_rasmm
+        self.hdf5_file.attrs['dimensions'] = anat.shape[:3]
+        self.hdf5_file.attrs['voxel_sizes'] = spacing
+        self.data = self.hdf5_file.create_dataset('data', (0, 3),
+                                                  dtype=np.float32,
+                                                  maxshape=(None, 3),
+                                                  chunks=True)
+
+    @staticmethod
+    def _extend(group, name, values):
+        if name not in group:
+            group.create_dataset(name, data=values, maxshape=(None,),
+                                 chunks=True)
+            return
+
+        dataset = group[name]
+        previous_len = len(dataset)
+        dataset.resize((previous_len + len(values),))
+        dataset[previous_len:] = values
+
+    def append(self, in_label, out_label, streamlines, strl_indices):
+        """
+        Append streamlines (in voxel space) to a connection, along with the
+        index of their source streamline in the tractogram.
+        """
+        if not len(streamlines):
+            return
+
+        lengths = np.array([len(s) for s in streamlines], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])) + \
+            len(self.data)
+
+        previous_len = len(self.data)
+        self.data.resize((previous_len + np.sum(lengths), 3))
+        self.data[previous_len:] = np.concatenate(streamlines)
+
+        group = self.hdf5_file.require_group('{}_{}'.format(in_label,
+                                                            out_label))
+        self._extend(group, 'offsets', offsets)
+        self._extend(group, 'lengths', lengths)
+        self._extend(group, 'streamline_indices',
+                     np.asarray(strl_indices, dtype=np.int64))
+
+    def close(self):
+        self.hdf5_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+def load_connection_from_hdf5(hdf5_file, in_label, out_label,
+                              to_rasmm=False):
+    """
+    Load the segments of a single connection from a file written by
+    ConnectionsHdf5Writer. Only the points of this connection are read.
+
+    :param hdf5_file: path or h5py.File
+    :param in_label: smallest label of the connection
+    :param out_label: largest label of the connection
+    :param to_rasmm: if True, return the streamlines in RASmm instead of
+                     voxel space (corner aligned)
+    :return: tuple (ArraySequence of streamlines,
+                    numpy.ndarray of source streamline indices)
+    """
+    if isinstance(hdf5_file, six.string_types):
+        with h5py.File(hdf5_file, 'r') as f:
+            return load_connection_from_hdf5(f, in_label, out_label,
+                                             to_rasmm=to_rasmm)
+
+    group = hdf5_file['{}_{}'.format(in_label, out_label)]
+    offsets = group['offsets'][:]
+    lengths = group['lengths'][:]
+    strl_indices = group['streamline_indices'][:]
+
+    # Segments appended together are contiguous, each run of contiguous
+    # segments is read at once instead of one read per segment.
+    ends = offsets + lengths
+    run_starts = np.concatenate(
+        ([0], np.nonzero(offsets[1:] != ends[:-1])[0] + 1)).astype(int)
+    run_ends = np.append(run_starts[1:], len(offsets))
+
+    segments = []
+    for run_start, run_end in zip(run_starts, run_ends):
+        start = offsets[run_start]
+        data = hdf5_file['data'][start:ends[run_end - 1]]
+        segments.extend([data[o - start:e - start]
+                         for o, e in zip(offsets[run_start:run_end],
+                                         ends[run_start:run_end])])
+
+    streamlines = ArraySequence(segments)
+    if to_rasmm:
+        streamlines._data = apply_affine(
+            hdf5_file.attrs['affine_to_rasmm'],
+            streamlines._data).astype(np.float32)
+
+    return streamlines, strl_indices
 
 
 def ichunk(sequence, n):
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import hashlib
+
+from dipy.core.sphere import Sphere
+from dipy.data import get_sphere
+from dipy.reconst.shm import smooth_pinv
+import numpy as np
+from scipy.sparse import issparse
+
+from scilpy.reconst.utils import _honor_authorsnames_sh_basis, get_b_matrix
+
+# Projectors are cached per (sphere, order, basis, smooth), since building
+# the basis and its regularized inverse is much slower than applying them.
+_SH_PROJECTORS = {}
+
+
+def get_sh_projector(sphere, sh_order, sh_basis, smooth=0.0):
+    """Get the (cached) SHProjector of a sphere and a SH basis.
+
+    Parameters
+    ----------
+    sphere : str or dipy.core.sphere.Sphere
+        Name of a Dipy sphere, or a sphere.
+    sh_order : int
+        Maximum SH order.
+    sh_basis : {None, 'tournier07', 'descoteaux07'}
+        SH basis, ``None`` defaults to ``descoteaux07``.
+    smooth : float, optional
+        Lambda-regularization of the SF to SH fit (default 0.0).
+
+    Returns
+    -------
+    sh_projector : SHProjector
+        Projector of the sphere, built on the first call.
+    """
+    sh_basis = _honor_authorsnames_sh_basis(sh_basis or 'descoteaux07')
+    if isinstance(sphere, str):
+        sphere_key = sphere
+    else:
+        vertices = np.ascontiguousarray(sphere.vertices, dtype=np.float64)
+        sphere_key = hashlib.sha1(vertices.tobytes()).hexdigest()
+    key = (sphere_key, int(sh_order), sh_basis, float(smooth))
+
+    if key not in _SH_PROJECTORS:
+        if isinstance(sphere, str):
+            sphere = get_sphere(sphere)
+        _SH_PROJECTORS[key] = SHProjector(sphere, sh_order, sh_basis,
+                                          smooth=smooth)
+    return _SH_PROJECTORS[key]
+
+
+class SHProjector(object):
+    def __init__(self, sphere, sh_order, sh_basis, smooth=0.0):
+        """Conversion between spherical functions (SF) and SH coefficients.
+
+        The B-matrix and its smooth pseudo-inverse are computed once, then
+        applied by chunks of voxels. The result is the same as Dipy's
+        sf_to_sh and sh_to_sf, the products are computed in float64 and
+        only the output is cast (float32 by default).
+
+        Parameters
+        ----------
+        sphere : dipy.core.sphere.Sphere
+            Sphere on which the SF are defined.
+        sh_order : int
+            Maximum SH order.
+        sh_basis : {'tournier07', 'descoteaux07'}
+            SH basis.
+        smooth : float, optional
+            Lambda-regularization of the SF to SH fit (default 0.0).
+        """
+        if not isinstance(sphere, Sphere):
+            raise TypeError('sphere must be a dipy Sphere.')
+        self.sphere = sphere
+        self.sh_order = sh_order
+        self.sh_basis = sh_basis
+        self.smooth = smooth
+
+        b_matrix, _, n = get_b_matrix(sh_order, sphere, sh_basis,
+                                      return_all=True)
+        laplacian = -n * (n + 1)
+        inv_b_matrix = smooth_pinv(b_matrix, np.sqrt(smooth) * laplacian)
+
+        # Transposed once, both products are then (voxels x ...) dots
+        self.sh_to_sf_matrix = np.ascontiguousarray(b_matrix.T)
+        self.sf_to_sh_matrix = np.ascontiguousarray(inv_b_matrix.T)
+        self.nb_coeffs = b_matrix.shape[1]
+        self.nb_vertices = b_matrix.shape[0]
+
+    def sf_to_sh(self, sf, chunk_size=10000, dtype=np.float32, out=None,
+                 mask=None):
+        """Project spherical functions to SH coefficients.
+
+        Parameters
+        ----------
+        sf : numpy.ndarray or scipy.sparse matrix (..., nb_vertices)
+            Spherical functions, sparse matrices are densified by chunk.
+        chunk_size : int, optional
+            Number of voxels projected at once (default 10000).
+        dtype : numpy dtype, optional
+            Type of the output, when it is allocated (default float32).
+        out : numpy.ndarray, optional
+            Output array (or memmap) written in place. Shaped like sf, or
+            (X, Y, Z, nb_coeffs) when a mask is given.
+        mask : numpy.ndarray (3D), optional
+            Voxels of out matching the rows of sf (in C order).
+
+        Returns
+        -------
+        sh : numpy.ndarray
+            SH coefficients, out if it was given.
+        """
+        return self._project(sf, self.sf_to_sh_matrix, chunk_size, dtype,
+                             out, mask)
+
+    def sh_to_sf(self, sh, chunk_size=10000, dtype=np.float32, out=None,
+                 mask=None):
+        """Evaluate SH coefficients as spherical functions on the sphere.
+
+        Parameters
+        ----------
+        sh : numpy.ndarray (..., nb_coeffs)
+            SH coefficients.
+        chunk_size : int, optional
+            Number of voxels evaluated at once (default 10000).
+        dtype : numpy dtype, optional
+            Type of the output, when it is allocated (default float32).
+        out : numpy.ndarray, optional
+            Output array (or memmap) written in place. Shaped like sh, or
+            (X, Y, Z, nb_vertices) when a mask is given.
+        mask : numpy.ndarray (3D), optional
+            Voxels of out matching the rows of sh (in C order).
+
+        Returns
+        -------
+        sf : numpy.ndarray
+            Spherical functions, out if it was given.
+        """
+        return self._project(sh, self.sh_to_sf_matrix, chunk_size, dtype,
+                             out, mask)
+
+    @staticmethod
+    def _project(values, matrix, chunk_size, dtype, out, mask):
+        if values.shape[-1] != matrix.shape[0]:
+            raise ValueError('Last dimension must be of size {0}, '
+                             'got {1}.'.format(matrix.shape[0],
+                                               values.shape[-1]))
+
+        if issparse(values):
+            values_2d = values.tocsr()
+        else:
+            values_2d = values.reshape((-1, values.shape[-1]))
+        nb_rows = values_2d.shape[0]
+
+        if mask is not None:
+            voxels = np.nonzero(mask)
+            if len(voxels[0]) != nb_rows:
+                raise ValueError('The mask must have one voxel per row.')
+            if out is None:
+                out = np.zeros(mask.shape + (matrix.shape[1],), dtype=dtype)
+            out_2d = None
+        else:
+            if out is None:
+                out = np.zeros(values.shape[:-1] + (matrix.shape[1],),
+                               dtype=dtype)
+            # Setting the shape of a view fails instead of silently copying
+            out_2d = out.view()
+            out_2d.shape = (nb_rows, matrix.shape[1])
+
+        for start in range(0, nb_rows, chunk_size):
+            end = min(start + chunk_size, nb_rows)
+            chunk = values_2d[start:end]
+            if issparse(chunk):
+                chunk = chunk.toarray()
+            result = np.dot(np.asarray(chunk, dtype=np.float64), matrix)
+
+            if out_2d is None:
+                out[tuple(axis[start:end] for axis in voxels)] = result
+            else:
+                out_2d[start:end] = result
+
+        return out
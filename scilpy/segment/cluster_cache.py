@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import logging
+import os
+import tempfile
+from time import time
+import zipfile
+
+import numpy as np
+
+CACHE_EXTENSION = '.npz'
+
+
+def get_streamlines_hash(streamlines):
+    """
+    Content hash of streamlines, independent of the filename and format.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        Streamlines to hash.
+
+    Returns
+    -------
+    streamlines_hash : str
+        Hexadecimal SHA1 of the points and lengths of the streamlines.
+    """
+    lengths = np.asarray(streamlines._lengths, dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    # Views (e.g slices) of an ArraySequence are packed first
+    if not (len(streamlines._data) == np.sum(lengths) and
+            np.array_equal(streamlines._offsets, offsets)):
+        streamlines = streamlines.copy()
+
+    sha1 = hashlib.sha1()
+    sha1.update(lengths.tobytes())
+    sha1.update(np.ascontiguousarray(streamlines._data,
+                                     dtype=np.float32).tobytes())
+    return sha1.hexdigest()
+
+
+def get_rng_state_hash(rng_state):
+    """
+    Hash of the state of a RandomState (as returned by get_state).
+
+    Parameters
+    ----------
+    rng_state : tuple
+        State of a RandomState.
+
+    Returns
+    -------
+    rng_state_hash : str
+        Hexadecimal SHA1 of the state.
+    """
+    sha1 = hashlib.sha1()
+    for value in rng_state:
+        sha1.update(str(value).encode() if not isinstance(value, np.ndarray)
+                    else value.tobytes())
+    return sha1.hexdigest()
+
+
+class ClusterCache(object):
+    def __init__(self, cache_dir, max_age=None, max_size=None):
+        """
+        On-disk cache of QBx clustering of tractograms, one compact file
+        (centroids, indices and sizes) per clustering.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory of the cache, created if needed.
+        max_age : float, optional
+            Files not used for more than max_age days are evicted.
+        max_size : float, optional
+            Least recently used files are evicted until the cache is smaller
+            than max_size MB.
+        """
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_size = max_size
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def get_key(streamlines_hash, thresholds, nb_points, rng_state):
+        """
+        Key of a clustering in the cache.
+
+        Parameters
+        ----------
+        streamlines_hash : str
+            Content hash of the tractogram, from get_streamlines_hash.
+        thresholds : list
+            QBx thresholds (mm).
+        nb_points : int
+            Number of points used for the resampling of streamlines.
+        rng_state : tuple
+            State of the RandomState before the clustering (the seed alone
+            is not enough when many clusterings share a RandomState).
+
+        Returns
+        -------
+        key : str
+            Hexadecimal SHA1 of all the parameters.
+        """
+        sha1 = hashlib.sha1()
+        sha1.update('{0}_{1}_{2}_{3}'.format(
+            streamlines_hash, list(thresholds), nb_points,
+            get_rng_state_hash(rng_state)).encode())
+        return sha1.hexdigest()
+
+    def _get_filename(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_EXTENSION)
+
+    def get(self, key):
+        """
+        Load a clustering from the cache.
+
+        Parameters
+        ----------
+        key : str
+            Key of the clustering, from get_key.
+
+        Returns
+        -------
+        cluster_arrays : tuple or None
+            Centroids, indices and sizes of the clusters, None if missing.
+        rng_state : tuple or None
+            State of the RandomState after the clustering, None if missing.
+        """
+        filename = self._get_filename(key)
+        if not os.path.isfile(filename):
+            return None, None
+
+        try:
+            with np.load(filename) as data:
+                cluster_arrays = (data['centroids'], data['indices'],
+                                  data['sizes'])
+                rng_state = (str(data['rng_name']), data['rng_keys'],
+                             int(data['rng_pos']), int(data['rng_has_gauss']),
+                             float(data['rng_cached_gaussian']))
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile):
+            logging.warning('Cluster cache file {0} is invalid, it will be '
+                            'replaced'.format(filename))
+            return None, None
+
+        # Used files are the last ones to be evicted
+        os.utime(filename, None)
+        return cluster_arrays, rng_state
+
+    def put(self, key, cluster_arrays, rng_state):
+        """
+        Save a clustering in the cache, then evict old files if needed.
+
+        Parameters
+        ----------
+        key : str
+            Key of the clustering, from get_key.
+        cluster_arrays : tuple
+            Centroids, indices and sizes of the clusters.
+        rng_state : tuple
+            State of the RandomState after the clustering.
+        """
+        centroids, indices, sizes = cluster_arrays
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = \
+            rng_state
+
+        # Written then renamed, concurrent runs never read a partial file
+        fd, tmp_filename = tempfile.mkstemp(suffix='.tmp',
+                                            dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, centroids=centroids, indices=indices, sizes=sizes,
+                     rng_name=rng_name, rng_keys=rng_keys, rng_pos=rng_pos,
+                     rng_has_gauss=rng_has_gauss,
+                     rng_cached_gaussian=rng_cached_gaussian)
+        os.rename(tmp_filename, self._get_filename(key))
+
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the files older than max_age, then the least recently used
+        files until the cache is smaller than max_size.
+        """
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith(CACHE_EXTENSION):
+                filename = os.path.join(self.cache_dir, filename)
+                stat = os.stat(filename)
+                files.append((stat.st_mtime, stat.st_size, filename))
+        files.sort()
+
+        to_remove = []
+        if self.max_age is not None:
+            min_time = time() - self.max_age * 86400
+            while files and files[0][0] < min_time:
+                to_remove.append(files.pop(0)[2])
+
+        if self.max_size is not None:
+            total_size = sum(size for _, size, _ in files)
+            while files and total_size > self.max_size * 1024 ** 2:
+                _, size, filename = files.pop(0)
+                total_size -= size
+                to_remove.append(filename)
+
+        for filename in to_remove:
+            logging.debug('Evicting {0} from the cluster cache'.format(
+                filename))
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+
+from dipy.segment.clustering import qbx_and_merge
+from dipy.tracking.streamline import set_number_of_points
+import h5py
+import nibabel as nib
+import numpy as np
+import six
+
+from scilpy.segment.recobundlesx import MODEL_CLUSTERING_THRESHOLDS
+
+ATLAS_EXTENSIONS = ('.hdf5', '.h5')
+
+
+def _get_group_name(atlas_index, bundle_name):
+    return 'models/{0}/{1}'.format(atlas_index, bundle_name)
+
+
+def _get_centroids_name(model_clust_thr):
+    return 'centroids_{0}'.format(float(model_clust_thr))
+
+
+def compile_model_atlas(out_filename, config, atlas_dirs, nb_points=20,
+                        seed=0):
+    """
+    Compile model bundles in a single atlas file for RecobundlesX.
+
+    Each model is resampled and clustered (QBx) at all the model clustering
+    thresholds of its bundle in the config, in model space. Recognition then
+    only reads and transforms the centroids it needs.
+
+    Layout of the HDF5 file:
+    models/{atlas_index}/{bundle_name}/streamlines (nb_streamlines,
+    nb_points, 3) and models/{atlas_index}/{bundle_name}/centroids_{mct}
+    (nb_centroids, nb_points, 3), for each model and threshold.
+
+    Parameters
+    ----------
+    out_filename : str
+        Output atlas filename (hdf5).
+    config : dict
+        Dictionary containing information relative to bundle recognition.
+    atlas_dirs : list
+        Directories of the models, must contain all bundles of the config.
+    nb_points : int
+        Number of points used for all resampling of streamlines.
+    seed : int
+        Value to initialize the RandomState of the clustering.
+    """
+    atlas_dirs = [os.path.normpath(atlas_dir) for atlas_dir in atlas_dirs]
+    rng = np.random.RandomState(seed)
+
+    with h5py.File(out_filename, 'w') as f:
+        f.attrs['nb_points'] = nb_points
+        f.attrs['atlas_dirs'] = json.dumps(atlas_dirs)
+
+        for atlas_index, atlas_dir in enumerate(atlas_dirs):
+            for bundle_name in sorted(config.keys()):
+                filename = os.path.join(atlas_dir, bundle_name)
+                if not os.path.isfile(filename):
+                    logging.warning('{0} does not exist, it will not be '
+                                    'in the atlas'.format(filename))
+                    continue
+
+                streamlines = nib.streamlines.load(filename).streamlines
+                group = f.create_group(_get_group_name(atlas_index,
+                                                       bundle_name))
+                group.create_dataset('streamlines', data=np.asarray(
+                    set_number_of_points(streamlines, nb_points),
+                    dtype=np.float32).reshape((-1, nb_points, 3)))
+
+                model_clust_thr = config[bundle_name]['model_clustering_thr']
+                for mct in sorted(set(model_clust_thr)):
+                    cluster_map = qbx_and_merge(
+                        streamlines, MODEL_CLUSTERING_THRESHOLDS + [mct],
+                        nb_pts=nb_points, rng=rng, verbose=False)
+                    group.create_dataset(
+                        _get_centroids_name(mct),
+                        data=np.asarray(cluster_map.centroids,
+                                        dtype=np.float32).reshape(
+                                            (-1, nb_points, 3)))
+
+                logging.info('{0} with {1} streamlines clustered at {2}mm '
+                             'gave {3} centroids'.format(
+                                 filename, len(streamlines),
+                                 sorted(set(model_clust_thr)),
+                                 [len(group[_get_centroids_name(mct)])
+                                  for mct in sorted(set(model_clust_thr))]))
+
+
+class ModelAtlas(object):
+    def __init__(self, filename):
+        """
+        Reader of an atlas compiled by compile_model_atlas. Models are
+        identified by the same tags as in the models directories
+        (atlas_dir/bundle_name), only the requested arrays are read.
+
+        Parameters
+        ----------
+        filename : str
+            Atlas filename (hdf5).
+        """
+        self.filename = filename
+        with h5py.File(filename, 'r') as f:
+            self.nb_points = int(f.attrs['nb_points'])
+            self.atlas_dirs = [str(atlas_dir) for atlas_dir in
+                               json.loads(f.attrs['atlas_dirs'])]
+
+    def _get_group_name(self, tag):
+        if not isinstance(tag, six.string_types):
+            tag = tag.decode('ascii')
+        atlas_dir = os.path.normpath(os.path.dirname(tag))
+        if atlas_dir not in self.atlas_dirs:
+            return None
+        return _get_group_name(self.atlas_dirs.index(atlas_dir),
+                               os.path.basename(tag))
+
+    def has_model(self, tag):
+        """
+        Whether the model of a tag (atlas_dir/bundle_name) was compiled.
+        """
+        group_name = self._get_group_name(tag)
+        if group_name is None:
+            return False
+        with h5py.File(self.filename, 'r') as f:
+            return group_name in f
+
+    def get_streamlines(self, tag):
+        """
+        Resampled streamlines of a model, in model space.
+
+        :param tag: str, model identifier (atlas_dir/bundle_name)
+        :return: numpy.ndarray (nb_streamlines, nb_points, 3)
+        """
+        with h5py.File(self.filename, 'r') as f:
+            return f[self._get_group_name(tag)]['streamlines'][:]
+
+    def get_centroids(self, tag, model_clust_thr):
+        """
+        QBx centroids of a model at a clustering threshold, in model space.
+
+        :param tag: str, model identifier (atlas_dir/bundle_name)
+        :param model_clust_thr: float, distance in mm of the clustering
+        :return: numpy.ndarray (nb_centroids, nb_points, 3), None if the
+                 model was not compiled at this threshold
+        """
+        with h5py.File(self.filename, 'r') as f:
+            group = f[self._get_group_name(tag)]
+            name = _get_centroids_name(model_clust_thr)
+            if name not in group:
+                return None
+            return group[name][:]
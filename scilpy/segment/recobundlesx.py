@@ -12,6 +12,9 @@ from dipy.tracking.streamline import (select_random_set_of_streamlines,
                                       transform_streamlines)
 import numpy as np
 
+# Thresholds (mm) of the model clustering, before the model_clust_thr
+MODEL_CLUSTERING_THRESHOLDS = [30, 20, 15]
+
 
 class RecobundlesX(object):
     """
@@ -68,12 +71,14 @@ class RecobundlesX(object):
 
     def recognize(self, model_bundle,
                   model_clust_thr=8, bundle_pruning_thr=8,
-                  slr_transform_type='similarity', identifier=None):
+                  slr_transform_type='similarity', identifier=None,
+                  model_centroids=None):
         """
         Parameters
         ----------
         model_bundle : list or ArraySequence
             Model bundle as loaded by the nibabel API
+            Not used (can be None) if model_centroids are given
         model_clust_thr : obj
             Distance threshold (mm) for model clustering (QBx)
         bundle_pruning_thr : int
@@ -83,6 +88,9 @@ class RecobundlesX(object):
             [translation, rigid, similarity, scaling]
         identifier : str
             Identify the current bundle being recognize for the logging
+        model_centroids : list or numpy.ndarray
+            Centroids of the model bundle already clustered at
+            model_clust_thr (e.g from a compiled atlas), in subject space
 
         Returns
         -------
@@ -90,8 +98,12 @@ class RecobundlesX(object):
             Streamlines that were recognized by Recobundles and these
             parameters
         """
-        self._cluster_model_bundle(model_bundle, model_clust_thr,
-                                   identifier=identifier)
+        if model_centroids is None:
+            self._cluster_model_bundle(model_bundle, model_clust_thr,
+                                       identifier=identifier)
+        else:
+            self.model_cluster_map = None
+            self.model_centroids = model_centroids
 
         if not self._reduce_search_space():
             if identifier:
@@ -119,7 +131,7 @@ class RecobundlesX(object):
         :param model_clust_thr, float, distance in mm for clustering
         :param identifier, str, name of the bundle for logging
         """
-        thresholds = [30, 20, 15, model_clust_thr]
+        thresholds = MODEL_CLUSTERING_THRESHOLDS + [model_clust_thr]
         self.model_cluster_map = qbx_and_merge(model, thresholds,
                                                nb_pts=self.nb_points,
                                                rng=self.rng,
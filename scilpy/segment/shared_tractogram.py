@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from dipy.segment.clustering import ClusterCentroid, ClusterMapCentroid
+from nibabel.streamlines import ArraySequence
+import numpy as np
+
+# Arrays already attached by this process, per shared directory
+_ATTACHED = {}
+
+
+def cluster_map_to_arrays(cluster_map):
+    """
+    Convert a QBx cluster map to compact arrays.
+
+    Parameters
+    ----------
+    cluster_map : ClusterMapCentroid
+        Clusters, as returned by qbx_and_merge.
+
+    Returns
+    -------
+    centroids : numpy.ndarray (3D)
+        Centroid of each cluster (nb_clusters, nb_points, 3).
+    indices : numpy.ndarray (1D)
+        Streamlines indices of all clusters, one cluster after the other.
+    sizes : numpy.ndarray (1D)
+        Number of streamlines of each cluster.
+    """
+    centroids = np.asarray(cluster_map.centroids, dtype=np.float32)
+    sizes = np.asarray(cluster_map.clusters_sizes(), dtype=np.int32)
+    if len(cluster_map):
+        indices = np.concatenate([np.asarray(cluster.indices, dtype=np.int32)
+                                  for cluster in cluster_map.clusters])
+    else:
+        indices = np.zeros((0,), dtype=np.int32)
+    return centroids, indices, sizes
+
+
+def arrays_to_cluster_map(centroids, indices, sizes, refdata=None):
+    """
+    Convert compact arrays back to a QBx cluster map.
+
+    Parameters
+    ----------
+    centroids : numpy.ndarray (3D)
+        Centroid of each cluster (nb_clusters, nb_points, 3).
+    indices : numpy.ndarray (1D)
+        Streamlines indices of all clusters, one cluster after the other.
+    sizes : numpy.ndarray (1D)
+        Number of streamlines of each cluster.
+    refdata : list or ArraySequence, optional
+        Streamlines referred to by the indices.
+
+    Returns
+    -------
+    cluster_map : ClusterMapCentroid
+        Clusters, as returned by qbx_and_merge. The indices of each cluster
+        are slices (views) of indices, so memory-mapped indices are not
+        copied.
+    """
+    cluster_map = ClusterMapCentroid()
+    offsets = np.concatenate(([0], np.cumsum(sizes)))
+    for i in range(len(sizes)):
+        cluster_map.add_cluster(ClusterCentroid(
+            np.array(centroids[i]), id=i,
+            indices=indices[offsets[i]:offsets[i + 1]]))
+    if refdata is not None:
+        cluster_map.refdata = refdata
+    return cluster_map
+
+
+def share_streamlines(streamlines, shared_dir):
+    """
+    Write the arrays of streamlines in a directory, to be attached
+    (memory-mapped) by other processes with attach_streamlines.
+
+    Parameters
+    ----------
+    streamlines : ArraySequence
+        Streamlines to share.
+    shared_dir : str
+        Directory of the shared arrays (e.g a temporary directory).
+    """
+    for name in ['data', 'offsets', 'lengths']:
+        np.save(os.path.join(shared_dir, 'streamlines_{0}.npy'.format(name)),
+                getattr(streamlines, '_{0}'.format(name)))
+
+
+def attach_streamlines(shared_dir):
+    """
+    Attach streamlines shared by share_streamlines, without copying them.
+
+    Parameters
+    ----------
+    shared_dir : str
+        Directory of the shared arrays.
+
+    Returns
+    -------
+    streamlines : ArraySequence
+        Streamlines, memory-mapped in copy-on-write mode (pages are shared
+        between processes until written).
+    """
+    key = (shared_dir, 'streamlines')
+    if key not in _ATTACHED:
+        streamlines = ArraySequence()
+        for name in ['data', 'offsets', 'lengths']:
+            setattr(streamlines, '_{0}'.format(name), np.load(
+                os.path.join(shared_dir,
+                             'streamlines_{0}.npy'.format(name)),
+                mmap_mode='c'))
+        _ATTACHED[key] = streamlines
+    return _ATTACHED[key]
+
+
+def share_cluster_map(cluster_map, shared_dir, name):
+    """
+    Write the arrays of a cluster map in a directory, to be attached by
+    other processes with attach_cluster_map.
+
+    Parameters
+    ----------
+    cluster_map : ClusterMapCentroid or tuple
+        Clusters, as returned by qbx_and_merge, or their arrays as returned
+        by cluster_map_to_arrays.
+    shared_dir : str
+        Directory of the shared arrays.
+    name : str
+        Unique name of the cluster map in the directory.
+    """
+    if not isinstance(cluster_map, tuple):
+        cluster_map = cluster_map_to_arrays(cluster_map)
+    for array_name, array in zip(['centroids', 'indices', 'sizes'],
+                                 cluster_map):
+        np.save(os.path.join(shared_dir, 'cluster_map_{0}_{1}.npy'.format(
+            name, array_name)), array)
+
+
+def attach_cluster_map(shared_dir, name):
+    """
+    Attach a cluster map shared by share_cluster_map, referring to the
+    streamlines shared in the same directory.
+    The cluster map is rebuilt once per process.
+
+    Parameters
+    ----------
+    shared_dir : str
+        Directory of the shared arrays.
+    name : str
+        Unique name of the cluster map in the directory.
+
+    Returns
+    -------
+    cluster_map : ClusterMapCentroid
+        Clusters, with the shared streamlines as refdata.
+    """
+    key = (shared_dir, 'cluster_map', name)
+    if key not in _ATTACHED:
+        arrays = [np.load(os.path.join(
+            shared_dir, 'cluster_map_{0}_{1}.npy'.format(name, array_name)),
+            mmap_mode='c')
+            for array_name in ['centroids', 'indices', 'sizes']]
+        _ATTACHED[key] = arrays_to_cluster_map(
+            *arrays, refdata=attach_streamlines(shared_dir))
+    return _ATTACHED[key]
+
+
+def detach(shared_dir):
+    """
+    Forget the arrays of a shared directory attached by this process.
+
+    Parameters
+    ----------
+    shared_dir : str
+        Directory of the shared arrays.
+    """
+    for key in list(_ATTACHED.keys()):
+        if key[0] == shared_dir:
+            del _ATTACHED[key]
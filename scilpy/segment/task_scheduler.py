@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from dipy.tracking.distances import bundles_distances_mdf
+from dipy.tracking.streamline import set_number_of_points
+import numpy as np
+
+# Relative cost of the local SLR, the degrees of freedom optimized by all its
+# successive registrations (translation, then rigid, similarity and scaling)
+SLR_COST_WEIGHTS = {'translation': 3, 'rigid': 9, 'similarity': 16,
+                    'scaling': 25}
+
+
+def estimate_nb_neighbors(model_streamlines, centroids, sizes, nb_points,
+                          neighbors_reduction_thr=18, min_cluster_size=10,
+                          sample_size=100):
+    """
+    Estimate the number of tractogram streamlines close to a model, as found
+    by the search space reduction of RecobundlesX, from an evenly spaced
+    sample of the model (no random number is drawn).
+
+    Parameters
+    ----------
+    model_streamlines : list or ArraySequence
+        Streamlines (or centroids) of the model, in subject space.
+    centroids : numpy.ndarray (3D)
+        Centroids of the tractogram clusters (nb_clusters, nb_points, 3).
+    sizes : numpy.ndarray (1D)
+        Number of streamlines of each tractogram cluster.
+    nb_points : int
+        Number of points of the centroids.
+    neighbors_reduction_thr : float
+        Distance in mm for a cluster to be a neighbor of the model.
+    min_cluster_size : int
+        Smaller clusters are not neighbors.
+    sample_size : int
+        Maximum number of model streamlines compared to the centroids.
+
+    Returns
+    -------
+    nb_neighbors : int
+        Estimated number of neighbor streamlines.
+    """
+    if not len(model_streamlines) or not len(centroids):
+        return 0
+
+    nb_samples = min(sample_size, len(model_streamlines))
+    sample_ids = np.unique(np.linspace(0, len(model_streamlines) - 1,
+                                       nb_samples).astype(int))
+    sample = set_number_of_points([np.asarray(model_streamlines[i],
+                                              dtype=np.float32)
+                                   for i in sample_ids], nb_points)
+
+    distances = bundles_distances_mdf(sample, centroids)
+    is_neighbor = np.logical_and(
+        np.min(distances, axis=0) <= neighbors_reduction_thr,
+        sizes >= min_cluster_size)
+    return int(np.sum(sizes[is_neighbor]))
+
+
+def estimate_task_cost(nb_model_streamlines, nb_neighbors,
+                       slr_transform_type):
+    """
+    Estimate the relative cost of a RecobundlesX execution.
+
+    Parameters
+    ----------
+    nb_model_streamlines : int
+        Number of streamlines (or precomputed centroids) of the model.
+    nb_neighbors : int
+        Estimated number of neighbor streamlines, see estimate_nb_neighbors.
+    slr_transform_type : str
+        Transformation of the local SLR
+        [translation, rigid, similarity, scaling]
+
+    Returns
+    -------
+    cost : float
+        Relative cost, only meaningful compared to other tasks.
+    """
+    return float(nb_model_streamlines + nb_neighbors) * \
+        SLR_COST_WEIGHTS[slr_transform_type]
+
+
+def order_by_cost(costs):
+    """
+    Order of dispatch of tasks, longest first, so that the long tasks do not
+    finish last on a single process. Ties keep their original order.
+
+    Parameters
+    ----------
+    costs : list
+        Estimated cost of each task.
+
+    Returns
+    -------
+    order : list
+        Indices of the tasks, by decreasing cost.
+    """
+    return sorted(range(len(costs)), key=lambda i: (-costs[i], i))
@@ -1,22 +1,35 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from itertools import product, repeat
+from itertools import product
 import json
 import logging
 import multiprocessing
 import os
 import random
+import shutil
+import tempfile
 from time import time
 
 import nibabel as nib
 import numpy as np
-from scipy.sparse import dok_matrix
+from scipy.sparse import coo_matrix
 
 from dipy.segment.clustering import qbx_and_merge
 from dipy.tracking.streamline import transform_streamlines
 
+from scilpy.segment.cluster_cache import get_streamlines_hash
+from scilpy.segment.model_atlas import ModelAtlas
 from scilpy.segment.recobundlesx import RecobundlesX
+from scilpy.segment.shared_tractogram import (attach_cluster_map,
+                                              attach_streamlines,
+                                              cluster_map_to_arrays,
+                                              detach,
+                                              share_cluster_map,
+                                              share_streamlines)
+from scilpy.segment.task_scheduler import (estimate_nb_neighbors,
+                                           estimate_task_cost,
+                                           order_by_cost)
 
 
 class VotingScheme(object):
@@ -30,6 +43,7 @@ class VotingScheme(object):
         atlas_directory : list
             List of all directories to be used as atlas by RBx
             Must contain all bundles as declared in the config file
+            Can also be a single atlas file compiled by compile_model_atlas
         transformation : numpy.ndarray
             Transformation (4x4) bringing the models into subject space
         output_directory : str
@@ -46,10 +60,16 @@ class VotingScheme(object):
         self.minimal_vote_ratio = minimal_vote_ratio
 
         # Scripts parameters
-        if isinstance(atlas_directory, list):
-            self.atlas_dir = atlas_directory
+        if not isinstance(atlas_directory, list):
+            atlas_directory = [atlas_directory]
+
+        # A compiled atlas replaces its models directories
+        if len(atlas_directory) == 1 and os.path.isfile(atlas_directory[0]):
+            self.model_atlas = ModelAtlas(atlas_directory[0])
+            self.atlas_dir = self.model_atlas.atlas_dirs
         else:
-            self.atlas_dir = [atlas_directory]
+            self.model_atlas = None
+            self.atlas_dir = atlas_directory
 
         self.transformation = transformation
         self.output_directory = output_directory
@@ -71,13 +91,18 @@ class VotingScheme(object):
                         for tag, bundle in all_atlas_models]
             bundles_filepath.append(tmp_list)
 
+        if self.model_atlas is None:
+            model_exists = os.path.isfile
+        else:
+            model_exists = self.model_atlas.has_model
+
         to_keep = []
         # All models must exist, if not the bundle will be skipped
         for i in range(len(bundles_filepath)):
             missing_count = 0
             missing_files = []
             for j in range(len(bundles_filepath[i])):
-                if not os.path.isfile(bundles_filepath[i][j]):
+                if not model_exists(bundles_filepath[i][j]):
                     missing_count += 1
                     missing_files.append(bundles_filepath[i][j])
 
@@ -125,39 +150,147 @@ class VotingScheme(object):
 
         return model_bundles_dict
 
-    def _find_max_in_sparse_matrix(self, bundle_id, min_vote,
-                                   streamlines_wise_vote, bundles_wise_vote):
+    def _load_centroids_dictionary(self, bundles_filepath,
+                                   model_clustering_thr):
+        """
+        Load the precomputed centroids of all model bundles from the compiled
+        atlas and store them in a dictionnary where the (filepath, threshold)
+        are the keys and the transformed centroids the values.
+        :param bundles_filepath, list, list of filepaths of model bundles
+        :param model_clustering_thr, list, model clustering thresholds to load
+        """
+        model_centroids_dict = {}
+        for filename in bundles_filepath:
+            for mct in model_clustering_thr:
+                centroids = self.model_atlas.get_centroids(filename, mct)
+                if centroids is None:
+                    raise ValueError('{0} was not compiled at {1}mm, compile '
+                                     'the atlas with the same config '
+                                     'file'.format(filename, mct))
+                model_centroids_dict[(filename, mct)] = transform_streamlines(
+                    centroids, self.transformation)
+
+            logging.debug('Loaded the centroids of {0} at {1}mm'.format(
+                filename, model_clustering_thr))
+
+        return model_centroids_dict
+
+    def _estimate_tasks_cost(self, processing_dict, tractogram_clusters,
+                             nb_points):
         """
-        Will find the maximum values of a specific row (bundle_id), make
-        sure they are the maximum values across bundles (argmax) and above the
-        min_vote threshold. Return the indices respecting all three conditions.
-        :param bundle_id, int, indices of the bundles in the dok_matrix
+        Estimate the cost of each task from the model size, the estimated
+        number of neighbors and the SLR transformation type.
+        :param processing_dict, dict, parameters of all tasks
+        :param tractogram_clusters, dict, centroids and sizes of the
+            tractogram clusters, for each (seed, tct)
+        :param nb_points, int, number of points of the centroids
+        Returns the log of each task (parameters and estimated cost).
+        """
+        nb_neighbors_dict = {}
+        tasks_log = []
+        for i in range(len(processing_dict['bundle_id'])):
+            tag = processing_dict['tag'][i]
+            seed = processing_dict['seed'][i]
+            tct = processing_dict['tct'][i]
+            mct = processing_dict['mct'][i]
+            slr_transform_type = processing_dict['slr_transform_type'][i]
+            model = processing_dict['model_bundle'][i]
+            if model is None:
+                model = processing_dict['model_centroids'][i]
+
+            # Models are the same for all tasks of a tag, except centroids
+            key = (tag, seed, tct,
+                   mct if processing_dict['model_bundle'][i] is None else None)
+            if key not in nb_neighbors_dict:
+                centroids, sizes = tractogram_clusters[(seed, tct)]
+                nb_neighbors_dict[key] = estimate_nb_neighbors(
+                    model, centroids, sizes, nb_points)
+
+            if not isinstance(tag, str):
+                tag = tag.decode('ascii')
+            tasks_log.append({
+                'tag': tag, 'seed': seed, 'tct': tct, 'mct': mct,
+                'bpt': processing_dict['bpt'][i],
+                'slr_transform_type': slr_transform_type,
+                'nb_model_streamlines': len(model),
+                'estimated_nb_neighbors': nb_neighbors_dict[key],
+                'estimated_cost': estimate_task_cost(
+                    len(model), nb_neighbors_dict[key], slr_transform_type)})
+
+        return tasks_log
+
+    def _log_tasks_results(self, results, tasks_log):
+        """
+        Stream the results of the tasks, as they arrive, while adding their
+        duration and number of neighbors to their log.
+        :param results, iterable, results of single_recognize
+        :param tasks_log, list, log of each task, updated in place
+        """
+        for rank, (task_id, bundle_id, recognized_indices, duration,
+                   nb_neighbors) in enumerate(results):
+            tasks_log[task_id]['completion_rank'] = rank
+            tasks_log[task_id]['duration'] = duration
+            tasks_log[task_id]['nb_neighbors'] = nb_neighbors
+            tasks_log[task_id]['nb_recognized'] = len(recognized_indices)
+            yield bundle_id, recognized_indices
+
+    def _accumulate_votes(self, all_measures_dict, nbr_streamlines,
+                          nbr_bundles):
+        """
+        Count the votes of all executions as a sparse matrix, built at once
+        from the (streamline, bundle) pairs of each execution.
+        :param all_measures_dict, iterable, bundle_id and recognized indices
+            of each execution
+        :param nbr_streamlines, int, number of streamlines in the tractogram
+        :param nbr_bundles, int, number of bundles
+        """
+        streamlines_ids = []
+        bundles_ids = []
+        for bundle_id, recognized_indices in all_measures_dict:
+            if recognized_indices is not None and len(recognized_indices):
+                # An execution votes at most once for a streamline
+                recognized_indices = np.unique(recognized_indices)
+                streamlines_ids.append(recognized_indices)
+                bundles_ids.append(np.full(len(recognized_indices),
+                                           bundle_id, dtype=np.int32))
+
+        if streamlines_ids:
+            streamlines_ids = np.concatenate(streamlines_ids)
+            bundles_ids = np.concatenate(bundles_ids)
+        else:
+            streamlines_ids = np.zeros((0,), dtype=np.int32)
+            bundles_ids = np.zeros((0,), dtype=np.int32)
+
+        # Duplicated pairs are summed by the conversion to CSR
+        return coo_matrix((np.ones(len(streamlines_ids), dtype=np.int32),
+                           (streamlines_ids, bundles_ids)),
+                          shape=(nbr_streamlines, nbr_bundles)).tocsr()
+
+    def _find_max_in_sparse_matrix(self, min_vote, streamlines_wise_vote):
+        """
+        Will find the bundle with the maximum vote (argmax) of each streamline
+        and keep it if above the min_vote threshold, for all bundles at once.
+        Ties are broken in favor of the lowest bundle id.
         :param min_vote, int, minimum value for considering (voting)
-        :param streamlines_wise_vote, dok_matrix, streamlines-wise
-            sparse matrix for voting
-        :param bundles_wise_vote, dok_matrix, bundles-wise
+        :param streamlines_wise_vote, csr_matrix, streamlines-wise
             sparse matrix for voting
+        Returns the streamlines indices (sorted), their bundle id and vote.
         """
-        streamlines_indices_in_bundles = []
-        streamline_ids = bundles_wise_vote[bundle_id]
-        for streamline_id in streamline_ids.keys():
-            current_max_vote = -1
-            current_arg_max = -1
+        votes = streamlines_wise_vote.tocoo()
+        order = np.lexsort((votes.col, -votes.data, votes.row))
+        rows = votes.row[order]
 
-            for vote_id in streamlines_wise_vote[streamline_id[1]].keys():
-                current_vote = streamlines_wise_vote[streamline_id[1],
-                                                     vote_id[1]]
-                if current_vote > current_max_vote:
-                    current_max_vote = current_vote
-                    current_arg_max = vote_id[1]
+        # The first entry of each streamline is its maximum vote
+        is_first = np.ones(len(rows), dtype=bool)
+        is_first[1:] = rows[1:] != rows[:-1]
+        max_entries = order[is_first]
+        max_entries = max_entries[votes.data[max_entries] >= min_vote]
 
-            if current_arg_max == bundle_id and current_max_vote >= min_vote:
-                streamlines_indices_in_bundles.append(streamline_id[1])
-
-        return np.asarray(streamlines_indices_in_bundles, dtype=np.int32)
+        return (votes.row[max_entries], votes.col[max_entries],
+                votes.data[max_entries])
 
     def _save_recognized_bundles(self, tractogram, bundle_names,
-                                 streamlines_wise_vote, bundles_wise_vote,
+                                 streamlines_wise_vote,
                                  minimum_vote, extension):
         """
         Parameters
@@ -167,10 +300,8 @@ class VotingScheme(object):
         bundle_names : list
             Bundle names as defined in the configuration file
             Will save the bundle using that filename and the extension
-        streamlines_wise_vote : dok_matrix
-            Array of zeros of shape (nbr_streamlines x nbr_bundles)
-        bundles_wise_vote : dok_matrix
-            Array of zeros of shape (nbr_bundles x nbr_streamlines)
+        streamlines_wise_vote : csr_matrix
+            Votes of shape (nbr_streamlines x nbr_bundles)
         minimum_vote : float
             Value for the vote ratio for a streamline to be considered
             (0 < minimal_vote < 1)
@@ -179,12 +310,14 @@ class VotingScheme(object):
 
         Will save multiple TRK/TCK file and results.json (contains indices)
         """
+        all_streamlines_id, all_bundles_id, all_votes = \
+            self._find_max_in_sparse_matrix(minimum_vote,
+                                            streamlines_wise_vote)
+
         results_dict = {}
         for bundle_id in range(len(bundle_names)):
-            streamlines_id = self._find_max_in_sparse_matrix(bundle_id,
-                                                             minimum_vote,
-                                                             streamlines_wise_vote,
-                                                             bundles_wise_vote)
+            is_in_bundle = all_bundles_id == bundle_id
+            streamlines_id = all_streamlines_id[is_in_bundle]
 
             if not streamlines_id.size:
                 logging.error('{0} final recognition got {1} streamlines'.format(
@@ -198,7 +331,7 @@ class VotingScheme(object):
             streamlines = tractogram.streamlines[streamlines_id.T]
             data_per_streamline = tractogram.tractogram.data_per_streamline[streamlines_id.T]
             data_per_point = tractogram.tractogram.data_per_point[streamlines_id.T]
-            vote_score = streamlines_wise_vote[streamlines_id.T, bundle_id]
+            vote_score = all_votes[is_in_bundle]
 
             # All models of the same bundle have the same basename
             basename = os.path.join(self.output_directory,
@@ -213,16 +346,87 @@ class VotingScheme(object):
 
             curr_results_dict = {}
             curr_results_dict['indices'] = np.asarray(streamlines_id).tolist()
-            curr_results_dict['votes'] = np.squeeze(
-                vote_score.toarray()).tolist()
+            curr_results_dict['votes'] = vote_score.tolist()
             results_dict[basename] = curr_results_dict
 
         out_logfile = os.path.join(self.output_directory, 'results.json')
         with open(out_logfile, 'w') as outfile:
             json.dump(results_dict, outfile)
 
+    def _cluster_tractogram(self, wb_streamlines, tractogram_clustering_thr,
+                            nb_points, seeds, shared_dir, cluster_cache=None):
+        """
+        Cluster the whole tractogram once per seed and clustering threshold,
+        and share the cluster maps with the processes.
+        :param wb_streamlines, ArraySequence, whole brain tractogram
+        :param tractogram_clustering_thr, list, distances in mm (for QBx)
+        :param nb_points, int, number of points used for all resampling
+        :param seeds, list, seeds of the RandomState
+        :param shared_dir, str, directory of the shared arrays
+        :param cluster_cache, ClusterCache, on-disk cache of the clustering
+        Returns the random state of each seed after its clusterings and the
+        centroids and sizes of the clusters, for each (seed, tct).
+        """
+        rng_states = {}
+        tractogram_clusters = {}
+        if cluster_cache is not None:
+            streamlines_hash = get_streamlines_hash(wb_streamlines)
+        base_thresholds = [45, 35, 25]
+        for seed in seeds:
+            rng = np.random.RandomState(seed)
+            for clustering_thr in tractogram_clustering_thr:
+                timer = time()
+                # If necessary, add an extra layer (more optimal)
+                if clustering_thr < 15:
+                    current_thr_list = base_thresholds + [15, clustering_thr]
+                else:
+                    current_thr_list = base_thresholds + [clustering_thr]
+
+                # The cache also restores the random state after clustering,
+                # results are the same as without the cache
+                cache_key = None
+                cluster_arrays = None
+                if cluster_cache is not None and seed is not None:
+                    cache_key = cluster_cache.get_key(streamlines_hash,
+                                                      current_thr_list,
+                                                      nb_points,
+                                                      rng.get_state())
+                    cluster_arrays, rng_state = cluster_cache.get(cache_key)
+
+                if cluster_arrays is not None:
+                    rng.set_state(rng_state)
+                    source = 'loaded from the cache'
+                else:
+                    cluster_map = qbx_and_merge(wb_streamlines,
+                                                current_thr_list,
+                                                nb_pts=nb_points, rng=rng,
+                                                verbose=False)
+                    cluster_arrays = cluster_map_to_arrays(cluster_map)
+                    if cache_key is not None:
+                        cluster_cache.put(cache_key, cluster_arrays,
+                                          rng.get_state())
+                    source = 'took'
+
+                share_cluster_map(cluster_arrays, shared_dir,
+                                  '{0}_{1}'.format(seed, clustering_thr))
+                tractogram_clusters[(seed, clustering_thr)] = \
+                    (cluster_arrays[0], cluster_arrays[2])
+
+                logging.info('QBx with seed {0} at {1}mm {2} {3}sec. gave '
+                             '{4} centroids'.format(seed, current_thr_list,
+                                                    source,
+                                                    round(time() - timer, 2),
+                                                    len(cluster_arrays[0])))
+
+            # Each task starts from the same random state, whatever the
+            # order in which the tasks are run
+            rng_states[seed] = rng.get_state()
+
+        return rng_states, tractogram_clusters
+
     def multi_recognize(self, input_tractogram_path, tractogram_clustering_thr,
-                        nb_points=20, nbr_processes=1, seeds=None):
+                        nb_points=20, nbr_processes=1, seeds=None,
+                        cluster_cache=None):
         """
         Parameters
         ----------
@@ -236,6 +440,9 @@ class VotingScheme(object):
             Number of processes used for the parallel bundle recognition
         seeds : list
             List of seed for the RandomState
+        cluster_cache : ClusterCache
+            On-disk cache of the tractogram clustering, reused across runs
+            (not used for a None seed)
         """
 
         # Load the subject tractogram
@@ -248,6 +455,12 @@ class VotingScheme(object):
                                                         round(time() -
                                                               timer, 2)))
 
+        if self.model_atlas is not None and \
+                self.model_atlas.nb_points != nb_points:
+            raise ValueError('The atlas was compiled with {0} points per '
+                             'streamline instead of {1}'.format(
+                                 self.model_atlas.nb_points, nb_points))
+
         # Prepare all tags to read the atlas properly
         bundle_names, bundles_filepath = self._init_bundles_tag()
 
@@ -256,6 +469,7 @@ class VotingScheme(object):
         processing_dict['bundle_id'] = []
         processing_dict['tag'] = []
         processing_dict['model_bundle'] = []
+        processing_dict['model_centroids'] = []
         processing_dict['tct'] = []
         processing_dict['mct'] = []
         processing_dict['bpt'] = []
@@ -292,9 +506,14 @@ class VotingScheme(object):
                                   picked_parameters))
 
                 # Using the tag previously generated, load the appropriate
-                # model bundles
-                model_bundles_dict = self._load_bundles_dictionary(
-                    bundles_filepath[bundle_id])
+                # model bundles, or only their centroids from a compiled atlas
+                if self.model_atlas is None:
+                    model_bundles_dict = self._load_bundles_dictionary(
+                        bundles_filepath[bundle_id])
+                else:
+                    model_centroids_dict = self._load_centroids_dictionary(
+                        bundles_filepath[bundle_id],
+                        sorted(set(mct for _, mct, _ in picked_parameters)))
 
                 # Each run (can) have their unique set of parameters
                 for parameters in picked_parameters:
@@ -302,10 +521,16 @@ class VotingScheme(object):
 
                     # Each bundle (can) have multiple models
                     for tag in bundles_filepath[bundle_id]:
-                        model_bundle = model_bundles_dict[tag]
+                        if self.model_atlas is None:
+                            model_bundle = model_bundles_dict[tag]
+                            model_centroids = None
+                        else:
+                            model_bundle = None
+                            model_centroids = model_centroids_dict[(tag, mct)]
                         processing_dict['bundle_id'] += [bundle_id]
                         processing_dict['tag'] += [tag]
                         processing_dict['model_bundle'] += [model_bundle]
+                        processing_dict['model_centroids'] += [model_centroids]
                         processing_dict['tct'] += [tct]
                         processing_dict['mct'] += [mct]
                         processing_dict['bpt'] += [bpt]
@@ -313,58 +538,56 @@ class VotingScheme(object):
                         processing_dict['seed'] += [seed]
 
         # Cluster the whole tractogram only once per possible clustering threshold
-        rbx_all = {}
-        base_thresholds = [45, 35, 25]
-        for seed in seeds:
-            rng = np.random.RandomState(seed)
-            for clustering_thr in tractogram_clustering_thr:
-                timer = time()
-                # If necessary, add an extra layer (more optimal)
-                if clustering_thr < 15:
-                    current_thr_list = base_thresholds + [15, clustering_thr]
-                else:
-                    current_thr_list = base_thresholds + [clustering_thr]
-
-                cluster_map = qbx_and_merge(wb_streamlines,
-                                            current_thr_list,
-                                            nb_pts=nb_points, rng=rng,
-                                            verbose=False)
-
-                rbx_all[(seed, clustering_thr)] = RecobundlesX(wb_streamlines,
-                                                               cluster_map,
-                                                               nb_points=nb_points,
-                                                               rng=rng)
-
-                logging.info('QBx with seed {0} at {1}mm took {2}sec. gave '
-                             '{3} centroids'.format(seed, current_thr_list,
-                                                    round(time() - timer, 2),
-                                                    len(cluster_map.centroids)))
-
-        pool = multiprocessing.Pool(nbr_processes)
-        all_measures_dict = pool.map(single_recognize,
-                                     zip(repeat(rbx_all),
-                                         processing_dict['bundle_id'],
-                                         processing_dict['tag'],
-                                         processing_dict['model_bundle'],
-                                         processing_dict['tct'],
-                                         processing_dict['mct'],
-                                         processing_dict['bpt'],
-                                         processing_dict['slr_transform_type'],
-                                         processing_dict['seed']))
-        pool.close()
-        pool.join()
-
-        streamlines_wise_vote = dok_matrix((len(wb_streamlines),
-                                            len(bundle_names)),
-                                           dtype=np.int16)
-        bundles_wise_vote = dok_matrix((len(bundle_names),
-                                        len(wb_streamlines)),
-                                       dtype=np.int16)
-
-        for bundle_id, recognized_indices in all_measures_dict:
-            if recognized_indices is not None:
-                streamlines_wise_vote[recognized_indices.T, bundle_id] += 1
-                bundles_wise_vote[bundle_id, recognized_indices.T] += 1
+        # The tractogram and the clusters are shared with the processes as
+        # memory-mapped arrays, instead of being serialized for each task
+        shared_dir = tempfile.mkdtemp()
+        try:
+            share_streamlines(wb_streamlines, shared_dir)
+            rng_states, tractogram_clusters = self._cluster_tractogram(
+                wb_streamlines, tractogram_clustering_thr, nb_points, seeds,
+                shared_dir, cluster_cache=cluster_cache)
+
+            # Tasks are dispatched one at a time, longest first, to the first
+            # free process. Votes do not depend on the order of the results.
+            tasks = []
+            for task_id, seed in enumerate(processing_dict['seed']):
+                task = dict((key, processing_dict[key][task_id])
+                            for key in processing_dict)
+                task.update({'shared_dir': shared_dir,
+                             'rng_state': rng_states[seed],
+                             'nb_points': nb_points,
+                             'task_id': task_id})
+                tasks.append(task)
+            tasks_log = self._estimate_tasks_cost(processing_dict,
+                                                  tractogram_clusters,
+                                                  nb_points)
+            order = order_by_cost([task_log['estimated_cost']
+                                   for task_log in tasks_log])
+
+            pool = multiprocessing.Pool(nbr_processes)
+            try:
+                results = pool.imap_unordered(single_recognize,
+                                              [tasks[i] for i in order],
+                                              chunksize=1)
+                streamlines_wise_vote = self._accumulate_votes(
+                    self._log_tasks_results(results, tasks_log),
+                    len(wb_streamlines), len(bundle_names))
+                pool.close()
+            except BaseException:
+                # Workers still attached to the shared arrays are stopped
+                # before the directory is removed
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        finally:
+            detach(shared_dir)
+            shutil.rmtree(shared_dir)
+
+        out_tasks_logfile = os.path.join(self.output_directory,
+                                         'tasks_log.json')
+        with open(out_tasks_logfile, 'w') as outfile:
+            json.dump(tasks_log, outfile, indent=1)
 
         nb_exec = len(self.atlas_dir) * self.multi_parameters * len(seeds) * \
             len(bundle_names)
@@ -387,7 +610,6 @@ class VotingScheme(object):
         extension = os.path.splitext(input_tractogram_path)[1]
         self._save_recognized_bundles(tractogram, bundle_names,
                                       streamlines_wise_vote,
-                                      bundles_wise_vote,
                                       minimum_vote, extension)
 
 
@@ -395,8 +617,15 @@ def single_recognize(args):
     """
     Parameters
     ----------
-    rbx_all : dict
-        Dictionary with int as key and QBx ClusterMap as values
+    args : dict
+        Parameters of the task, with the following keys.
+    shared_dir : str
+        Directory of the tractogram and QBx cluster maps, shared as
+        memory-mapped arrays
+    rng_state : tuple
+        State of the RandomState of the seed after the tractogram clustering
+    nb_points : int
+        Number of points used for all resampling of streamlines
     bundle_id : int
         Unique value to each bundle to identify them
     tag : str
@@ -414,41 +643,68 @@ def single_recognize(args):
         [translation, rigid, similarity, scaling]
     seed : int
         Value to initialize the RandomState of numpy
+    model_centroids : list or None
+        Centroids of the model bundle at mct from a compiled atlas, the model
+        bundle is then not clustered
+    task_id : int
+        Index of the task, results can arrive in any order
     Returns
     -------
     transf_neighbor : tuple
+        task_id (int)
+            Index of the task
         bundle_id (int)
             Unique value to each bundle to identify them
         recognized_indices (numpy.ndarray)
             Streamlines indices from the original tractogram
+        duration (float)
+            Duration of the recognition in seconds
+        nb_neighbors (int)
+            Number of neighbor streamlines of the model in the tractogram
     """
-    rbx_all = args[0]
-    bundle_id = args[1]
-    tag = args[2]
-    model_bundle = args[3]
-    tct = args[4]
-    mct = args[5]
-    bpt = args[6]
-    slr_transform_type = args[7]
-    seed = args[8]
-
-    rbx = rbx_all[(seed, tct)]
+    shared_dir = args['shared_dir']
+    rng_state = args['rng_state']
+    nb_points = args['nb_points']
+    bundle_id = args['bundle_id']
+    tag = args['tag']
+    model_bundle = args['model_bundle']
+    tct = args['tct']
+    mct = args['mct']
+    bpt = args['bpt']
+    slr_transform_type = args['slr_transform_type']
+    seed = args['seed']
+    model_centroids = args['model_centroids']
+    task_id = args['task_id']
+
+    # Attached once per process, without copying the arrays
+    rng = np.random.RandomState()
+    rng.set_state(rng_state)
+    rbx = RecobundlesX(attach_streamlines(shared_dir),
+                       attach_cluster_map(shared_dir,
+                                          '{0}_{1}'.format(seed, tct)),
+                       nb_points=nb_points, rng=rng)
 
     timer = time()
     recognized_bundle = rbx.recognize(model_bundle,
                                       model_clust_thr=mct,
                                       bundle_pruning_thr=bpt,
                                       slr_transform_type=slr_transform_type,
-                                      identifier=tag)
+                                      identifier=tag,
+                                      model_centroids=model_centroids)
     recognized_indices = rbx.get_pruned_indices()
 
+    duration = time() - timer
+    rounded_duration = round(duration, 2)
+
     logging.info('Model {0} recognized {1} streamlines'.format(
                  tag, len(recognized_bundle)))
     logging.debug('Model {0} (seed {1}) with parameters '
-                  'tct={2}, mct={3}, bpt={4} took {5} sec.'.format(tag, seed,
-                                                                   tct, mct, bpt,
-                                                                   round(time() -
-                                                                         timer, 2)))
+                  'tct={2}, mct={3}, bpt={4} took {5} sec.'.format(
+                      tag, seed, tct, mct, bpt, rounded_duration))
     if recognized_indices is None:
         recognized_indices = []
-    return bundle_id, np.asarray(recognized_indices, dtype=np.int)
+    nb_neighbors = 0
+    if rbx.neighb_streamlines is not None:
+        nb_neighbors = len(rbx.neighb_streamlines)
+    return (task_id, bundle_id, np.asarray(recognized_indices, dtype=np.int),
+            duration, nb_neighbors)
@@ -0,0 +1,596 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import division
+
+from builtins import zip
+import multiprocessing
+import os
+
+from dipy.tracking.streamlinespeed import length
+from nibabel.streamlines import ArraySequence
+import numpy as np
+
+from scilpy.tractanalysis.features import (remove_outliers,
+                                           remove_loops_and_sharp_turns)
+from scilpy.tractanalysis.quick_tools import \
+    extract_longest_segments_from_indices
+from scilpy.tractanalysis.tools import compute_streamline_segment
+from scilpy.tractanalysis.uncompress import uncompress, uncompress_parallel
+
+# Order in which the post-processing steps are reported. The keys match the
+# output sub-directories of scil_compute_connectivity.py.
+PROCESSING_STEPS = ['raw', 'removed_length', 'pruned', 'loops', 'no_loops',
+                    'outliers', 'no_outliers', 'qb_loops', 'final']
+
+# Data shared with the worker processes, set once by the pool initializer
+# so the tractogram is never pickled along with each label pair.
+_worker_data = {}
+
+
+def get_processing_options(no_pruning=False, min_length=20.,
+                           max_length=200., vox_size=1.,
+                           no_remove_loops=False, loop_max_angle=360.,
+                           no_remove_outliers=False, outlier_threshold=0.3,
+                           no_remove_loops_again=False, loop_qb_distance=15.):
+    """
+    Gather the post-processing options of a connection in a dictionary.
+    Lengths are in mm, vox_size is the (isotropic) voxel size used to
+    convert the voxel space segments lengths.
+    """
+    return {'no_pruning': no_pruning,
+            'min_length': min_length,
+            'max_length': max_length,
+            'vox_size': vox_size,
+            'no_remove_loops': no_remove_loops,
+            'loop_max_angle': loop_max_angle,
+            'no_remove_outliers': no_remove_outliers,
+            'outlier_threshold': outlier_threshold,
+            'no_remove_loops_again': no_remove_loops_again,
+            'loop_qb_distance': loop_qb_distance}
+
+
+def prune_segments(segments, min_length, max_length, vox_size):
+    """
+    Split segments according to their length (in mm).
+    Parameters
+    ----------
+    segments: list of ndarray
+        Segments in voxel space.
+    min_length: float
+        Minimal length of a valid segment.
+    max_length: float
+        Maximal length of a valid segment.
+    vox_size: float
+        Isotropic voxel size, in mm.
+    Returns
+    -------
+    A tuple containing
+        list of ndarray: the segments within the length range
+        list of ndarray: the segments outside of the length range
+    """
+    lengths = list(length(segments) * vox_size)
+    valid = []
+    invalid = []
+
+    for s, l in zip(segments, lengths):
+        if min_length <= l <= max_length:
+            valid.append(s)
+        else:
+            invalid.append(s)
+    return valid, invalid
+
+
+def compute_connection_segments(streamlines, indices, points_to_idx,
+                                pair_info):
+    """
+    Cut the streamlines of a connection to keep only the segment between
+    the two labels.
+    Parameters
+    ----------
+    streamlines: ArraySequence
+        Streamlines in voxel space.
+    indices: ArraySequence
+        Voxel indices traversed by each streamline, as returned by uncompress.
+    points_to_idx: ArraySequence
+        Mapping of each streamline point to its voxel index.
+    pair_info: list of dict
+        Connection information, as returned by compute_connectivity.
+    Returns
+    -------
+    list of ndarray: one segment per connection information.
+    """
+    segments = []
+    for connection in pair_info:
+        strl_idx = connection['strl_idx']
+        segments.append(compute_streamline_segment(streamlines[strl_idx],
+                                                   indices[strl_idx],
+                                                   connection['in_idx'],
+                                                   connection['out_idx'],
+                                                   points_to_idx[strl_idx]))
+    return segments
+
+
+def process_connection(streamlines, indices, points_to_idx, pair_info,
+                       options):
+    """
+    Extract and post-process the segments of a single connection.
+    Parameters
+    ----------
+    streamlines: ArraySequence
+        Streamlines in voxel space.
+    indices: ArraySequence
+        Voxel indices traversed by each streamline, as returned by uncompress.
+    points_to_idx: ArraySequence
+        Mapping of each streamline point to its voxel index.
+    pair_info: list of dict
+        Connection information, as returned by compute_connectivity.
+    options: dict
+        Post-processing options, as returned by get_processing_options.
+    Returns
+    -------
+    dict: Streamlines (list of ndarray) of each step in PROCESSING_STEPS
+        that was reached. A step is missing when the connection was emptied
+        before getting to it. When reached, 'final_strl_idx' holds the
+        source streamline index of each final segment.
+    """
+    results = {}
+    final_strl = compute_connection_segments(streamlines, indices,
+                                             points_to_idx, pair_info)
+    results['raw'] = final_strl
+
+    if not options['no_pruning']:
+        pruned_strl, invalid_strl = prune_segments(final_strl,
+                                                   options['min_length'],
+                                                   options['max_length'],
+                                                   options['vox_size'])
+        results['removed_length'] = invalid_strl
+    else:
+        pruned_strl = final_strl
+
+    if not len(pruned_strl):
+        return results
+    results['pruned'] = pruned_strl
+
+    if not options['no_remove_loops']:
+        no_loops, loops = remove_loops_and_sharp_turns(
+            pruned_strl, options['loop_max_angle'])
+        results['loops'] = loops
+    else:
+        no_loops = pruned_strl
+
+    if not len(no_loops):
+        return results
+    results['no_loops'] = no_loops
+
+    if not options['no_remove_outliers']:
+        no_outliers, outliers = remove_outliers(no_loops,
+                                                options['outlier_threshold'])
+        # Clusters hold a reference to all of their streamlines, only keep
+        # the selected ones to avoid transferring them more than once.
+        no_outliers = list(no_outliers)
+        results['outliers'] = list(outliers)
+    else:
+        no_outliers = no_loops
+
+    if not len(no_outliers):
+        return results
+    results['no_outliers'] = no_outliers
+
+    if not options['no_remove_loops_again']:
+        no_qb_loops_strl, loops2 = remove_loops_and_sharp_turns(
+            no_outliers,
+            options['loop_max_angle'],
+            True,
+            options['loop_qb_distance'])
+        results['qb_loops'] = loops2
+    else:
+        no_qb_loops_strl = no_outliers
+
+    results['final'] = no_qb_loops_strl
+
+    # All steps keep references to the raw segments, which gives back the
+    # source streamline of each final segment.
+    raw_position = dict((id(s), i) for i, s in enumerate(final_strl))
+    results['final_strl_idx'] = \
+        [pair_info[raw_position[id(s)]]['strl_idx'] for s in no_qb_loops_strl]
+
+    return results
+
+
+def _init_worker(streamlines, indices, points_to_idx, options):
+    _worker_data['streamlines'] = streamlines
+    _worker_data['indices'] = indices
+    _worker_data['points_to_idx'] = points_to_idx
+    _worker_data['options'] = options
+
+
+def _process_connection_worker(args):
+    in_label, out_label, pair_info = args
+    results = process_connection(_worker_data['streamlines'],
+                                 _worker_data['indices'],
+                                 _worker_data['points_to_idx'],
+                                 pair_info,
+                                 _worker_data['options'])
+    return in_label, out_label, results
+
+
+def _process_connection_data_worker(args):
+    (in_label, out_label, pair_info, streamlines, indices, points_to_idx,
+     options) = args
+    return in_label, out_label, process_connection(streamlines, indices,
+                                                   points_to_idx, pair_info,
+                                                   options)
+
+
+def _get_connection_data_tasks(tasks, streamlines, indices, points_to_idx,
+                               options):
+    # Only the streamlines of a connection are sent along with it, in dicts
+    # indexed as the whole tractogram.
+    for in_label, out_label, pair_info in tasks:
+        strl_ids = [connection['strl_idx'] for connection in pair_info]
+        yield (in_label, out_label, pair_info,
+               dict((i, streamlines[i]) for i in strl_ids),
+               dict((i, indices[i]) for i in strl_ids),
+               dict((i, points_to_idx[i]) for i in strl_ids),
+               options)
+
+
+def _get_connection_tasks(con_info):
+    tasks = []
+    for in_label in sorted(con_info.keys()):
+        for out_label in sorted(con_info[in_label].keys()):
+            pair_info = con_info[in_label][out_label]
+            if len(pair_info):
+                tasks.append((in_label, out_label, pair_info))
+    return tasks
+
+
+def iter_processed_connections(con_info, streamlines, indices, points_to_idx,
+                               options, nbr_processes=1, pool=None):
+    """
+    Post-process all connections, optionally using a pool of processes.
+    Connections are always yielded in increasing (in_label, out_label) order
+    and each of them is processed independently with fixed seeds, so the
+    results are identical whatever the number of processes.
+    Parameters
+    ----------
+    con_info: dict of dict of list
+        Symmetrized connection information.
+    streamlines: ArraySequence
+        Streamlines in voxel space.
+    indices: ArraySequence
+        Voxel indices traversed by each streamline, as returned by uncompress.
+    points_to_idx: ArraySequence
+        Mapping of each streamline point to its voxel index.
+    options: dict
+        Post-processing options, as returned by get_processing_options.
+    nbr_processes: int
+        Number of processes used to post-process the connections.
+    pool: multiprocessing.Pool
+        If given, used instead of a new pool of nbr_processes. The
+        streamlines of each connection are then sent along with it, so a
+        single pool can process many tractograms (e.g chunks). The pool is
+        not closed.
+    Returns
+    -------
+    generator of tuple: (in_label, out_label, results), results as returned
+        by process_connection.
+    """
+    tasks = _get_connection_tasks(con_info)
+
+    if pool is not None:
+        for result in pool.imap(_process_connection_data_worker,
+                                _get_connection_data_tasks(tasks, streamlines,
+                                                           indices,
+                                                           points_to_idx,
+                                                           options)):
+            yield result
+        return
+
+    if nbr_processes == 1 or len(tasks) < 2:
+        for in_label, out_label, pair_info in tasks:
+            yield in_label, out_label, process_connection(streamlines,
+                                                          indices,
+                                                          points_to_idx,
+                                                          pair_info,
+                                                          options)
+        return
+
+    pool = multiprocessing.Pool(nbr_processes,
+                                initializer=_init_worker,
+                                initargs=(streamlines, indices,
+                                          points_to_idx, options))
+    try:
+        # imap keeps the tasks order, results are handed back as soon as
+        # all the previous connections are done.
+        for result in pool.imap(_process_connection_worker, tasks):
+            yield result
+    finally:
+        # All results were received (or the caller stopped early), no need
+        # to wait for the workers.
+        pool.terminate()
+        pool.join()
+
+
+def segments_arrays_to_symmetric_con_info(strl_idx, start_label, end_label,
+                                          in_idx, out_idx):
+    """
+    Build the symmetrized connection information (in_label <= out_label)
+    from the flat arrays of extract_longest_segments_from_indices.
+    Only the label pairs that are connected are present. Within a pair, the
+    streamlines going from in_label to out_label come first, each group being
+    ordered by streamline index.
+    """
+    sym_in_label = np.minimum(start_label, end_label)
+    sym_out_label = np.maximum(start_label, end_label)
+    swapped = start_label > end_label
+    ordering = np.lexsort((strl_idx, swapped, sym_out_label, sym_in_label))
+
+    con_info = {}
+    for i in ordering.tolist():
+        in_label = int(sym_in_label[i])
+        out_label = int(sym_out_label[i])
+        if in_label not in con_info:
+            con_info[in_label] = {}
+        if out_label not in con_info[in_label]:
+            con_info[in_label][out_label] = []
+        con_info[in_label][out_label].append({'strl_idx': int(strl_idx[i]),
+                                              'in_idx': int(in_idx[i]),
+                                              'out_idx': int(out_idx[i])})
+
+    return con_info
+
+
+class StreamlinesSpill(object):
+    def __init__(self, spill_dir):
+        """
+        Append the streamlines of each connection to raw files on disk, so
+        they never have to be held in memory all at once.
+
+        Parameters
+        ----------
+        spill_dir : str
+            Existing directory where the raw files are written.
+        """
+        self.spill_dir = spill_dir
+        self.pairs = set()
+
+    def _get_filenames(self, in_label, out_label):
+        basename = os.path.join(self.spill_dir,
+                                '{}_{}'.format(in_label, out_label))
+        return (basename + '_data.bin', basename + '_lengths.bin',
+                basename + '_indices.bin')
+
+    def append(self, in_label, out_label, streamlines, strl_indices):
+        """
+        Append streamlines (in voxel space) to a connection, along with the
+        index of their source streamline in the tractogram.
+        """
+        if not len(streamlines):
+            return
+
+        data_filename, lengths_filename, indices_filename = \
+            self._get_filenames(in_label, out_label)
+        lengths = np.array([len(s) for s in streamlines], dtype=np.int64)
+        with open(data_filename, 'ab') as data_file:
+            for s in streamlines:
+                np.asarray(s, dtype=np.float32).tofile(data_file)
+        with open(lengths_filename, 'ab') as lengths_file:
+            lengths.tofile(lengths_file)
+        with open(indices_filename, 'ab') as indices_file:
+            np.asarray(strl_indices, dtype=np.int64).tofile(indices_file)
+
+        self.pairs.add((in_label, out_label))
+
+    def load_indices(self, in_label, out_label):
+        return np.fromfile(self._get_filenames(in_label, out_label)[2],
+                           dtype=np.int64)
+
+    def load(self, in_label, out_label):
+        data_filename, lengths_filename, _ = \
+            self._get_filenames(in_label, out_label)
+        streamlines = ArraySequence()
+        streamlines._data = np.fromfile(data_filename,
+                                        dtype=np.float32).reshape((-1, 3))
+        streamlines._lengths = np.fromfile(lengths_filename,
+                                           dtype=np.int64).astype(np.intp)
+        streamlines._offsets = np.concatenate(
+            ([0], np.cumsum(streamlines._lengths)[:-1])).astype(np.intp)
+        return streamlines
+
+    def remove(self, in_label, out_label):
+        for filename in self._get_filenames(in_label, out_label):
+            os.remove(filename)
+        self.pairs.discard((in_label, out_label))
+
+
+class ConnectivityAccumulator(object):
+    def __init__(self, nb_labels, img_shape, vox_size=1., metrics=None,
+                 compute_length=False, compute_volume=False):
+        """
+        Accumulate the connectivity matrices while the connections are
+        post-processed, so the streamlines never have to be visited again.
+        Connections can be added more than once (e.g. one chunk at a time).
+
+        Parameters
+        ----------
+        nb_labels : int
+            Maximal label value. Matrices have a (nb_labels + 1) shape, the
+            first row and column being the background.
+        img_shape : tuple
+            Shape of the labels volume (and of the metrics).
+        vox_size : float
+            Isotropic voxel size, in mm.
+        metrics : dict
+            Metric name as key, 3D numpy.ndarray as value. The mean of each
+            metric along the segments of the connection is computed, each
+            voxel being weighted by the number of times it is traversed.
+            Voxels crossed by many segments count more than the others.
+        compute_length : bool
+            Compute the mean segment length (mm) of each connection.
+        compute_volume : bool
+            Compute the volume (mm^3) of the voxels traversed by each
+            connection.
+        """
+        shape = (nb_labels + 1, nb_labels + 1)
+        self.img_shape = tuple(img_shape)
+        self.vox_size = vox_size
+
+        self.count = np.zeros(shape, dtype=np.uint32)
+        self.length_sum = None
+        if compute_length:
+            self.length_sum = np.zeros(shape, dtype=np.float64)
+
+        # Set of the voxels ids traversed by each connection
+        self.voxels = None
+        if compute_volume:
+            self.voxels = {}
+
+        # Metrics are flattened once, then indexed with the voxels ids
+        self.metrics = {}
+        self.metrics_sum = {}
+        self.metrics_visits = None
+        if metrics:
+            for name, data in metrics.items():
+                if data.shape[:3] != self.img_shape:
+                    raise ValueError('Metric {} does not have the labels '
+                                     'shape.'.format(name))
+                self.metrics[name] = np.asarray(data, dtype=np.float64).ravel()
+                self.metrics_sum[name] = np.zeros(shape, dtype=np.float64)
+            self.metrics_visits = np.zeros(shape, dtype=np.uint64)
+
+    def add(self, in_label, out_label, streamlines):
+        """
+        Add the (final) streamlines of a connection.
+
+        Parameters
+        ----------
+        in_label : int
+            Smallest label of the connection.
+        out_label : int
+            Largest label of the connection.
+        streamlines : list of numpy.ndarray
+            Segments in voxel space.
+        """
+        if not len(streamlines):
+            return
+
+        self.count[in_label, out_label] += len(streamlines)
+
+        if self.length_sum is not None:
+            self.length_sum[in_label, out_label] += \
+                np.sum(length(streamlines)) * self.vox_size
+
+        if self.voxels is None and self.metrics_visits is None:
+            return
+
+        segments = ArraySequence(streamlines)
+        # Points on or past the grid edge would give ids of other (or no)
+        # voxels, so they are clipped into the last voxel
+        segments._data = np.clip(segments._data, 0,
+                                 np.array(self.img_shape) - 1e-3
+                                 ).astype(np.float32)
+        voxels_ids = uncompress(segments, dimensions=self.img_shape)._data
+
+        if self.voxels is not None:
+            self.voxels.setdefault((in_label, out_label), set()).update(
+                np.unique(voxels_ids).tolist())
+
+        if self.metrics_visits is not None:
+            self.metrics_visits[in_label, out_label] += len(voxels_ids)
+            for name, data in self.metrics.items():
+                self.metrics_sum[name][in_label, out_label] += \
+                    np.sum(data[voxels_ids])
+
+    @staticmethod
+    def _mean(values_sum, count):
+        mean = np.zeros(values_sum.shape, dtype=np.float64)
+        mask = count > 0
+        mean[mask] = values_sum[mask] / count[mask]
+        return mean
+
+    def get_count_matrix(self):
+        return self.count
+
+    def get_length_matrix(self):
+        return self._mean(self.length_sum, self.count)
+
+    def get_volume_matrix(self):
+        volume = np.zeros(self.count.shape, dtype=np.float64)
+        for (in_label, out_label), voxels_ids in self.voxels.items():
+            volume[in_label, out_label] = \
+                len(voxels_ids) * self.vox_size ** 3
+        return volume
+
+    def get_metric_matrix(self, name):
+        return self._mean(self.metrics_sum[name], self.metrics_visits)
+
+
+def compute_streaming_connectivity(streamlines_chunks, atlas_data,
+                                   accumulator, options,
+                                   connections_writer=None, nbr_processes=1,
+                                   pool=None):
+    """
+    Compute the connectivity matrices one chunk of streamlines at a time.
+    Only the accumulated matrices (and optionally the spilled final
+    streamlines) are kept between chunks, so memory is bounded by the chunk
+    size.
+    Outlier removal and QuickBundles loop removal need all the streamlines
+    of a connection, they must be disabled in the options.
+    Parameters
+    ----------
+    streamlines_chunks: iterable of ArraySequence
+        Chunks of streamlines in voxel space, e.g. from
+        scilpy.io.streamlines.ichunk_trk_in_voxel_space.
+    atlas_data: numpy.ndarray (3D)
+        Labels volume.
+    accumulator: ConnectivityAccumulator
+        Receives the final streamlines of each connection of each chunk.
+    options: dict
+        Post-processing options, as returned by get_processing_options.
+    connections_writer: StreamlinesSpill or ConnectionsHdf5Writer
+        If given, the final streamlines of each connection are appended to it,
+        with their streamline index in the whole tractogram.
+    nbr_processes: int
+        Number of threads used to uncompress each chunk.
+    pool: multiprocessing.Pool
+        If given, post-processes the connections of all chunks, otherwise
+        they are post-processed in this process. It must be created before
+        opening an HDF5 connections_writer, the file handle must not be
+        inherited by the workers. The pool is not closed.
+    """
+    if not (options['no_remove_outliers'] and
+            options['no_remove_loops_again']):
+        raise ValueError('Outlier removal and QuickBundles loop removal '
+                         'cannot be applied one chunk at a time, they must '
+                         'be disabled.')
+
+    atlas_data = atlas_data.astype(np.int32)
+
+    chunk_offset = 0
+    for streamlines in streamlines_chunks:
+        if not len(streamlines):
+            continue
+
+        if nbr_processes > 1:
+            indices, points_to_idx = uncompress_parallel(
+                streamlines, return_mapping=True, nbr_threads=nbr_processes)
+        else:
+            indices, points_to_idx = uncompress(streamlines,
+                                                return_mapping=True)
+        con_info = segments_arrays_to_symmetric_con_info(
+            *extract_longest_segments_from_indices(indices, atlas_data))
+
+        for in_label, out_label, results in iter_processed_connections(
+                con_info, streamlines, indices, points_to_idx, options,
+                pool=pool):
+            if 'final' not in results:
+                continue
+
+            accumulator.add(in_label, out_label, results['final'])
+            if connections_writer is not None:
+                connections_writer.append(
+                    in_label, out_label, results['final'],
+                    np.asarray(results['final_strl_idx']) + chunk_offset)
+
+        chunk_offset += len(streamlines)
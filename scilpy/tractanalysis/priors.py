@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+from collections import deque
+import gzip
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import nibabel as nib
+import numpy as np
+
+from scilpy.io.image import create_memmap_nifti
+from scilpy.reconst.sh_projector import get_sh_projector
+from scilpy.reconst.utils import find_order_from_nb_coeff
+from scilpy.tractanalysis.todi import TrackOrientationDensityImaging
+
+PRIORS_SPHERE = 'repulsion724'
+
+
+def compute_todi_priors_sf(streamlines, wm_mask, todi_sigma=1,
+                           sf_threshold=0.2):
+    """Compute the TODI of a bundle, as priors spherical functions (SF).
+
+    Parameters
+    ----------
+    streamlines : list or ArraySequence
+        Streamlines of the bundle, in voxel space.
+    wm_mask : numpy.ndarray (3D)
+        Mask constraining the TODI spatial smoothing (e.g a WM mask).
+    todi_sigma : int, optional
+        Sigma of the TODI spatial smoothing (default 1).
+    sf_threshold : float, optional
+        Relative threshold for SF masking, 0.0-1.0 (default 0.2).
+
+    Returns
+    -------
+    sub_mask_3d : numpy.ndarray (3D)
+        Voxels of the TODI within the WM mask.
+    todi_sf : numpy.ndarray (2D)
+        Priors SF of each voxel of sub_mask_3d (in C order), between
+        sf_threshold and 1.
+    """
+    with TrackOrientationDensityImaging(wm_mask.shape,
+                                        PRIORS_SPHERE) as todi_obj:
+        todi_obj.compute_todi(streamlines, length_weights=True)
+        todi_obj.smooth_todi_dir()
+        todi_obj.smooth_todi_spatial(sigma=todi_sigma)
+
+        # Fancy masking of 1d indices to limit spatial dilation to WM
+        sub_mask_3d = np.logical_and(
+            wm_mask, todi_obj.reshape_to_3d(todi_obj.get_mask()))
+        sub_mask_1d = sub_mask_3d.flatten()[todi_obj.get_mask()]
+        todi_sf = todi_obj.get_todi()[sub_mask_1d] ** 2
+
+    # The priors should always be between 0 and 1
+    # A minimum threshold is set to prevent misaligned FOD from disappearing
+    todi_sf /= np.max(todi_sf, axis=-1, keepdims=True)
+    todi_sf[todi_sf < sf_threshold] = sf_threshold
+
+    return sub_mask_3d, todi_sf
+
+
+def compute_endpoints_mask(streamlines, mask):
+    """Mask of the streamlines endpoints, for streamlines starting in mask.
+
+    Parameters
+    ----------
+    streamlines : list or ArraySequence
+        Streamlines of the bundle, in voxel space.
+    mask : numpy.ndarray (3D)
+        Mask of the valid starting points.
+
+    Returns
+    -------
+    endpoints_mask : numpy.ndarray (3D)
+        Mask of the endpoints (int16).
+    """
+    endpoints_mask = np.zeros(mask.shape, dtype=np.int16)
+    for streamline in streamlines:
+        if mask[tuple(streamline[0].astype(np.int16))]:
+            endpoints_mask[tuple(streamline[0].astype(np.int16))] = 1
+            endpoints_mask[tuple(streamline[-1].astype(np.int16))] = 1
+    return endpoints_mask
+
+
+def compute_priors_block(sh_block, block_masks, todi_sfs, sh_order,
+                         sh_basis):
+    """Compute the priors and enhanced-FOD (E-FOD) of a block of voxels,
+    for one or many bundles.
+
+    The SF of the input FOD are evaluated once, on the union of the
+    bundles masks.
+
+    Parameters
+    ----------
+    sh_block : numpy.ndarray (4D)
+        Input FOD SH coefficients of the block.
+    block_masks : list of numpy.ndarray (3D)
+        Voxels of the block with priors, for each bundle.
+    todi_sfs : list of numpy.ndarray (2D)
+        Priors SF of the voxels of each block mask (in C order).
+    sh_order : int
+        Maximum SH order of the FOD.
+    sh_basis : str
+        SH basis of the FOD.
+
+    Returns
+    -------
+    results : list of tuple
+        Priors and E-FOD SH coefficients (float32) of the voxels of each
+        block mask (in C order).
+    """
+    sh_projector = get_sh_projector(PRIORS_SPHERE, sh_order, sh_basis)
+    union_mask = np.logical_or.reduce(block_masks)
+    input_sf = sh_projector.sh_to_sf(
+        np.asarray(sh_block[union_mask], dtype=np.float32))
+    union_rows = np.cumsum(union_mask.ravel()) - 1
+
+    results = []
+    for block_mask, todi_sf in zip(block_masks, todi_sfs):
+        priors_sh = sh_projector.sf_to_sh(todi_sf)
+        input_sf_1d = input_sf[union_rows[block_mask.ravel()]]
+
+        # Creation of the enhanced-FOD (direction-wise multiplication)
+        mult_sf_1d = input_sf_1d * todi_sf
+
+        input_max_value = np.max(input_sf_1d, axis=-1, keepdims=True)
+        mult_max_value = np.max(mult_sf_1d, axis=-1, keepdims=True)
+        mult_positive_mask = np.squeeze(mult_max_value, axis=-1) > 0.0
+        mult_sf_1d[mult_positive_mask] = mult_sf_1d[mult_positive_mask] * \
+            input_max_value[mult_positive_mask] / \
+            mult_max_value[mult_positive_mask]
+
+        results.append((priors_sh, sh_projector.sf_to_sh(mult_sf_1d)))
+    return results
+
+
+def _compute_priors_block_wrapper(args):
+    return compute_priors_block(*args)
+
+
+def _iter_priors_blocks(sh_data, sub_masks, todi_sfs, sh_order, sh_basis,
+                        block_size):
+    # Rows of each todi_sf are the voxels of its sub_mask_3d, in C order
+    img_shape = sub_masks[0].shape
+    sub_ids = [np.flatnonzero(sub_mask_3d) for sub_mask_3d in sub_masks]
+    for z_start in range(0, img_shape[2], block_size):
+        z_end = min(z_start + block_size, img_shape[2])
+        block_masks = []
+        block_todi_sfs = []
+        for sub_mask_3d, ids, todi_sf in zip(sub_masks, sub_ids, todi_sfs):
+            block_mask = sub_mask_3d[:, :, z_start:z_end]
+            x, y, z = np.nonzero(block_mask)
+            rows = np.searchsorted(ids, np.ravel_multi_index(
+                (x, y, z + z_start), img_shape))
+            block_masks.append(block_mask)
+            block_todi_sfs.append(np.asarray(todi_sf[rows]))
+
+        yield (z_start, z_end, sh_data[:, :, z_start:z_end],
+               (block_masks, block_todi_sfs))
+
+
+def _create_block_output(filename, shape, affine, tmp_dir):
+    # Compressed outputs are first written in a temporary uncompressed file
+    if filename.endswith('.nii'):
+        return filename, create_memmap_nifti(filename, shape, affine)
+    fd, tmp_filename = tempfile.mkstemp(suffix='.nii', dir=tmp_dir)
+    os.close(fd)
+    return tmp_filename, create_memmap_nifti(tmp_filename, shape, affine)
+
+
+def _compress_output(tmp_filename, filename, buffer_size=2**24):
+    # The uncompressed file is streamed through gzip, the image is never
+    # loaded in memory
+    with open(tmp_filename, 'rb') as f_in:
+        with gzip.open(filename, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, buffer_size)
+
+
+def _write_block(priors_memmaps, efod_memmaps, block, results):
+    z_start, z_end, sh_block, (block_masks, _) = block
+    for priors_memmap, efod_memmap, block_mask, (priors_sh, efod_sh) in \
+            zip(priors_memmaps, efod_memmaps, block_masks, results):
+        # The E-FOD is the input FOD outside of the bundle
+        efod_memmap[:, :, z_start:z_end] = sh_block
+        efod_memmap[:, :, z_start:z_end][block_mask] = efod_sh
+        priors_memmap[:, :, z_start:z_end][block_mask] = priors_sh
+
+
+def generate_priors(sh_filename, sub_masks, todi_sfs, sh_basis,
+                    out_priors, out_efods, block_size=8, nbr_processes=1):
+    """Generate the priors and enhanced-FOD (E-FOD) of bundles by blocks of
+    slices.
+
+    Blocks of slices of the FOD are read through the NIfTI proxy, processed
+    (optionally in worker processes) and written to memory-mapped outputs,
+    so the memory usage depends on the block size, not on the image size.
+    Compressed outputs are written uncompressed first, then streamed
+    through gzip. Each block is read once for all bundles. Reading blocks from a
+    compressed FOD is much slower than from an uncompressed one, unless
+    indexed_gzip is installed.
+
+    Parameters
+    ----------
+    sh_filename : str
+        Input FOD filename.
+    sub_masks : list of numpy.ndarray (3D)
+        Voxels with priors, for each bundle.
+    todi_sfs : list of numpy.ndarray (2D)
+        Priors SF of each voxel of each sub mask (in C order), can be
+        memory-mapped.
+    sh_basis : str
+        SH basis of the FOD.
+    out_priors : list of str
+        Output priors filenames, for each bundle.
+    out_efods : list of str
+        Output E-FOD filenames, for each bundle.
+    block_size : int, optional
+        Number of slices (along the last spatial axis) per block (default 8).
+    nbr_processes : int, optional
+        Number of worker processes (default 1).
+    """
+    img_sh = nib.load(sh_filename)
+    sh_order = find_order_from_nb_coeff(img_sh.shape)
+    blocks = _iter_priors_blocks(img_sh.dataobj, sub_masks, todi_sfs,
+                                 sh_order, sh_basis, block_size)
+
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(
+        out_priors[0])))
+    try:
+        outputs = []
+        priors_memmaps = []
+        efod_memmaps = []
+        for filenames, memmaps in [(out_priors, priors_memmaps),
+                                   (out_efods, efod_memmaps)]:
+            for filename in filenames:
+                tmp_filename, memmap = _create_block_output(
+                    filename, img_sh.shape, img_sh.affine, tmp_dir)
+                outputs.append((tmp_filename, filename))
+                memmaps.append(memmap)
+
+        if nbr_processes > 1:
+            # At most two blocks per process are in flight at once
+            pool = multiprocessing.Pool(nbr_processes)
+            try:
+                pending = deque()
+                for block in blocks:
+                    task = block[2:3] + block[3] + (sh_order, sh_basis)
+                    pending.append((block, pool.apply_async(
+                        _compute_priors_block_wrapper, (task,))))
+                    if len(pending) >= 2 * nbr_processes:
+                        block, results = pending.popleft()
+                        _write_block(priors_memmaps, efod_memmaps, block,
+                                     results.get())
+                while pending:
+                    block, results = pending.popleft()
+                    _write_block(priors_memmaps, efod_memmaps, block,
+                                 results.get())
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for block in blocks:
+                results = compute_priors_block(block[2], *block[3],
+                                               sh_order=sh_order,
+                                               sh_basis=sh_basis)
+                _write_block(priors_memmaps, efod_memmaps, block, results)
+
+        for memmap in priors_memmaps + efod_memmaps:
+            memmap.flush()
+        del priors_memmaps[:], efod_memmaps[:]
+
+        for tmp_filename, filename in outputs:
+            if tmp_filename != filename:
+                _compress_output(tmp_filename, filename)
+                os.remove(tmp_filename)
+    finally:
+        shutil.rmtree(tmp_dir)
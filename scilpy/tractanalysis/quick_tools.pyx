@@ -48,3 +48,123 @@ def get_previous_real_point(points_to_index, vox_index):
         map_idx = pts_to_index_view[previous_point]
 
     return previous_point
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def extract_longest_segments_from_indices(indices, atlas_data):
+    """
+    Compiled equivalent of extract_longest_segments_from_profile, applied to
+    all streamlines at once.
+
+    :param indices: nibabel.streamlines.array_sequence.ArraySequence
+        voxel indices of each streamline, as returned by uncompress.
+    :param atlas_data: numpy.ndarray (3D) of integer labels.
+    :return: tuple of 1D numpy.ndarray (strl_idx, start_label, end_label,
+        in_idx, out_idx), one element per streamline connecting 2 labels.
+    """
+    cdef:
+        cnp.npy_intp nb_streamlines = len(indices._lengths)
+        cnp.npy_intp nb_found = 0
+        cnp.npy_intp strl_idx, el_idx, offset, nb_el
+        cnp.npy_intp start_idx, end_idx
+        int start_label, end_label, label
+        bint found_wm, out_of_bounds = False
+        cnp.npy_intp dim_x, dim_y, dim_z
+
+    atlas_data = np.ascontiguousarray(atlas_data, dtype=np.int32)
+    dim_x, dim_y, dim_z = atlas_data.shape
+
+    out_strl_idx = np.zeros(nb_streamlines, dtype=np.intp)
+    out_start_label = np.zeros(nb_streamlines, dtype=np.int32)
+    out_end_label = np.zeros(nb_streamlines, dtype=np.int32)
+    out_in_idx = np.zeros(nb_streamlines, dtype=np.intp)
+    out_out_idx = np.zeros(nb_streamlines, dtype=np.intp)
+
+    if nb_streamlines == 0:
+        return (out_strl_idx, out_start_label, out_end_label,
+                out_in_idx, out_out_idx)
+
+    cdef:
+        cnp.npy_intp[:] lengths_view = indices._lengths
+        cnp.npy_intp[:] offsets_view = indices._offsets
+        cnp.uint16_t[:, :] data_view = indices._data
+        int[:, :, :] atlas_view = atlas_data
+        cnp.npy_intp[:] strl_idx_view = out_strl_idx
+        int[:] start_label_view = out_start_label
+        int[:] end_label_view = out_end_label
+        cnp.npy_intp[:] in_idx_view = out_in_idx
+        cnp.npy_intp[:] out_idx_view = out_out_idx
+
+    with nogil:
+        # Bounds are checked once, before labelling anything
+        for el_idx in range(data_view.shape[0]):
+            if data_view[el_idx, 0] >= dim_x or \
+                    data_view[el_idx, 1] >= dim_y or \
+                    data_view[el_idx, 2] >= dim_z:
+                out_of_bounds = True
+                break
+
+    if out_of_bounds:
+        raise IndexError('Streamlines indices are out of the atlas bounds.')
+
+    with nogil:
+        for strl_idx in range(nb_streamlines):
+            offset = offsets_view[strl_idx]
+            nb_el = lengths_view[strl_idx]
+
+            # First labelled voxel
+            start_idx = -1
+            start_label = 0
+            el_idx = 0
+            while el_idx < nb_el:
+                label = atlas_view[data_view[offset + el_idx, 0],
+                                   data_view[offset + el_idx, 1],
+                                   data_view[offset + el_idx, 2]]
+                el_idx += 1
+                if label > 0:
+                    start_label = label
+                    start_idx = el_idx - 1
+                    break
+
+            # The streamline must then go through the white matter
+            found_wm = False
+            while el_idx < nb_el:
+                label = atlas_view[data_view[offset + el_idx, 0],
+                                   data_view[offset + el_idx, 1],
+                                   data_view[offset + el_idx, 2]]
+                el_idx += 1
+                if label == 0:
+                    found_wm = True
+                    break
+
+            if el_idx >= nb_el or not found_wm:
+                continue
+
+            # Last labelled voxel
+            end_idx = -1
+            end_label = 0
+            el_idx = nb_el - 1
+            while el_idx > start_idx:
+                label = atlas_view[data_view[offset + el_idx, 0],
+                                   data_view[offset + el_idx, 1],
+                                   data_view[offset + el_idx, 2]]
+                if label > 0:
+                    end_label = label
+                    end_idx = el_idx
+                    break
+                el_idx -= 1
+
+            if end_idx < 0 or end_idx <= start_idx + 1:
+                continue
+
+            strl_idx_view[nb_found] = strl_idx
+            start_label_view[nb_found] = start_label
+            end_label_view[nb_found] = end_label
+            in_idx_view[nb_found] = start_idx
+            out_idx_view[nb_found] = end_idx
+            nb_found += 1
+
+    return (out_strl_idx[:nb_found].copy(), out_start_label[:nb_found].copy(),
+            out_end_label[:nb_found].copy(), out_in_idx[:nb_found].copy(),
+            out_out_idx[:nb_found].copy())
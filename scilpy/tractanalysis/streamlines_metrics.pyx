@@ -8,11 +8,47 @@
 from __future__ import division
 
 cimport cython
+from cython cimport floating
+from cython.parallel cimport prange, threadid
+cimport openmp
 import numpy as np
 cimport numpy as np
+from nibabel.streamlines import ArraySequence
 
 from libc.math cimport sqrt, floor, ceil, fabs
 from libc.math cimport fmin as cfmin
+from libc.stdlib cimport free, malloc, qsort, realloc
+
+# Maximum memory of the per-thread volumes of the dense mode, fewer threads
+# are used if they do not fit.
+DENSE_ACCUMULATORS_MAX_BYTES = 1024 ** 3
+
+
+cdef struct VoxelValue:
+    np.npy_intp voxel_id
+    double value
+
+
+cdef struct Accumulator:
+    # Dense mode: number of streamlines going through each voxel (or the sum
+    # of their values), and the last streamline (+ 1) flagged in each voxel.
+    np.int_t *counts
+    double *values
+    np.int32_t *touched_tags
+
+    # Sparse mode: voxels traversed by the streamlines, each voxel only once
+    # per streamline.
+    VoxelValue *voxels
+    np.npy_intp nb_voxels
+    np.npy_intp max_voxels
+
+    # Weight of the current streamline. If length_weighted, each voxel gets
+    # the weighted length of the streamline inside it, instead of the weight.
+    double weight
+    bint length_weighted
+
+    bint failed
+
 
 # Changing this to a memview was slower.
 @cython.boundscheck(False)
@@ -27,7 +63,7 @@ cdef inline double norm(double x, double y, double z) nogil:
 @cython.wraparound(False)
 cdef inline void c_get_closest_edge(double p_x, double p_y, double p_z,
                                     double d_x, double d_y, double d_z,
-                                    np.double_t[:] edge,
+                                    double *edge,
                                     double eps=1.) nogil:
      edge[0] = floor(p_x + eps) if d_x >= 0.0 else ceil(p_x - eps)
      edge[1] = floor(p_y + eps) if d_y >= 0.0 else ceil(p_y - eps)
@@ -38,69 +74,357 @@ cdef inline void c_get_closest_edge(double p_x, double p_y, double p_z,
 @cython.wraparound(False)
 @cython.cdivision(True)
 # IMPORTANT: Streamlines should be in voxel space, aligned to corner.
-def compute_tract_counts_map(streamlines, vol_dims):
+def compute_tract_counts_map(streamlines, vol_dims, nbr_threads=1,
+                             sparse=False, length_weighted=False,
+                             weights=None):
+    """
+    Count the number of streamlines going through each voxel.
+
+    :param streamlines: list of numpy.ndarray or ArraySequence, in voxel
+        space, aligned to corner.
+    :param vol_dims: shape of the volume.
+    :param nbr_threads: number of OpenMP threads, 0 to use them all. Each
+        thread has its own counts volume, summed at the end. Fewer threads are
+        used if these volumes need more than DENSE_ACCUMULATORS_MAX_BYTES.
+    :param sparse: if True, return (voxels_ids, counts) for the traversed
+        voxels only, voxels_ids being flat (C order) ids. No volume is
+        allocated, which is much lighter for small bundles in large grids.
+    :param length_weighted: if True, each streamline adds its exact length
+        inside the voxel (in voxel units) instead of 1.
+    :param weights: one weight per streamline (e.g. COMMIT or SIFT weights),
+        multiplying what each streamline adds.
+    Counts are float64 when length_weighted or weights are used.
+    """
     flags = np.seterr(divide="ignore", under="ignore")
 
     # Inspired from Dipy track_counts
     vol_dims = np.asarray(vol_dims).astype(np.int)
     n_voxels = np.prod(vol_dims)
 
-    # This array counts the number of different tracks going through each voxel.
-    # Need to keep both the array and the memview on it to be able to
-    # reshape and return in the end.
-    traversal_tags = np.zeros((n_voxels,), dtype=np.int)
-    cdef np.int_t[:] traversal_tags_v = traversal_tags
+    cdef:
+        int nb_threads = nbr_threads
+        np.npy_intp nb_blocks, nb_accumulators, block_idx, thread_idx, el_no
+        Accumulator *accumulators
+        bint is_float32
+        bint is_sparse = sparse
+        bint is_counting = not length_weighted and weights is None
+        double *weights_ptr = NULL
 
-    # This array keeps track of whether the current track has already been
-    # flagged in a specific voxel.
-    cdef np.int_t[:] touched_tags_v = np.zeros((n_voxels,), dtype=np.int)
+    if nb_threads <= 0:
+        nb_threads = openmp.omp_get_max_threads()
 
-    cdef int streamlines_len = len(streamlines)
+    if not isinstance(streamlines, ArraySequence):
+        streamlines = ArraySequence(streamlines)
 
-    if streamlines_len == 0:
+    dtype = np.int if is_counting else np.float64
+    has_touched_tags = not sparse and not length_weighted
+    if has_touched_tags and len(streamlines) >= np.iinfo(np.int32).max:
+        np.seterr(**flags)
+        raise ValueError('Too many streamlines for the dense mode, use '
+                         'sparse=True.')
+
+    if not sparse:
+        accumulator_bytes = n_voxels * np.dtype(dtype).itemsize
+        if has_touched_tags:
+            accumulator_bytes += n_voxels * np.dtype(np.int32).itemsize
+        nb_threads = max(1, min(nb_threads, DENSE_ACCUMULATORS_MAX_BYTES //
+                                accumulator_bytes))
+    if len(streamlines) == 0:
+        np.seterr(**flags)
+        if sparse:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=dtype)
+        return np.zeros(vol_dims, dtype=dtype)
+
+    points = streamlines._data
+    if points.dtype != np.float32:
+        points = points.astype(np.double)
+    is_float32 = points.dtype == np.float32
+
+    cdef:
+        float[:, :] points32 = points if is_float32 else None
+        double[:, :] points64 = None if is_float32 else points
+        np.npy_intp[:] offsets = streamlines._offsets.astype(np.intp)
+        np.npy_intp[:] lengths = streamlines._lengths.astype(np.intp)
+        double[:] weights_v
+        np.npy_intp[:] boundaries
+        np.npy_intp vd[3]
+
+    if weights is not None:
+        weights_v = np.ascontiguousarray(weights, dtype=np.double).ravel()
+        if len(weights_v) != len(streamlines):
+            np.seterr(**flags)
+            raise ValueError('There must be one weight per streamline.')
+        weights_ptr = &weights_v[0]
+
+    for el_no in range(3):
+        vd[el_no] = vol_dims[el_no]
+
+    # Blocks of about the same number of points, dispatched to the threads
+    boundaries = _get_blocks_boundaries(streamlines._lengths,
+                                        nb_threads * 8 if nb_threads > 1
+                                        else 1)
+    nb_blocks = len(boundaries) - 1
+
+    if sparse:
+        nb_accumulators = nb_blocks
+    else:
+        nb_accumulators = nb_threads
+
+    # This array counts the number of different tracks going through each
+    # voxel, one per thread, summed at the end. The touched tags keep track
+    # of whether the current track has already been flagged in a voxel.
+    cdef:
+        np.int_t[:, :] traversal_tags_v
+        double[:, :] traversal_values_v
+        np.int32_t[:, :] touched_tags_v
+    if not sparse:
+        traversal_tags = np.zeros((nb_threads, n_voxels), dtype=dtype)
+        if is_counting:
+            traversal_tags_v = traversal_tags
+        else:
+            traversal_values_v = traversal_tags
+        if has_touched_tags:
+            touched_tags_v = np.zeros((nb_threads, n_voxels), dtype=np.int32)
+
+    accumulators = <Accumulator*>malloc(nb_accumulators * sizeof(Accumulator))
+    if accumulators == NULL:
         np.seterr(**flags)
-        return traversal_tags.reshape(vol_dims)
+        raise MemoryError()
+    for block_idx in range(nb_accumulators):
+        accumulators[block_idx].counts = NULL
+        accumulators[block_idx].values = NULL
+        accumulators[block_idx].touched_tags = NULL
+        accumulators[block_idx].voxels = NULL
+        accumulators[block_idx].nb_voxels = 0
+        accumulators[block_idx].max_voxels = 0
+        accumulators[block_idx].weight = 1.
+        accumulators[block_idx].length_weighted = length_weighted
+        accumulators[block_idx].failed = False
+        if not sparse:
+            if is_counting:
+                accumulators[block_idx].counts = \
+                    &traversal_tags_v[block_idx, 0]
+            else:
+                accumulators[block_idx].values = \
+                    &traversal_values_v[block_idx, 0]
+            if has_touched_tags:
+                accumulators[block_idx].touched_tags = \
+                    &touched_tags_v[block_idx, 0]
+
+    try:
+        for block_idx in prange(nb_blocks, nogil=True, schedule='dynamic',
+                                num_threads=nb_threads):
+            if is_sparse:
+                thread_idx = block_idx
+            else:
+                thread_idx = threadid()
+
+            if is_float32:
+                _count_block(points32, offsets, lengths, weights_ptr,
+                             boundaries[block_idx], boundaries[block_idx + 1],
+                             vd, &accumulators[thread_idx])
+            else:
+                _count_block(points64, offsets, lengths, weights_ptr,
+                             boundaries[block_idx], boundaries[block_idx + 1],
+                             vd, &accumulators[thread_idx])
+
+        for block_idx in range(nb_accumulators):
+            if accumulators[block_idx].failed:
+                raise MemoryError()
+
+        if sparse:
+            voxels_ids, voxels_values = zip(
+                *[_get_voxels(&accumulators[block_idx])
+                  for block_idx in range(nb_accumulators)])
+            voxels_ids = np.concatenate(voxels_ids)
+            if is_counting:
+                voxels_ids, counts = np.unique(voxels_ids, return_counts=True)
+                result = voxels_ids, counts.astype(np.int)
+            else:
+                voxels_ids, inverse = np.unique(voxels_ids,
+                                                return_inverse=True)
+                counts = np.bincount(inverse,
+                                     weights=np.concatenate(voxels_values),
+                                     minlength=len(voxels_ids))
+                result = voxels_ids, counts
+        else:
+            if is_counting:
+                traversal_tags = _reduce_counts(traversal_tags_v, nb_threads)
+            else:
+                traversal_tags = _reduce_counts(traversal_values_v,
+                                                nb_threads)
+            result = traversal_tags.reshape(vol_dims)
+    finally:
+        for block_idx in range(nb_accumulators):
+            free(accumulators[block_idx].voxels)
+        free(accumulators)
+        np.seterr(**flags)
+
+    return result
+
+
+def _get_blocks_boundaries(streamlines_lengths, nb_blocks):
+    nb_streamlines = len(streamlines_lengths)
+    nb_blocks = max(1, min(nb_streamlines, nb_blocks))
+    cumulative_points = np.cumsum(streamlines_lengths)
+    boundaries = np.searchsorted(
+        cumulative_points,
+        np.linspace(0, cumulative_points[-1], nb_blocks + 1)[1:-1],
+        side='right')
+    return np.unique(np.concatenate(([0], boundaries,
+                                     [nb_streamlines]))).astype(np.intp)
+
 
-    # Memview to a streamline instance, which is a numpy array.
-    cdef np.double_t[:,:] t = streamlines[0].astype(np.double)
+cdef _get_voxels(Accumulator *accumulator):
+    voxels_ids = np.empty(accumulator.nb_voxels, dtype=np.intp)
+    voxels_values = np.empty(accumulator.nb_voxels, dtype=np.float64)
+    cdef np.npy_intp[:] voxels_ids_v = voxels_ids
+    cdef double[:] voxels_values_v = voxels_values
+    cdef np.npy_intp i
+    for i in range(accumulator.nb_voxels):
+        voxels_ids_v[i] = accumulator.voxels[i].voxel_id
+        voxels_values_v[i] = accumulator.voxels[i].value
+    return voxels_ids, voxels_values
 
-    # Memviews for points and direction vectors.
-    cdef np.double_t[:] in_pt = np.zeros(3, dtype=np.double)
-    cdef np.double_t[:] next_pt = np.zeros(3, dtype=np.double)
-    cdef np.double_t[:] dir_vect = np.zeros(3, dtype=np.double)
 
-    # Memview for the current edge
-    cdef np.double_t[:] cur_edge = np.zeros(3, dtype=np.double)
+ctypedef fused count_t:
+    np.int_t
+    double
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef _reduce_counts(count_t[:, :] traversal_tags_v, int nb_threads):
+    cdef:
+        np.npy_intp el_no, thread_idx
+        np.npy_intp n_voxels = traversal_tags_v.shape[1]
+
+    for el_no in prange(n_voxels, nogil=True, schedule='static',
+                        num_threads=nb_threads):
+        for thread_idx in range(1, traversal_tags_v.shape[0]):
+            traversal_tags_v[0, el_no] += traversal_tags_v[thread_idx, el_no]
 
-    # Memview for the coordinates of the current voxel
-    cdef np.int_t[:] cur_voxel_coords = np.zeros(3, dtype=np.int)
+    # Copied, so the per-thread buffer is not kept alive by the result
+    return np.array(traversal_tags_v[0])
 
-    # various temporary loop and working variables
-    #cdef:
-    #    int track_idx   # Index of the track when iterating.
-    cdef int tno, pno, cno
-    cdef np.npy_intp el_no, v
 
-    cdef int vd[3]
-    cdef double vxs[3]
-    for cno in range(3):
-        vd[cno] = vol_dims[cno]
+cdef int _compare_voxels(const void *a, const void *b) nogil:
+    cdef np.npy_intp id_a = (<VoxelValue*>a).voxel_id
+    cdef np.npy_intp id_b = (<VoxelValue*>b).voxel_id
+    return (id_a > id_b) - (id_a < id_b)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _tag_voxel(Accumulator *accumulator, np.npy_intp el_no,
+                            np.npy_intp track_idx, double length) nogil:
+    cdef:
+        VoxelValue *voxels
+        double value = accumulator.weight
+
+    if accumulator.length_weighted:
+        value = accumulator.weight * length
+
+    if accumulator.counts != NULL or accumulator.values != NULL:
+        if accumulator.length_weighted:
+            accumulator.values[el_no] += value
+        # Use + 1 since the first track would be ignored
+        elif accumulator.touched_tags[el_no] != <np.int32_t>(track_idx + 1):
+            accumulator.touched_tags[el_no] = <np.int32_t>(track_idx + 1)
+            if accumulator.counts != NULL:
+                accumulator.counts[el_no] += 1
+            else:
+                accumulator.values[el_no] += value
+        return
+
+    if accumulator.nb_voxels == accumulator.max_voxels:
+        accumulator.max_voxels = 2 * accumulator.max_voxels + 1024
+        voxels = <VoxelValue*>realloc(
+            accumulator.voxels, accumulator.max_voxels * sizeof(VoxelValue))
+        if voxels == NULL:
+            accumulator.failed = True
+            return
+        accumulator.voxels = voxels
+    accumulator.voxels[accumulator.nb_voxels].voxel_id = el_no
+    accumulator.voxels[accumulator.nb_voxels].value = value
+    accumulator.nb_voxels += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _unique_streamline_voxels(Accumulator *accumulator,
+                                    np.npy_intp start) nogil:
+    # Only keep each voxel once for the streamline ending the sparse list,
+    # summing its lengths if length weighted
+    cdef:
+        VoxelValue *voxels = accumulator.voxels + start
+        np.npy_intp nb_voxels = accumulator.nb_voxels - start
+        np.npy_intp i, nb_unique = 0
+
+    if accumulator.voxels == NULL or nb_voxels < 2:
+        return
+
+    qsort(voxels, nb_voxels, sizeof(VoxelValue), _compare_voxels)
+    for i in range(nb_voxels):
+        if i == 0 or voxels[i].voxel_id != voxels[nb_unique - 1].voxel_id:
+            voxels[nb_unique] = voxels[i]
+            nb_unique += 1
+        elif accumulator.length_weighted:
+            voxels[nb_unique - 1].value += voxels[i].value
+    accumulator.nb_voxels = start + nb_unique
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _count_block(floating[:, :] points,
+                       np.npy_intp[:] offsets,
+                       np.npy_intp[:] lengths,
+                       double *weights,
+                       np.npy_intp start,
+                       np.npy_intp end,
+                       np.npy_intp *vd,
+                       Accumulator *accumulator) nogil:
+    # Points and direction vectors.
+    cdef double in_pt[3]
+    cdef double next_pt[3]
+    cdef double dir_vect[3]
+
+    # The current edge
+    cdef double cur_edge[3]
+
+    # The coordinates of the current voxel
+    cdef np.npy_intp cur_voxel_coords[3]
+
+    cdef np.npy_intp track_idx, pno, cno, offset, el_no, first_voxel_id
+
     # x slice size (C array ordering)
     cdef np.npy_intp x_slice_size = vd[1] * vd[2]
 
-    cdef np.double_t dir_vect_norm, remaining_dist, length_ratio
+    cdef double dir_vect_norm, remaining_dist, length_ratio
 
-    for track_idx in range(streamlines_len):
-        t = streamlines[track_idx].astype(np.double)
+    for track_idx in range(start, end):
+        if lengths[track_idx] == 0:
+            continue
+
+        offset = offsets[track_idx]
+        first_voxel_id = accumulator.nb_voxels
+        if weights != NULL:
+            accumulator.weight = weights[track_idx]
+
+        # A single point streamline only tags its own voxel
+        for cno in range(3):
+            in_pt[cno] = points[offset, cno]
+            next_pt[cno] = points[offset, cno]
 
         # This loop is time-critical
         # Changed to -1 because we get the next point in the loop
-        for pno in range(t.shape[0] - 1):
+        for pno in range(offset, offset + lengths[track_idx] - 1):
             # Assign current and next point, find vector between both,
             # and use the current point as nearest edge for testing.
             for cno in range(3):
-                in_pt[cno] = t[pno, cno]
-                next_pt[cno] = t[pno + 1, cno]
+                in_pt[cno] = points[pno, cno]
+                next_pt[cno] = points[pno + 1, cno]
                 dir_vect[cno] = next_pt[cno] - in_pt[cno]
                 cur_edge[cno] = in_pt[cno]
 
@@ -111,7 +435,8 @@ def compute_tract_counts_map(streamlines, vol_dims):
             if dir_vect_norm == 0:
                 continue
 
-            # Set the "dist" var to compute remaining length of vector to process
+            # Set the "dist" var to compute remaining length of vector to
+            # process
             remaining_dist = dir_vect_norm
 
             # Check if it's already a real edge. If not, find the closest edge.
@@ -144,6 +469,19 @@ def compute_tract_counts_map(streamlines, vol_dims):
 
                 # Check if last point is already on an edge
                 if remaining_dist < 0 and not fabs(remaining_dist) < 1e-8:
+                    # The rest of the segment, before the next edge
+                    if accumulator.length_weighted:
+                        for cno in range(3):
+                            cur_voxel_coords[cno] = <int>floor(
+                                in_pt[cno] + 0.5 * (next_pt[cno] - in_pt[cno]))
+
+                        el_no = cur_voxel_coords[0] * x_slice_size + \
+                            cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
+
+                        _tag_voxel(accumulator, el_no, track_idx,
+                                   norm(next_pt[0] - in_pt[0],
+                                        next_pt[1] - in_pt[1],
+                                        next_pt[2] - in_pt[2]))
                     break
 
                 # Find the coordinates of voxel containing current point, to
@@ -156,10 +494,8 @@ def compute_tract_counts_map(streamlines, vol_dims):
                 el_no = cur_voxel_coords[0] * x_slice_size + \
                         cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
 
-                # Use + 1 since the first track would be ignored
-                if touched_tags_v[el_no] != track_idx + 1:
-                    touched_tags_v[el_no] = track_idx + 1
-                    traversal_tags_v[el_no] += 1
+                _tag_voxel(accumulator, el_no, track_idx,
+                           length_ratio * dir_vect_norm)
 
                 # NOTE: in_pt is moved to the closest edge
                 for cno in range(3):
@@ -173,7 +509,7 @@ def compute_tract_counts_map(streamlines, vol_dims):
                                    dir_vect[0], dir_vect[1], dir_vect[2],
                                    cur_edge)
 
-        # Add last point
+        # Add last point, already done with its length if length weighted
         for cno in range(3):
             cur_voxel_coords[cno] = <int>floor(in_pt[cno] +
                                                0.5 * (next_pt[cno] - in_pt[cno]))
@@ -181,10 +517,6 @@ def compute_tract_counts_map(streamlines, vol_dims):
         el_no = cur_voxel_coords[0] * x_slice_size + \
                 cur_voxel_coords[1] * vd[2] + cur_voxel_coords[2]
 
-        # Use + 1 since the first track would be ignored
-        if touched_tags_v[el_no] != track_idx + 1:
-            touched_tags_v[el_no] = track_idx + 1
-            traversal_tags_v[el_no] += 1
-
-    np.seterr(**flags)
-    return traversal_tags.reshape(vol_dims)
+        if not accumulator.length_weighted:
+            _tag_voxel(accumulator, el_no, track_idx, 0.)
+        _unique_streamline_voxels(accumulator, first_voxel_id)
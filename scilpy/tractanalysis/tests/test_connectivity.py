@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import multiprocessing
+
+from nibabel.streamlines import ArraySequence
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from scilpy.tractanalysis.connectivity import (
+    ConnectivityAccumulator, get_processing_options, iter_processed_connections, prune_segments,
+    segments_arrays_to_symmetric_con_info)
+from scilpy.tractanalysis.features import (remove_outliers,
+                                           remove_loops_and_sharp_turns)
+from scilpy.tractanalysis.quick_tools import \
+    extract_longest_segments_from_indices
+from scilpy.tractanalysis.tools import compute_streamline_segment
+from scilpy.tractanalysis.uncompress import uncompress
+
+
+def _synthetic_connectivity(nb_streamlines=90, seed=0):
+    # Three labelled regions connected by noisy lines with a few points,
+    # some of them with a detour
+    atlas = np.zeros((20, 20, 20), dtype=np.int32)
+    atlas[:5] = 1
+    atlas[15:] = 2
+    atlas[5:15, 15:] = 3
+    centers = np.array([[2.5, 10.5, 10.5], [17.5, 10.5, 10.5],
+                        [10.5, 17.5, 10.5]])
+
+    rng = np.random.RandomState(seed)
+    streamlines = []
+    for _ in range(nb_streamlines):
+        start, end = rng.choice(3, 2, replace=False)
+        line = np.linspace(centers[start], centers[end], rng.randint(2, 8))
+        line += rng.normal(scale=0.5, size=line.shape)
+        if rng.rand() < 0.2:
+            # A detour, making a loop or an outlier
+            line = np.insert(line, 1, rng.rand(3) * 20, axis=0)
+        streamlines.append(np.clip(line, 0.1, 19.9).astype(np.float32))
+    streamlines = ArraySequence(streamlines)
+
+    indices, points_to_idx = uncompress(streamlines, return_mapping=True)
+    con_info = segments_arrays_to_symmetric_con_info(
+        *extract_longest_segments_from_indices(indices, atlas))
+    return con_info, streamlines, indices, points_to_idx
+
+
+def _per_pair_loop(con_info, streamlines, indices, points_to_idx, options):
+    # Post-processing of the connections, as previously done in
+    # scil_compute_connectivity.py
+    final = {}
+    for in_label in sorted(con_info.keys()):
+        for out_label in sorted(con_info[in_label].keys()):
+            pair_info = con_info[in_label][out_label]
+            if not len(pair_info):
+                continue
+
+            final_strl = []
+            for connection in pair_info:
+                strl_idx = connection['strl_idx']
+                final_strl.append(compute_streamline_segment(
+                    streamlines[strl_idx], indices[strl_idx],
+                    connection['in_idx'], connection['out_idx'],
+                    points_to_idx[strl_idx]))
+
+            pruned_strl, _ = prune_segments(final_strl,
+                                            options['min_length'],
+                                            options['max_length'],
+                                            options['vox_size'])
+            if not len(pruned_strl):
+                continue
+
+            no_loops, _ = remove_loops_and_sharp_turns(
+                pruned_strl, options['loop_max_angle'])
+            if not len(no_loops):
+                continue
+
+            no_outliers, _ = remove_outliers(no_loops,
+                                             options['outlier_threshold'])
+            if not len(no_outliers):
+                continue
+
+            no_qb_loops_strl, _ = remove_loops_and_sharp_turns(
+                no_outliers, options['loop_max_angle'], True,
+                options['loop_qb_distance'])
+            final[(in_label, out_label)] = no_qb_loops_strl
+    return final
+
+
+def _assert_same_streamlines(streamlines, expected):
+    assert len(streamlines) == len(expected)
+    for s, expected_s in zip(streamlines, expected):
+        assert_array_equal(s, expected_s)
+
+
+def _assert_same_results(results, expected):
+    assert [r[:2] for r in results] == [r[:2] for r in expected]
+    for (_, _, steps), (_, _, expected_steps) in zip(results, expected):
+        assert sorted(steps.keys()) == sorted(expected_steps.keys())
+        for step in steps:
+            if step == 'final_strl_idx':
+                assert steps[step] == expected_steps[step]
+            else:
+                _assert_same_streamlines(steps[step], expected_steps[step])
+
+
+def test_iter_processed_connections_same_as_per_pair_loop():
+    con_info, streamlines, indices, points_to_idx = _synthetic_connectivity()
+    options = get_processing_options(min_length=11., max_length=30.,
+                                     loop_max_angle=240.,
+                                     loop_qb_distance=5.)
+
+    expected = _per_pair_loop(con_info, streamlines, indices, points_to_idx,
+                              options)
+    assert len(expected)
+
+    results = list(iter_processed_connections(
+        con_info, streamlines, indices, points_to_idx, options))
+    final = dict(((in_label, out_label), steps['final'])
+                 for in_label, out_label, steps in results
+                 if 'final' in steps)
+    assert sorted(final.keys()) == sorted(expected.keys())
+    for key in expected:
+        _assert_same_streamlines(final[key], expected[key])
+
+
+def test_iter_processed_connections_same_with_processes():
+    con_info, streamlines, indices, points_to_idx = _synthetic_connectivity()
+    options = get_processing_options(min_length=11., max_length=30.,
+                                     loop_max_angle=240.,
+                                     loop_qb_distance=5.)
+
+    expected = list(iter_processed_connections(
+        con_info, streamlines, indices, points_to_idx, options))
+
+    _assert_same_results(
+        list(iter_processed_connections(con_info, streamlines, indices,
+                                        points_to_idx, options,
+                                        nbr_processes=3)),
+        expected)
+
+    pool = multiprocessing.Pool(3)
+    try:
+        _assert_same_results(
+            list(iter_processed_connections(con_info, streamlines, indices,
+                                            points_to_idx, options,
+                                            pool=pool)),
+            expected)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def test_connectivity_accumulator_chunks():
+    _, streamlines, _, _ = _synthetic_connectivity()
+    metric = np.random.RandomState(0).rand(20, 20, 20)
+
+    expected = ConnectivityAccumulator(3, (20, 20, 20), vox_size=2.,
+                                       metrics={'metric': metric},
+                                       compute_length=True,
+                                       compute_volume=True)
+    expected.add(1, 2, list(streamlines))
+
+    accumulator = ConnectivityAccumulator(3, (20, 20, 20), vox_size=2.,
+                                          metrics={'metric': metric},
+                                          compute_length=True,
+                                          compute_volume=True)
+    for start in range(0, len(streamlines), 7):
+        accumulator.add(1, 2, list(streamlines[start:start + 7]))
+
+    voxels = np.unique(np.ravel_multi_index(
+        uncompress(streamlines)._data.T, (20, 20, 20)))
+    assert accumulator.voxels[(1, 2)] == set(voxels.tolist())
+    assert_array_equal(accumulator.get_count_matrix(),
+                       expected.get_count_matrix())
+    assert_array_equal(accumulator.get_volume_matrix(),
+                       expected.get_volume_matrix())
+    assert accumulator.get_volume_matrix()[1, 2] == len(voxels) * 8.
+    assert_allclose(accumulator.get_length_matrix(),
+                    expected.get_length_matrix())
+    assert_allclose(accumulator.get_metric_matrix('metric'),
+                    expected.get_metric_matrix('metric'))
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+from dipy.tracking.streamlinespeed import length
+from nibabel.streamlines import ArraySequence
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from scilpy.tractanalysis.streamlines_metrics import compute_tract_counts_map
+from scilpy.tractanalysis.uncompress import uncompress
+
+VOL_DIMS = (20, 20, 20)
+
+
+def _random_streamlines(seed, nb_streamlines=300):
+    rng = np.random.RandomState(seed)
+    return ArraySequence(
+        [(rng.rand(rng.randint(1, 6), 3) * VOL_DIMS[0]).astype(np.float32)
+         for _ in range(nb_streamlines)])
+
+
+def test_compute_tract_counts_map_same_as_uncompress():
+    streamlines = _random_streamlines(0)
+    expected = np.zeros(VOL_DIMS, dtype=np.int)
+    for voxels in uncompress(streamlines):
+        expected[tuple(np.unique(voxels, axis=0).T)] += 1
+
+    assert_array_equal(compute_tract_counts_map(streamlines, VOL_DIMS),
+                       expected)
+
+
+def test_compute_tract_counts_map_single_point():
+    streamlines = [np.array([[5.5, 9.5, 1.5]], np.float32)]
+    expected = np.zeros(VOL_DIMS, dtype=np.int)
+    expected[5, 9, 1] = 1
+
+    assert_array_equal(compute_tract_counts_map(streamlines, VOL_DIMS),
+                       expected)
+
+
+def test_compute_tract_counts_map_threads():
+    for seed in range(5):
+        streamlines = _random_streamlines(seed)
+        expected = compute_tract_counts_map(streamlines, VOL_DIMS)
+        for nbr_threads in [2, 4]:
+            assert_array_equal(
+                compute_tract_counts_map(streamlines, VOL_DIMS,
+                                         nbr_threads=nbr_threads),
+                expected)
+
+
+def test_compute_tract_counts_map_sparse():
+    for seed in range(5):
+        streamlines = _random_streamlines(seed)
+        expected = compute_tract_counts_map(streamlines, VOL_DIMS).ravel()
+        for nbr_threads in [1, 4]:
+            voxels_ids, counts = compute_tract_counts_map(
+                streamlines, VOL_DIMS, nbr_threads=nbr_threads, sparse=True)
+            assert_array_equal(voxels_ids, np.flatnonzero(expected))
+            assert_array_equal(counts, expected[voxels_ids])
+
+
+def test_compute_tract_counts_map_length_weighted():
+    streamlines = _random_streamlines(0)
+    for nbr_threads in [1, 4]:
+        lengths_map = compute_tract_counts_map(streamlines, VOL_DIMS,
+                                               nbr_threads=nbr_threads,
+                                               length_weighted=True)
+        assert_allclose(np.sum(lengths_map), np.sum(length(streamlines)))
+
+    # Each streamline only adds its length in the voxels it traverses
+    for streamline in streamlines[:20]:
+        lengths_map = compute_tract_counts_map([streamline], VOL_DIMS,
+                                               length_weighted=True)
+        assert_allclose(np.sum(lengths_map), length(streamline), atol=1e-5)
+        counts = compute_tract_counts_map([streamline], VOL_DIMS)
+        assert np.all(counts[lengths_map > 0] == 1)
+
+
+def test_compute_tract_counts_map_weights():
+    streamlines = _random_streamlines(0, nb_streamlines=100)
+    weights = np.random.RandomState(0).rand(len(streamlines))
+    for length_weighted in [False, True]:
+        expected = np.zeros(VOL_DIMS)
+        for streamline, weight in zip(streamlines, weights):
+            expected += weight * compute_tract_counts_map(
+                [streamline], VOL_DIMS, length_weighted=length_weighted)
+
+        for nbr_threads in [1, 4]:
+            weighted_map = compute_tract_counts_map(
+                streamlines, VOL_DIMS, nbr_threads=nbr_threads,
+                length_weighted=length_weighted, weights=weights)
+            assert_allclose(weighted_map, expected)
+
+            voxels_ids, values = compute_tract_counts_map(
+                streamlines, VOL_DIMS, nbr_threads=nbr_threads, sparse=True,
+                length_weighted=length_weighted, weights=weights)
+            assert_allclose(values, expected.ravel()[voxels_ids])
+            assert_array_equal(voxels_ids, np.flatnonzero(expected))
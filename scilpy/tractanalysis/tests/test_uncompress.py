@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+from nibabel.streamlines import ArraySequence
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from scilpy.tractanalysis.uncompress import uncompress, uncompress_parallel
+
+
+def _random_streamlines(seed, max_nb_points=4, grid_size=20):
+    # Few points per streamline (some with a single point) crossing many
+    # voxels, so the output is resized more than once.
+    rng = np.random.RandomState(seed)
+    return ArraySequence(
+        [(rng.rand(rng.randint(1, max_nb_points), 3) *
+          grid_size).astype(np.float32)
+         for _ in range(rng.randint(1, 50))])
+
+
+def _assert_same_uncompress(result, expected):
+    indices, points_to_index = result
+    expected_indices, expected_points_to_index = expected
+    assert_array_equal(indices._data, expected_indices._data)
+    assert_array_equal(indices._offsets, expected_indices._offsets)
+    assert_array_equal(indices._lengths, expected_indices._lengths)
+    assert_array_equal(points_to_index._data,
+                       expected_points_to_index._data)
+    assert_array_equal(points_to_index._offsets,
+                       expected_points_to_index._offsets)
+    assert_array_equal(points_to_index._lengths,
+                       expected_points_to_index._lengths)
+
+
+def test_single_point_streamline():
+    streamlines = ArraySequence([np.array([[5.5, 9.5, 1.5]], np.float32),
+                                 np.array([[18.5, 5.5, 5.5],
+                                           [18.5, 5.5, 7.5]], np.float32),
+                                 np.array([[2.5, 3.5, 4.5]], np.float32)])
+    indices = uncompress(streamlines)
+    assert_array_equal(indices[0], [[5, 9, 1]])
+    assert_array_equal(indices[1], [[18, 5, 5], [18, 5, 6], [18, 5, 7]])
+    assert_array_equal(indices[2], [[2, 3, 4]])
+
+    parallel_indices = uncompress_parallel(streamlines, nbr_threads=2)
+    assert_array_equal(parallel_indices._data, indices._data)
+
+
+def test_uncompress_parallel_same_as_serial():
+    for seed in range(200):
+        streamlines = _random_streamlines(seed)
+        expected = uncompress(streamlines, return_mapping=True)
+        for nbr_threads in [1, 2, 4]:
+            _assert_same_uncompress(
+                uncompress_parallel(streamlines, return_mapping=True,
+                                    nbr_threads=nbr_threads),
+                expected)
+
+
+def test_uncompress_exact_size_same_as_default():
+    for seed in range(200):
+        streamlines = _random_streamlines(seed)
+        _assert_same_uncompress(
+            uncompress(streamlines, return_mapping=True, exact_size=True),
+            uncompress(streamlines, return_mapping=True))
+
+
+def test_uncompress_flat_voxel_ids():
+    dimensions = (21, 21, 21)
+    for seed in range(200):
+        streamlines = _random_streamlines(seed)
+        expected, expected_points_to_index = uncompress(streamlines,
+                                                        return_mapping=True)
+        expected_ids = np.ravel_multi_index(expected._data.T, dimensions)
+        for exact_size in [False, True]:
+            indices, points_to_index = uncompress(
+                streamlines, return_mapping=True, exact_size=exact_size,
+                dimensions=dimensions)
+            assert indices._data.dtype == np.int32
+            assert_array_equal(indices._data, expected_ids)
+            assert_array_equal(indices._offsets, expected._offsets)
+            assert_array_equal(indices._lengths, expected._lengths)
+            assert_array_equal(points_to_index._data,
+                               expected_points_to_index._data)
@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
-from copy import deepcopy
 import logging
+from multiprocessing.pool import ThreadPool
+import os
 
 from dipy.data import get_sphere
-from dipy.reconst.shm import sf_to_sh
+import h5py
 import numpy as np
 from scipy.ndimage.filters import gaussian_filter
+from scipy.sparse import csr_matrix, issparse
 
+from scilpy.reconst.sh_projector import get_sh_projector
 import scilpy.tractanalysis.todi_util as todi_u
 
 MINIMUM_TODI_EPSILON = 1e-8
 GAUSSIAN_TRUNCATE = 2.0
+UINT16_MAX = np.iinfo(np.uint16).max
 
 
 class TrackOrientationDensityImaging(object):
@@ -37,6 +41,7 @@ class TrackOrientationDensityImaging(object):
         assert len(img_shape) == 3
 
         self.sphere = get_sphere(sphere_type)
+        self.sphere_type = sphere_type
         self.nb_sphere_vts = len(self.sphere.vertices)
 
         self.img_shape = img_shape
@@ -51,7 +56,8 @@ class TrackOrientationDensityImaging(object):
         self.mask = mask
         self.todi = todi
 
-    def compute_todi(self, streamlines, length_weights=True):
+    def compute_todi(self, streamlines, length_weights=True,
+                     chunk_size=None, sparse=False, dtype=np.float64):
         """Compute the TODI map.
 
         At each voxel an histogram distribution of
@@ -63,7 +69,22 @@ class TrackOrientationDensityImaging(object):
             List of streamlines.
         length_weights : bool, optional
             Weights TODI map of each segment's length (default True).
+        chunk_size : int, optional
+            Number of streamlines processed at once, streamlines can then be
+            a generator. Only the non-zero bins are accumulated, the memory
+            is bounded by the chunk size plus the non-zero bins
+            (default None, all at once).
+        sparse : bool, optional
+            Keep the TODI as a scipy.sparse CSR matrix (default False).
+        dtype : numpy dtype, optional
+            Type of the TODI, uint16 is only for counts (without length
+            weights) (default float64).
         """
+        if chunk_size is not None or sparse or dtype != np.float64:
+            self._compute_sparse_todi(streamlines, length_weights,
+                                      chunk_size, sparse, dtype)
+            return
+
         # Streamlines vertices in "VOXEL_SPACE" within "img_shape" range
         pts_pos, pts_dir, pts_norm = \
             todi_u.streamlines_to_pts_dir_norm(streamlines)
@@ -71,7 +92,7 @@ class TrackOrientationDensityImaging(object):
         if not length_weights:
             pts_norm = None
 
-        sph_ids = todi_u.get_dir_to_sphere_id(pts_dir, self.sphere.vertices)
+        sph_ids = todi_u.get_dir_to_sphere_id(pts_dir, self.sphere_type)
 
         # Get voxel indices for each point
         pts_unmasked_vox = todi_u.get_indices_1d(self.img_shape, pts_pos)
@@ -95,6 +116,209 @@ class TrackOrientationDensityImaging(object):
         # Bincount of sphere id for each voxel
         self.todi = todi_bin_1d.reshape(todi_bin_shape)
 
+    def _compute_sparse_todi(self, streamlines, length_weights,
+                             chunk_size, sparse, dtype):
+        dtype = np.dtype(dtype)
+        if dtype == np.uint16 and length_weights:
+            raise ValueError('uint16 TODI can only count segments, '
+                             'without length weights.')
+
+        if chunk_size is None:
+            chunks = [streamlines]
+        else:
+            chunks = todi_u.iter_streamlines_chunks(streamlines, chunk_size)
+
+        # Sparse histogram of (voxel, sphere id) keys. Chunks are summed
+        # into the compacted histogram when they outgrow it.
+        keys = np.zeros(0, dtype=np.int64)
+        bins_sum = np.zeros(0, dtype=np.float64)
+        pending_keys, pending_sums = [], []
+        nb_pending = 0
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            pts_pos, pts_dir, pts_norm = \
+                todi_u.streamlines_to_pts_dir_norm(chunk)
+            if not len(pts_pos):
+                continue
+            sph_ids = todi_u.get_dir_to_sphere_id(pts_dir, self.sphere_type)
+            pts_vox = todi_u.get_indices_1d(self.img_shape, pts_pos)
+
+            chunk_keys, chunk_sums = todi_u.sum_sparse_bins(
+                pts_vox.astype(np.int64) * self.nb_sphere_vts + sph_ids,
+                weights=pts_norm if length_weights else None)
+            pending_keys.append(chunk_keys)
+            pending_sums.append(chunk_sums)
+            nb_pending += len(chunk_keys)
+
+            if nb_pending > len(keys):
+                keys, bins_sum = todi_u.sum_sparse_bins(
+                    np.concatenate([keys] + pending_keys),
+                    weights=np.concatenate([bins_sum] + pending_sums))
+                pending_keys, pending_sums = [], []
+                nb_pending = 0
+
+        if pending_keys:
+            keys, bins_sum = todi_u.sum_sparse_bins(
+                np.concatenate([keys] + pending_keys),
+                weights=np.concatenate([bins_sum] + pending_sums))
+
+        if dtype == np.uint16 and len(bins_sum) and \
+                bins_sum.max() > UINT16_MAX:
+            raise ValueError('Too many segments in a bin for uint16 TODI.')
+
+        # Keys are sorted, so are the voxels
+        pts_vox, sph_ids = np.divmod(keys, self.nb_sphere_vts)
+        self.mask = todi_u.generate_mask_indices_1d(self.nb_voxel, pts_vox)
+        voxels, rows = np.unique(pts_vox, return_inverse=True)
+
+        self.todi = csr_matrix((bins_sum.astype(dtype), (rows, sph_ids)),
+                               shape=(len(voxels), self.nb_sphere_vts),
+                               dtype=dtype)
+        if not sparse:
+            self.todi = self.todi.toarray()
+
+    def _get_dense_todi(self):
+        if issparse(self.todi):
+            return self.todi.toarray()
+        return self.todi
+
+    def add_streamlines(self, streamlines, length_weights=True,
+                        chunk_size=None):
+        """Add streamlines to the TODI map.
+
+        Parameters
+        ----------
+        streamlines : list of numpy.ndarray
+            List of streamlines.
+        length_weights : bool, optional
+            Weights TODI map of each segment's length (default True).
+        chunk_size : int, optional
+            Number of streamlines processed at once (default None).
+        """
+        if self.todi is None:
+            self.compute_todi(streamlines, length_weights=length_weights,
+                              chunk_size=chunk_size)
+            return
+
+        other = TrackOrientationDensityImaging(self.img_shape,
+                                               self.sphere_type)
+        other.compute_todi(streamlines, length_weights=length_weights,
+                           chunk_size=chunk_size, sparse=issparse(self.todi),
+                           dtype=self.todi.dtype)
+        self.merge(other)
+
+    def merge(self, other):
+        """Sum another TODI map (e.g. computed in another process) into
+        this one. The mask becomes the union of both masks.
+
+        Parameters
+        ----------
+        other : TrackOrientationDensityImaging
+            TODI map of the same shape and sphere.
+        """
+        if tuple(other.img_shape) != tuple(self.img_shape) or \
+                other.nb_sphere_vts != self.nb_sphere_vts:
+            raise ValueError('Cannot merge TODI maps of different shapes.')
+        if other.todi is None:
+            return
+        if self.todi is None:
+            self.set_todi(other.mask.copy(), other.todi.copy())
+            return
+
+        voxels = np.flatnonzero(self.mask)
+        other_voxels = np.flatnonzero(other.mask)
+        new_voxels = np.union1d(voxels, other_voxels)
+        rows = np.searchsorted(new_voxels, voxels)
+        other_rows = np.searchsorted(new_voxels, other_voxels)
+
+        shape = (len(new_voxels), self.nb_sphere_vts)
+        dtype = np.result_type(self.todi.dtype, other.todi.dtype)
+        if issparse(self.todi) and issparse(other.todi):
+            todi = self.todi.tocoo()
+            other_todi = other.todi.tocoo()
+            new_todi = csr_matrix(
+                (np.concatenate((todi.data, other_todi.data)).astype(dtype),
+                 (np.concatenate((rows[todi.row], other_rows[other_todi.row])),
+                  np.concatenate((todi.col, other_todi.col)))),
+                shape=shape, dtype=dtype)
+        else:
+            new_todi = np.zeros(shape, dtype=dtype)
+            new_todi[rows] = self._get_dense_todi()
+            new_todi[other_rows] += other._get_dense_todi()
+
+        self.mask = todi_u.generate_mask_indices_1d(self.nb_voxel, new_voxels)
+        self.todi = new_todi
+
+    def save(self, filename):
+        """Save the masked TODI map (mask and TODI, sparse or not).
+
+        Parameters
+        ----------
+        filename : str
+            Output filename, HDF5 (.h5, .hdf5) or numpy (.npz).
+        """
+        data = {'img_shape': np.asarray(self.img_shape),
+                'sphere_type': np.asarray(self.sphere_type),
+                'voxels': np.flatnonzero(self.mask)}
+        if issparse(self.todi):
+            todi = self.todi.tocsr()
+            data.update({'todi_data': todi.data,
+                         'todi_indices': todi.indices,
+                         'todi_indptr': todi.indptr})
+        else:
+            data['todi'] = self.todi
+
+        if os.path.splitext(filename)[1] in ['.h5', '.hdf5']:
+            with h5py.File(filename, 'w') as f:
+                for key, value in data.items():
+                    if key == 'sphere_type':
+                        f.attrs[key] = self.sphere_type
+                    else:
+                        f.create_dataset(key, data=value)
+        else:
+            np.savez(filename, **data)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a masked TODI map saved with save().
+
+        Parameters
+        ----------
+        filename : str
+            HDF5 (.h5, .hdf5) or numpy (.npz) filename.
+
+        Returns
+        -------
+        todi_obj : TrackOrientationDensityImaging
+            The TODI map, sparse if it was saved sparse.
+        """
+        if os.path.splitext(filename)[1] in ['.h5', '.hdf5']:
+            with h5py.File(filename, 'r') as f:
+                data = {key: f[key][()] for key in f.keys()}
+                data['sphere_type'] = f.attrs['sphere_type']
+        else:
+            with np.load(filename) as f:
+                data = {key: f[key] for key in f.files}
+
+        sphere_type = data['sphere_type']
+        if isinstance(sphere_type, bytes):
+            sphere_type = sphere_type.decode()
+        todi_obj = cls(tuple(int(dim) for dim in data['img_shape']),
+                       str(sphere_type))
+
+        mask = todi_u.generate_mask_indices_1d(todi_obj.nb_voxel,
+                                               data['voxels'])
+        if 'todi' in data:
+            todi = data['todi']
+        else:
+            todi = csr_matrix((data['todi_data'], data['todi_indices'],
+                               data['todi_indptr']),
+                              shape=(len(data['voxels']),
+                                     todi_obj.nb_sphere_vts))
+        todi_obj.set_todi(mask, todi)
+        return todi_obj
+
     def get_todi(self):
         return self.todi
 
@@ -108,6 +332,8 @@ class TrackOrientationDensityImaging(object):
         tdi : numpy.ndarray (3D)
             Tract Density Image
         """
+        if issparse(self.todi):
+            return np.asarray(self.todi.sum(axis=-1)).ravel()
         return np.sum(self.todi, axis=-1)
 
     def get_todi_shape(self):
@@ -119,8 +345,10 @@ class TrackOrientationDensityImaging(object):
     def mask_todi(self, mask):
         """Mask the TODI map.
 
-        Mask the TODI without having to reshape the whole volume all
-        at once (big in memory).
+        Mask the TODI without having to reshape the whole volume
+        (big in memory). The given mask is mapped to the rows of the
+        masked TODI, then these rows are selected (for a dense or sparse
+        TODI), in O(number of voxels of the TODI).
 
         Parameters
         ----------
@@ -128,47 +356,89 @@ class TrackOrientationDensityImaging(object):
             Given volume mask for the TODI map.
         """
         # Compute intersection between current mask and given mask
-        new_mask = np.logical_and(self.mask, mask.flatten())
-
-        # Prepare new todi
-        nb_voxel_with_pts = np.count_nonzero(new_mask)
-        new_todi = np.zeros((nb_voxel_with_pts, self.nb_sphere_vts))
-        # Too big in memory, mask one dir each step
-        for i in range(self.nb_sphere_vts):
-            new_todi[:, i] = \
-                self.reshape_to_3d(self.todi[:, i]).flatten()[new_mask]
+        new_mask = np.logical_and(self.mask, mask.ravel())
+
+        # Rows of the current TODI that are kept
+        self.todi = self.todi[new_mask[self.mask]]
         self.mask = new_mask
-        self.todi = new_todi
 
-    def smooth_todi_dir(self, order=2):
+    def smooth_todi_dir(self, order=2, psf_threshold=None,
+                        nb_neighbors=None, chunk_size=10000):
         """Smooth orientations on the sphere.
 
         Smooth the orientations / distribution on the sphere.
         Important for priors construction of BST.
 
+        The TODI is smoothed in place, by chunks of voxels. With
+        psf_threshold or nb_neighbors, the point spread function (PSF) is
+        truncated and kept as a sparse matrix. The dropped weights are
+        then all below the largest dropped one, so each smoothed value
+        (before the per-voxel renormalization) is underestimated by at most
+        that weight times the TDI of the voxel.
+
         Parameters
         ----------
         order : int, optional
             Exponent blurring factor, based on the dot product
             (default 2).
+        psf_threshold : float, optional
+            Drop the PSF weights below this value (default None).
+        nb_neighbors : int, optional
+            Only keep the PSF weights of the nb_neighbors closest
+            directions of each direction (default None).
+        chunk_size : int, optional
+            Number of voxels smoothed at once (default 10000).
         """
         assert order >= 1
-        todi_sum = np.sum(self.todi, axis=-1, keepdims=True)
-        sphere_dot = np.dot(self.sphere.vertices, self.sphere.vertices.T)
-        sphere_psf = np.abs(sphere_dot) ** order
-        self.todi = np.dot(self.todi, sphere_psf)
-        self.todi *= todi_sum / np.sum(self.todi, axis=-1, keepdims=True)
+        sphere_psf = todi_u.psf_from_sphere(self.sphere.vertices) ** order
+        if psf_threshold is not None or nb_neighbors is not None:
+            sphere_psf = todi_u.truncate_psf(sphere_psf, psf_threshold,
+                                             nb_neighbors)
+
+        if np.issubdtype(self.todi.dtype, np.floating):
+            if issparse(self.todi):
+                new_todi = np.zeros(self.todi.shape, dtype=self.todi.dtype)
+            else:
+                new_todi = self.todi
+        else:
+            # Integer counts (e.g. from np.bincount) are smoothed to floats
+            new_todi = np.zeros(self.todi.shape, dtype=np.float32
+                                if self.todi.dtype == np.uint16
+                                else np.float64)
+
+        for start in range(0, self.todi.shape[0], chunk_size):
+            todi = self.todi[start:start + chunk_size]
+            if issparse(todi):
+                todi = todi.toarray()
+
+            todi_sum = np.sum(todi, axis=-1, keepdims=True)
+            if issparse(sphere_psf):
+                todi = sphere_psf.T.dot(todi.T).T
+            else:
+                todi = np.dot(todi, sphere_psf)
+            todi *= todi_sum / np.sum(todi, axis=-1, keepdims=True)
+            new_todi[start:start + chunk_size] = todi
 
-    def smooth_todi_spatial(self, sigma=0.5):
+        self.todi = new_todi
+
+    def smooth_todi_spatial(self, sigma=0.5, batch_size=32, nbr_threads=1):
         """Spatial Smoothing of the TODI map.
 
         Blur the TODI map using neighborhood information.
         Important for priors construction of BST.
 
+        Batches of directions are filtered as a single 4D volume, restricted
+        to the bounding box of the mask (with a margin of twice the kernel
+        radius, so the result is the same as filtering the whole volume).
+
         Parameters
         ----------
         sigma : float, optional
             Gaussian blurring factor (default 0.5).
+        batch_size : int, optional
+            Number of directions filtered at once (default 32).
+        nbr_threads : int, optional
+            Number of batches filtered in parallel (default 1).
         """
         # This operation changes the mask as well as the TODI
         mask_3d = self.reshape_to_3d(self.mask).astype(np.float)
@@ -176,31 +446,48 @@ class TrackOrientationDensityImaging(object):
             mask_3d, sigma, truncate=GAUSSIAN_TRUNCATE).flatten()
         new_mask = mask_3d > MINIMUM_TODI_EPSILON
 
-        # Memory friendly version
-        chunk_size = 50
-        chunk_count = (self.nb_sphere_vts // chunk_size) + 1
-        nb_voxel_with_pts = np.count_nonzero(new_mask)
-        new_todi = np.array([])
-        tmp_todi = np.zeros((nb_voxel_with_pts, chunk_size))
-        # To save on hstack, one chunk at the time
-        while chunk_count > 0:
-            # Smooth one direction at a time, too big in memory otherwise
-            for i in range(chunk_size):
-                if i > self.todi.shape[1]-1:
-                    tmp_todi = np.delete(
-                        tmp_todi, range(i, chunk_size), axis=1)
-                    break
-                current_vol = self.reshape_to_3d(self.todi[:, i])
-                tmp_todi[:, i] = gaussian_filter(
-                    current_vol, sigma,
-                    truncate=GAUSSIAN_TRUNCATE).flatten()[new_mask]
-            # The first hstack cannot be with an empty array
-            if new_todi.size == 0:
-                new_todi = deepcopy(tmp_todi)
-            else:
-                new_todi = np.hstack((new_todi, tmp_todi))
-            self.todi = np.delete(self.todi, range(0, chunk_size), axis=1)
-            chunk_count -= 1
+        # Same radius as scipy's gaussian kernel
+        radius = int(GAUSSIAN_TRUNCATE * sigma + 0.5)
+        old_mask_3d = self.reshape_to_3d(self.mask)
+        box = todi_u.get_mask_bounding_box(old_mask_3d, margin=2 * radius)
+        box_shape = old_mask_3d[box].shape
+        mask_box = old_mask_3d[box].flatten()
+        new_mask_box = new_mask.reshape(self.img_shape)[box].flatten()
+
+        if issparse(self.todi):
+            # Columns are read one batch at a time
+            todi = self.todi.tocsc()
+        else:
+            todi = self.todi
+        dtype = np.float64 if todi.dtype == np.float64 else np.float32
+        new_todi = np.zeros((np.count_nonzero(new_mask), self.nb_sphere_vts),
+                            dtype=dtype)
+
+        def smooth_batch(start):
+            end = min(start + batch_size, self.nb_sphere_vts)
+            batch = todi[:, start:end]
+            if issparse(batch):
+                batch = batch.toarray()
+
+            batch_vol = np.zeros((len(mask_box), end - start), dtype=dtype)
+            batch_vol[mask_box] = batch
+            batch_vol = gaussian_filter(
+                batch_vol.reshape(box_shape + (end - start,)),
+                (sigma, sigma, sigma, 0), truncate=GAUSSIAN_TRUNCATE)
+            new_todi[:, start:end] = \
+                batch_vol.reshape((-1, end - start))[new_mask_box]
+
+        batches_start = range(0, self.nb_sphere_vts, batch_size)
+        if nbr_threads > 1:
+            pool = ThreadPool(nbr_threads)
+            try:
+                pool.map(smooth_batch, batches_start)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for start in batches_start:
+                smooth_batch(start)
 
         self.mask = new_mask
         self.todi = new_todi
@@ -220,14 +507,18 @@ class TrackOrientationDensityImaging(object):
         todi : numpy.ndarray
             Normalized TODI map.
         """
-        self.todi = todi_u.p_normalize_vectors(self.todi, p_norm)
+        self.todi = todi_u.p_normalize_vectors(self._get_dense_todi(),
+                                               p_norm)
         return self.todi
 
-    def get_sh(self, sh_basis, sh_order, smooth=0.006):
+    def get_sh(self, sh_basis, sh_order, smooth=0.006, chunk_size=10000,
+               out=None):
         """Spherical Harmonics (SH) coefficients of the TODI map
 
         Compute the SH representation of the TODI map,
         converting SF to SH with a smoothing factor.
+        The projection is done by chunks of voxels (a sparse TODI is only
+        densified one chunk at a time).
 
         Parameters
         ----------
@@ -242,11 +533,16 @@ class TrackOrientationDensityImaging(object):
         smooth : float, optional
             Smoothing factor for the conversion,
             Lambda-regularization in the SH fit (default 0.006).
+        chunk_size : int, optional
+            Number of voxels projected at once (default 10000).
+        out : numpy.ndarray, optional
+            Output (X, Y, Z, nb_coeffs) array or memmap, filled in the mask
+            instead of returning the masked representation.
 
         Returns
         -------
         todi_sh : ndarray
-            SH representation of the TODI map
+            SH representation of the TODI map (float32), out if it was given.
 
         References
         ----------
@@ -258,8 +554,13 @@ class TrackOrientationDensityImaging(object):
                diffusion MRI: Non-negativity constrained super-resolved
                spherical deconvolution. NeuroImage. 2007;35(4):1459-1472.
         """
-        return sf_to_sh(self.todi, self.sphere, sh_order=sh_order,
-                        basis_type=sh_basis, smooth=smooth)
+        sh_projector = get_sh_projector(self.sphere_type, sh_order, sh_basis,
+                                        smooth=smooth)
+        if out is None:
+            return sh_projector.sf_to_sh(self.todi, chunk_size=chunk_size)
+        return sh_projector.sf_to_sh(self.todi, chunk_size=chunk_size,
+                                     out=out,
+                                     mask=self.reshape_to_3d(self.get_mask()))
 
     def reshape_to_3d(self, img_voxelly_masked):
         """Reshape a complex ravelled image to 3D.
@@ -278,6 +579,9 @@ class TrackOrientationDensityImaging(object):
         unraveled_img : numpy.ndarray (3D, or 4D)
             Unravel volume in x, y, z (, c).
         """
+        if issparse(img_voxelly_masked):
+            img_voxelly_masked = img_voxelly_masked.toarray()
+
         dtype = img_voxelly_masked.dtype
         if img_voxelly_masked.ndim == 1:
             if len(img_voxelly_masked) == self.nb_voxel:
@@ -300,7 +604,8 @@ class TrackOrientationDensityImaging(object):
         return img_voxelly_masked
 
     def compute_distance_to_peak(self, peak_img, normalize_count=True,
-                                 deg=True, with_avg_dir=True):
+                                 deg=True, with_avg_dir=True,
+                                 chunk_size=10000):
         """Compute distance to peak map.
 
         Compute the distance of the TODI map to peaks at each position,
@@ -317,6 +622,8 @@ class TrackOrientationDensityImaging(object):
         with_avg_dir : bool, optional
             Average all orientation of each voxel of the TODI map
             into a single direction, warning for crossing (default True).
+        chunk_size : int, optional
+            Number of voxels processed at once (default 10000).
 
         Returns
         -------
@@ -330,17 +637,21 @@ class TrackOrientationDensityImaging(object):
         peak_img = peak_img[self.mask]
 
         if with_avg_dir:
-            avg_dir = self.compute_average_dir()
+            avg_dir = self.compute_average_dir(chunk_size=chunk_size)
             error_map = np.arccos(
                 np.clip(np.abs(np.sum(avg_dir * peak_img, axis=1)), 0.0, 1.0))
         else:
+            # Antipodal directions have the same angle to a peak
+            half_vertices = self.sphere.vertices[:self.nb_sphere_vts // 2]
             error_map = np.zeros((len(peak_img)), dtype=np.float)
-            for i in range(self.nb_sphere_vts):
-                count_i = self.todi[:, i]
-                error_i = np.dot(peak_img, self.sphere.vertices[i])
-                mask = np.isfinite(error_i)
-                arccos_i = np.arccos(np.clip(np.abs(error_i[mask]), 0.0, 1.0))
-                error_map[mask] += count_i[mask] * arccos_i
+            for start in range(0, len(peak_img), chunk_size):
+                peaks = peak_img[start:start + chunk_size]
+                valid = np.all(np.isfinite(peaks), axis=1)
+                angles = np.arccos(np.clip(
+                    np.abs(np.dot(peaks[valid], half_vertices.T)), 0.0, 1.0))
+                counts = self._get_half_sphere_counts(start, len(peaks))
+                error_map[start:start + len(peaks)][valid] = \
+                    np.sum(counts[valid] * angles, axis=1)
 
             if normalize_count:
                 tdi = self.get_tdi().astype(np.float)
@@ -353,28 +664,41 @@ class TrackOrientationDensityImaging(object):
 
         return error_map
 
-    def compute_average_dir(self):
+    def compute_average_dir(self, chunk_size=10000):
         """Voxel-wise average of TODI orientations.
 
         Average all orientation of each voxel, of the TODI map,
         into a single direction, warning for crossing.
 
+        Parameters
+        ----------
+        chunk_size : int, optional
+            Number of voxels processed at once (default 10000).
+
         Returns
         -------
         avg_dir : numpy.ndarray (4D)
             Volume containing a single 3-vector (peak) per voxel.
         """
-        avg_dir = np.zeros((len(self.todi), 3), dtype=np.float)
-
-        sym_dir_index = self.nb_sphere_vts // 2
-        for i in range(sym_dir_index):
-            current_dir = self.sphere.vertices[i]
-            count_dir = (self.todi[:, i] + self.todi[:, i + sym_dir_index])
-            avg_dir += np.outer(count_dir, current_dir)
+        half_vertices = self.sphere.vertices[:self.nb_sphere_vts // 2]
+        nb_voxels = self.todi.shape[0]
+        avg_dir = np.zeros((nb_voxels, 3), dtype=np.float)
+        for start in range(0, nb_voxels, chunk_size):
+            counts = self._get_half_sphere_counts(start, chunk_size)
+            avg_dir[start:start + chunk_size] = np.dot(counts, half_vertices)
 
         avg_dir = todi_u.normalize_vectors(avg_dir)
         return avg_dir
 
+    def _get_half_sphere_counts(self, start, chunk_size):
+        # Dipy spheres store the antipodal of vertex i at i + nb_vertices / 2
+        todi = self.todi[start:start + chunk_size]
+        if issparse(todi):
+            todi = todi.toarray()
+        sym_dir_index = self.nb_sphere_vts // 2
+        return (todi[:, :sym_dir_index] +
+                todi[:, sym_dir_index:2 * sym_dir_index])
+
     def __enter__(self):
         # Necessary for a 'with' statement to scrap a todi_object after
         # the scope of operation in the script scil_priors_from_streamlines.py
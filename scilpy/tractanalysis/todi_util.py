@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+from itertools import islice
+
 import numpy as np
 from numpy.linalg import norm
-from scipy.spatial.ckdtree import cKDTree
+from scipy.sparse import csr_matrix
+
+from scilpy.utils.sphere_binner import get_sphere_binner
 
 
 def streamlines_to_segments(streamlines):
@@ -27,6 +31,52 @@ def streamlines_to_segments(streamlines):
     return segments
 
 
+def iter_streamlines_chunks(streamlines, chunk_size):
+    """Split streamlines into chunks of at most chunk_size streamlines.
+
+    Parameters
+    ----------
+    streamlines : iterable of numpy.ndarray
+        List, ArraySequence or generator of streamlines.
+    chunk_size : int
+        Maximum number of streamlines per chunk.
+
+    Returns
+    -------
+    chunks : generator of list of numpy.ndarray
+        Chunks of streamlines.
+    """
+    iterator = iter(streamlines)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def sum_sparse_bins(keys, weights=None):
+    """Sum the weights of identical keys (a sparse bincount).
+
+    Parameters
+    ----------
+    keys : numpy.ndarray (1D)
+        Bin of each value.
+    weights : numpy.ndarray (1D), optional
+        Value added to the bin, 1 if None.
+
+    Returns
+    -------
+    unique_keys : numpy.ndarray (1D)
+        Sorted bins with at least one value.
+    bins_sum : numpy.ndarray (1D)
+        Sum of the weights of each bin.
+    """
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    bins_sum = np.bincount(inverse, weights=weights,
+                           minlength=len(unique_keys))
+    return unique_keys, bins_sum.astype(np.float64)
+
+
 def streamlines_to_endpoints(streamlines):
     """Equivalent to streamlines resampling to 2 points (first and last).
 
@@ -93,6 +143,35 @@ def psf_from_sphere(sphere_vertices):
     return np.abs(np.dot(sphere_vertices, sphere_vertices.T))
 
 
+def truncate_psf(psf, threshold=None, nb_neighbors=None):
+    """Sparse point spread function, without its smallest weights.
+
+    Parameters
+    ----------
+    psf : numpy.ndarray (2D)
+        Dense PSF, the row of each sphere direction.
+    threshold : float, optional
+        Drop the weights below this value.
+    nb_neighbors : int, optional
+        Only keep the nb_neighbors largest weights of each row.
+
+    Returns
+    -------
+    sparse_psf : scipy.sparse.csr_matrix
+        Truncated PSF.
+    """
+    keep = np.ones(psf.shape, dtype=bool)
+    if threshold is not None:
+        keep &= psf >= threshold
+    if nb_neighbors is not None and nb_neighbors < psf.shape[1]:
+        neighbors = np.argpartition(-psf, nb_neighbors - 1,
+                                    axis=1)[:, :nb_neighbors]
+        neighbors_mask = np.zeros(psf.shape, dtype=bool)
+        neighbors_mask[np.arange(len(psf))[:, None], neighbors] = True
+        keep &= neighbors_mask
+    return csr_matrix(np.where(keep, psf, 0.))
+
+
 # Mask functions
 def generate_mask_indices_1d(nb_voxel, indices_1d):
     mask_1d = np.zeros(nb_voxel, dtype=np.bool)
@@ -100,29 +179,50 @@ def generate_mask_indices_1d(nb_voxel, indices_1d):
     return mask_1d
 
 
+def get_mask_bounding_box(mask_3d, margin=0):
+    """Bounding box of the non-zero voxels of a mask.
+
+    Parameters
+    ----------
+    mask_3d : numpy.ndarray (3D)
+        Volume mask.
+    margin : int, optional
+        Number of voxels added on each side, within the volume (default 0).
+
+    Returns
+    -------
+    bounding_box : tuple of slice
+        Slices of the bounding box, to index the volume.
+    """
+    nonzero = np.nonzero(mask_3d)
+    if not len(nonzero[0]):
+        return tuple(slice(0, 0) for _ in mask_3d.shape)
+    return tuple(slice(max(0, np.min(ind) - margin),
+                       min(dim, np.max(ind) + margin + 1))
+                 for ind, dim in zip(nonzero, mask_3d.shape))
+
+
 def get_indices_1d(volume_shape, pts):
     return np.ravel_multi_index(pts.T.astype(np.int), volume_shape)
 
 
 def get_dir_to_sphere_id(vectors, sphere_vertices):
-    """Find the closest vector on the sphere vertices using a cKDT tree
+    """Find the closest vector on the sphere vertices using a SphereBinner
         sphere_vertices must be normed (or all with equal norm).
 
     Parameters
     ----------
     vectors : numpy.ndarray (2D)
         Vectors representing the direction (x,y,z) of segments.
-    sphere_vertices : numpy.ndarray (2D)
-        Vertices of a Dipy sphere object.
+    sphere_vertices : numpy.ndarray (2D) or str
+        Vertices of a Dipy sphere object, or its name.
 
     Returns
     -------
     dir_sphere_id : numpy.ndarray (1D)
         Sphere indices of the closest sphere direction for each vector
     """
-    sphere_kdtree = cKDTree(sphere_vertices)
-    _, dir_sphere_id = sphere_kdtree.query(vectors, k=1, n_jobs=-1)
-    return dir_sphere_id
+    return get_sphere_binner(sphere_vertices).get_ids(vectors)
 
 
 # Generic Functions (vector norm)
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import division
-from builtins import range
+from builtins import range, zip
 
 import numpy as np
 
-from scilpy.tractanalysis.quick_tools import (get_next_real_point,
-                                              get_previous_real_point)
+from scilpy.tractanalysis.quick_tools import (
+    extract_longest_segments_from_indices,
+    get_next_real_point,
+    get_previous_real_point)
 
 
 def get_streamline_pt_index(points_to_index, vox_index, from_start=True):
@@ -164,3 +166,35 @@ def compute_connectivity(indices, atlas_data,
                  'out_idx': si['end_index']})
 
     return connectivity
+
+
+def segments_arrays_to_connectivity(real_labels, strl_idx, start_label,
+                                    end_label, in_idx, out_idx):
+    """
+    Convert the flat arrays of extract_longest_segments_from_indices to the
+    dictionary returned by compute_connectivity.
+    """
+    connectivity = {k: {lab: [] for lab in real_labels} for k in real_labels}
+
+    for si in zip(strl_idx.tolist(), start_label.tolist(),
+                  end_label.tolist(), in_idx.tolist(), out_idx.tolist()):
+        connectivity[si[1]][si[2]].append({'strl_idx': si[0],
+                                           'in_idx': si[3],
+                                           'out_idx': si[4]})
+
+    return connectivity
+
+
+def compute_connectivity_from_indices(indices, atlas_data):
+    """
+    Equivalent to compute_connectivity with
+    extract_longest_segments_from_profile, but the labelling of all
+    streamlines is done in compiled code.
+
+    :param indices: ArraySequence of voxel indices, as returned by uncompress
+    :param atlas_data: numpy.ndarray (3D) of integer labels
+    """
+    atlas_data = atlas_data.astype(np.int32)
+    segments = extract_longest_segments_from_indices(indices, atlas_data)
+
+    return segments_arrays_to_connectivity(np.unique(atlas_data), *segments)
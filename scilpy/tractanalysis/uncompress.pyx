@@ -4,12 +4,25 @@
 
 from libc.math cimport ceil, fabs, floor, sqrt
 from libc.math cimport fmin as cfmin
+from libc.stdlib cimport free, malloc, realloc
+from libc.string cimport memcpy
 
 import cython
+from cython.parallel cimport prange
+cimport openmp
 import nibabel as nib
 import numpy as np
 cimport numpy as cnp
 
+cdef enum OutputMode:
+    # uint16 (x, y, z) triplets
+    TRIPLETS_OUTPUT
+    # int32 flat voxel ids, C order
+    FLAT_OUTPUT
+    # Nothing is written except the lengths and offsets
+    COUNT_OUTPUT
+
+
 cdef struct Pointers:
     # Incremented when we complete a streamline. Saved at the start of each
     # streamline because we need to start anew if we resize data_out
@@ -30,11 +43,18 @@ cdef struct Pointers:
     cnp.npy_intp *pti_offsets_out
     cnp.uint64_t *points_to_index_out
 
+    # const, what is written and, for flat ids, the grid dimensions
+    OutputMode output_mode
+    cnp.int32_t *flat_out
+    cnp.npy_intp dim_y
+    cnp.npy_intp dim_z
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-def uncompress(streamlines, return_mapping=False):
+def uncompress(streamlines, return_mapping=False, exact_size=False,
+               dimensions=None):
     """
     Get the indices of the voxels traversed by each streamline; then returns
     an ArraySequence of indices. Yes, of *indices*. ArraySequence.data is
@@ -44,24 +64,49 @@ def uncompress(streamlines, return_mapping=False):
 
     :param streamlines: nibabel.streamlines.array_sequence.ArraySequence
         should be in voxel space, aligned to corner.
+    :param exact_size: first count the voxels traversed by each streamline,
+        then allocate the output once and fill it. No resize (and copy) of
+        the output, at the cost of traversing the streamlines twice.
+    :param dimensions: shape of the grid. If given, ArraySequence.data is of
+        type int32 and contains the flat voxel ids (C order, same as
+        np.ravel_multi_index) instead of uint16 triplets.
     """
     cdef:
         cnp.npy_intp nb_streamlines = len(streamlines._lengths)
+        cnp.npy_intp nb_points_in = len(streamlines._data)
         cnp.npy_intp at_point = 0
+        cnp.npy_intp no_limit = np.iinfo(np.intp).max
+        cnp.npy_intp nb_points_to_index
+        OutputMode output_mode = TRIPLETS_OUTPUT
+        cnp.npy_intp width = 3
 
         # Multiplying by 6 is simply a heuristic to avoiding resizing too many
         # times. In my bundles tests, I had either 0 or 1 resize.
-        cnp.npy_intp max_points = (streamlines.data.size / 3) * 6
+        cnp.npy_intp max_points = nb_points_in * 6
+
+    if dimensions is not None:
+        dimensions = tuple(int(dim) for dim in dimensions)
+        if len(dimensions) != 3:
+            raise ValueError('Flat voxel ids need 3D dimensions.')
+        if np.prod(dimensions, dtype=np.int64) > np.iinfo(np.int32).max:
+            raise ValueError('Too many voxels for int32 flat voxel ids.')
+        output_mode = FLAT_OUTPUT
+        width = 1
 
     new_array_sequence = nib.streamlines.array_sequence.ArraySequence()
-    new_array_sequence._lengths.resize(nb_streamlines)
-    new_array_sequence._offsets.resize(nb_streamlines)
-    new_array_sequence._data = np.empty(max_points * 3, np.uint16)
+    new_array_sequence._lengths = np.zeros(nb_streamlines, dtype=np.intp)
+    new_array_sequence._offsets = np.zeros(nb_streamlines, dtype=np.intp)
 
     points_to_index = nib.streamlines.array_sequence.ArraySequence()
-    points_to_index._lengths.resize(nb_streamlines)
-    points_to_index._offsets.resize(nb_streamlines)
-    points_to_index._data = np.zeros(int(streamlines.data.size / 3), np.uint64)
+    points_to_index._lengths = np.zeros(nb_streamlines, dtype=np.intp)
+    points_to_index._offsets = np.zeros(nb_streamlines, dtype=np.intp)
+
+    if nb_streamlines == 0:
+        new_array_sequence._data = _new_output(0, output_mode)
+        points_to_index._data = np.zeros(0, np.uint64)
+        if not return_mapping:
+            return new_array_sequence
+        return (new_array_sequence, points_to_index)
 
     cdef:
         cnp.npy_intp[:] lengths_view_in = streamlines._lengths
@@ -69,41 +114,260 @@ def uncompress(streamlines, return_mapping=False):
         float[:, :] data_view_in = streamlines._data
         cnp.npy_intp[:] lengths_view_out = new_array_sequence._lengths
         cnp.npy_intp[:] offsets_view_out = new_array_sequence._offsets
-        cnp.uint16_t[:] data_view_out = new_array_sequence._data
         cnp.npy_intp[:] pti_lengths_view_out = points_to_index._lengths
         cnp.npy_intp[:] pti_offsets_view_out = points_to_index._offsets
-        cnp.uint64_t[:] points_to_index_view_out = points_to_index._data
-
-    cdef Pointers pointers
-    pointers.lengths_in = &lengths_view_in[0]
-    pointers.lengths_in_end = pointers.lengths_in + nb_streamlines
-    pointers.offsets_in = &offsets_view_in[0]
-    pointers.data_in = &data_view_in[0, 0]
-    pointers.lengths_out = &lengths_view_out[0]
-    pointers.offsets_out = &offsets_view_out[0]
-    pointers.data_out = &data_view_out[0]
-    pointers.pti_lengths_out = &pti_lengths_view_out[0]
-    pointers.pti_offsets_out = &pti_offsets_view_out[0]
-    pointers.points_to_index_out = &points_to_index_view_out[0]
+        cnp.uint64_t[:] points_to_index_view_out
+        Pointers pointers
+
+    pointers.lengths_in_end = &lengths_view_in[0] + nb_streamlines
+    pointers.flat_out = NULL
+    pointers.data_out = NULL
+    pointers.points_to_index_out = NULL
+    if dimensions is not None:
+        pointers.dim_y = dimensions[1]
+        pointers.dim_z = dimensions[2]
+
+    if exact_size:
+        # Counting pass, only the lengths and offsets are written
+        pointers.output_mode = COUNT_OUTPUT
+        _rewind_pointers(&pointers, lengths_view_in, offsets_view_in,
+                         data_view_in, lengths_view_out, offsets_view_out,
+                         pti_lengths_view_out, pti_offsets_view_out)
+        _uncompress(&pointers, 0, no_limit)
+
+        max_points = offsets_view_out[nb_streamlines - 1] + \
+            lengths_view_out[nb_streamlines - 1]
+        nb_points_to_index = pti_offsets_view_out[nb_streamlines - 1] + \
+            pti_lengths_view_out[nb_streamlines - 1]
+        new_array_sequence._data = _new_output(max_points, output_mode)
+        points_to_index._data = np.zeros(nb_points_to_index, np.uint64)
+
+        # Filling pass, the output can't be full
+        pointers.output_mode = output_mode
+        _rewind_pointers(&pointers, lengths_view_in, offsets_view_in,
+                         data_view_in, lengths_view_out, offsets_view_out,
+                         pti_lengths_view_out, pti_offsets_view_out)
+        _point_to_output(&pointers, new_array_sequence._data, 0)
+        points_to_index_view_out = points_to_index._data
+        pointers.points_to_index_out = &points_to_index_view_out[0]
+        at_point = _uncompress(&pointers, 0, max_points + 1)
+    else:
+        new_array_sequence._data = _new_output(max_points, output_mode)
+        # At most one per point, plus the last point of each streamline
+        points_to_index._data = np.zeros(nb_points_in + nb_streamlines,
+                                         np.uint64)
+        points_to_index_view_out = points_to_index._data
+
+        pointers.output_mode = output_mode
+        _rewind_pointers(&pointers, lengths_view_in, offsets_view_in,
+                         data_view_in, lengths_view_out, offsets_view_out,
+                         pti_lengths_view_out, pti_offsets_view_out)
+        _point_to_output(&pointers, new_array_sequence._data, 0)
+        pointers.points_to_index_out = &points_to_index_view_out[0]
+
+        while 1:
+            at_point = _uncompress(&pointers, at_point, max_points - 1)
+            if pointers.lengths_in == pointers.lengths_in_end:
+                # Job finished, we can return the streamlines
+                break
+
+            # Resize and point the memoryview and pointer on the right data
+            max_points += max_points / 3  # Make it one third bigger
+            new_array_sequence._data.resize(max_points * width,
+                                            refcheck=False)
+            _point_to_output(&pointers, new_array_sequence._data, at_point)
+
+            # Restart the unfinished streamline
+            if at_point == 0:
+                pointers.points_to_index_out = &points_to_index_view_out[0]
+            else:
+                pointers.points_to_index_out = \
+                    &points_to_index_view_out[0] + \
+                    pointers.pti_offsets_out[-1] + pointers.pti_lengths_out[-1]
 
-    while 1:
-        at_point = _uncompress(&pointers, at_point, max_points - 1)
-        if pointers.lengths_in == pointers.lengths_in_end:
-            # Job finished, we can return the streamlines
-            break
+        nb_points_to_index = pti_offsets_view_out[nb_streamlines - 1] + \
+            pti_lengths_view_out[nb_streamlines - 1]
+        points_to_index._data.resize(nb_points_to_index, refcheck=False)
+        new_array_sequence._data.resize(at_point * width, refcheck=False)
 
-        # Resize and point the memoryview and pointer on the right data
-        max_points += max_points / 3  # Make it one third bigger
-        new_array_sequence._data.resize(max_points * 3, refcheck=False)
-        data_view_out = new_array_sequence._data
-        pointers.data_out = &data_view_out[0] + at_point * 3
+    if output_mode == TRIPLETS_OUTPUT:
+        new_array_sequence._data.shape = (at_point, 3)
 
-        if at_point == 0:
-            pointers.points_to_index_out = &points_to_index_view_out[0]
-        else:
-            pointers.points_to_index_out = &points_to_index_view_out[0] + pointers.offsets_in[0]
+    if not return_mapping:
+        return new_array_sequence
+    else:
+        return (new_array_sequence, points_to_index)
+
+
+def _new_output(nb_points, output_mode):
+    if output_mode == FLAT_OUTPUT:
+        return np.empty(nb_points, np.int32)
+    return np.empty(nb_points * 3, np.uint16)
+
+
+cdef void _rewind_pointers(Pointers *pointers,
+                           cnp.npy_intp[:] lengths_in,
+                           cnp.npy_intp[:] offsets_in,
+                           float[:, :] data_in,
+                           cnp.npy_intp[:] lengths_out,
+                           cnp.npy_intp[:] offsets_out,
+                           cnp.npy_intp[:] pti_lengths_out,
+                           cnp.npy_intp[:] pti_offsets_out):
+    pointers.lengths_in = &lengths_in[0]
+    pointers.offsets_in = &offsets_in[0]
+    pointers.data_in = &data_in[0, 0]
+    pointers.lengths_out = &lengths_out[0]
+    pointers.offsets_out = &offsets_out[0]
+    pointers.pti_lengths_out = &pti_lengths_out[0]
+    pointers.pti_offsets_out = &pti_offsets_out[0]
+
+
+cdef void _point_to_output(Pointers *pointers, cnp.ndarray data,
+                           cnp.npy_intp at_point):
+    cdef:
+        cnp.uint16_t[:] triplets_view
+        cnp.int32_t[:] flat_view
+
+    if len(data) == 0:
+        return
+    if pointers.output_mode == FLAT_OUTPUT:
+        flat_view = data
+        pointers.flat_out = &flat_view[0] + at_point
+    else:
+        triplets_view = data
+        pointers.data_out = &triplets_view[0] + at_point * 3
+
+
+cdef struct Block:
+    # Streamlines [start, end) are uncompressed in this block
+    cnp.npy_intp start
+    cnp.npy_intp end
+
+    # Block-local buffers, concatenated once all blocks are done
+    cnp.uint16_t *data_out
+    cnp.uint64_t *points_to_index_out
+    cnp.npy_intp nb_points_out
+    cnp.npy_intp nb_points_to_index_out
+
+    # Where the block is copied in the final arrays
+    cnp.npy_intp points_base
+    cnp.npy_intp points_to_index_base
+
+    bint failed
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def uncompress_parallel(streamlines, return_mapping=False, nbr_threads=0,
+                        nbr_blocks_per_thread=8):
+    """
+    Same output as uncompress, but streamlines are split in blocks of
+    (about) the same number of points, uncompressed in parallel without the
+    GIL into block-local buffers and then concatenated.
+
+    :param streamlines: nibabel.streamlines.array_sequence.ArraySequence
+        should be in voxel space, aligned to corner.
+    :param nbr_threads: number of OpenMP threads, 0 to use them all.
+    :param nbr_blocks_per_thread: more blocks than threads balances the
+        work when some blocks are slower.
+    """
+    cdef:
+        cnp.npy_intp nb_streamlines = len(streamlines._lengths)
+        cnp.npy_intp nb_blocks, block_idx, i
+        int num_threads = nbr_threads
+        Block *blocks
+        bint failed = False
 
-    new_array_sequence._data.resize((at_point, 3), refcheck=False)
+    if num_threads <= 0:
+        num_threads = openmp.omp_get_max_threads()
+
+    new_array_sequence = nib.streamlines.array_sequence.ArraySequence()
+    new_array_sequence._lengths = np.zeros(nb_streamlines, dtype=np.intp)
+    new_array_sequence._offsets = np.zeros(nb_streamlines, dtype=np.intp)
+
+    points_to_index = nib.streamlines.array_sequence.ArraySequence()
+    points_to_index._lengths = np.zeros(nb_streamlines, dtype=np.intp)
+    points_to_index._offsets = np.zeros(nb_streamlines, dtype=np.intp)
+
+    if nb_streamlines == 0:
+        new_array_sequence._data = np.zeros((0, 3), np.uint16)
+        points_to_index._data = np.zeros(0, np.uint64)
+        if not return_mapping:
+            return new_array_sequence
+        return (new_array_sequence, points_to_index)
+
+    # Blocks boundaries, so that each block has about the same number of
+    # input points.
+    nb_blocks = min(nb_streamlines, num_threads * nbr_blocks_per_thread)
+    cumulative_points = np.cumsum(streamlines._lengths)
+    boundaries = np.searchsorted(
+        cumulative_points,
+        np.linspace(0, cumulative_points[nb_streamlines - 1],
+                    nb_blocks + 1)[1:nb_blocks],
+        side='right')
+    boundaries = np.unique(np.concatenate(([0], boundaries,
+                                           [nb_streamlines])))
+    nb_blocks = len(boundaries) - 1
+
+    cdef:
+        cnp.npy_intp[:] boundaries_view = boundaries.astype(np.intp)
+        cnp.npy_intp[:] lengths_view_in = streamlines._lengths
+        cnp.npy_intp[:] offsets_view_in = streamlines._offsets
+        float[:, :] data_view_in = streamlines._data
+        cnp.npy_intp[:] lengths_view_out = new_array_sequence._lengths
+        cnp.npy_intp[:] offsets_view_out = new_array_sequence._offsets
+        cnp.npy_intp[:] pti_lengths_view_out = points_to_index._lengths
+        cnp.npy_intp[:] pti_offsets_view_out = points_to_index._offsets
+
+    blocks = <Block*>malloc(nb_blocks * sizeof(Block))
+    if blocks == NULL:
+        raise MemoryError()
+
+    for block_idx in range(nb_blocks):
+        blocks[block_idx].start = boundaries_view[block_idx]
+        blocks[block_idx].end = boundaries_view[block_idx + 1]
+        blocks[block_idx].data_out = NULL
+        blocks[block_idx].points_to_index_out = NULL
+        blocks[block_idx].failed = False
+
+    try:
+        for block_idx in prange(nb_blocks, nogil=True, schedule='dynamic',
+                                num_threads=num_threads):
+            _uncompress_block(&blocks[block_idx],
+                              &lengths_view_in[0], &offsets_view_in[0],
+                              &data_view_in[0, 0],
+                              &lengths_view_out[0], &offsets_view_out[0],
+                              &pti_lengths_view_out[0],
+                              &pti_offsets_view_out[0])
+
+        # Exact bookkeeping of where each block goes in the final arrays
+        nb_points_out = 0
+        nb_points_to_index_out = 0
+        for block_idx in range(nb_blocks):
+            failed = failed or blocks[block_idx].failed
+            blocks[block_idx].points_base = nb_points_out
+            blocks[block_idx].points_to_index_base = nb_points_to_index_out
+            nb_points_out += blocks[block_idx].nb_points_out
+            nb_points_to_index_out += blocks[block_idx].nb_points_to_index_out
+
+        if failed:
+            raise MemoryError()
+
+        new_array_sequence._data = np.empty((nb_points_out, 3), np.uint16)
+        points_to_index._data = np.empty(nb_points_to_index_out, np.uint64)
+
+        if nb_points_out > 0:
+            _concatenate_blocks(blocks, nb_blocks,
+                                new_array_sequence._data,
+                                points_to_index._data,
+                                offsets_view_out, pti_offsets_view_out,
+                                num_threads)
+    finally:
+        for block_idx in range(nb_blocks):
+            free(blocks[block_idx].data_out)
+            free(blocks[block_idx].points_to_index_out)
+        free(blocks)
 
     if not return_mapping:
         return new_array_sequence
@@ -111,6 +375,128 @@ def uncompress(streamlines, return_mapping=False):
         return (new_array_sequence, points_to_index)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _concatenate_blocks(Block *blocks, cnp.npy_intp nb_blocks,
+                              cnp.uint16_t[:, :] data_out,
+                              cnp.uint64_t[:] points_to_index_out,
+                              cnp.npy_intp[:] offsets_out,
+                              cnp.npy_intp[:] pti_offsets_out,
+                              int num_threads):
+    cdef:
+        cnp.npy_intp block_idx, i
+        cnp.uint16_t *data_ptr = &data_out[0, 0]
+        cnp.uint64_t *pti_ptr = &points_to_index_out[0]
+
+    for block_idx in prange(nb_blocks, nogil=True, schedule='static',
+                            num_threads=num_threads):
+        memcpy(data_ptr + blocks[block_idx].points_base * 3,
+               blocks[block_idx].data_out,
+               blocks[block_idx].nb_points_out * 3 * sizeof(cnp.uint16_t))
+        memcpy(pti_ptr + blocks[block_idx].points_to_index_base,
+               blocks[block_idx].points_to_index_out,
+               blocks[block_idx].nb_points_to_index_out *
+               sizeof(cnp.uint64_t))
+
+        # Offsets were computed relative to the start of the block
+        for i in range(blocks[block_idx].start, blocks[block_idx].end):
+            offsets_out[i] += blocks[block_idx].points_base
+            pti_offsets_out[i] += blocks[block_idx].points_to_index_base
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _uncompress_block(Block *block,
+                            cnp.npy_intp *lengths_in,
+                            cnp.npy_intp *offsets_in,
+                            float *data_in,
+                            cnp.npy_intp *lengths_out,
+                            cnp.npy_intp *offsets_out,
+                            cnp.npy_intp *pti_lengths_out,
+                            cnp.npy_intp *pti_offsets_out) nogil:
+    cdef:
+        cnp.npy_intp nb_points_in = 0
+        cnp.npy_intp max_points, at_point = 0
+        cnp.npy_intp nb_done, pti_position, i
+        cnp.uint16_t *new_data_out
+        Pointers pointers
+
+    for i in range(block.start, block.end):
+        nb_points_in += lengths_in[i]
+
+    # Same heuristic as uncompress. There is at most one points_to_index per
+    # input point, plus the last point of each streamline.
+    max_points = nb_points_in * 6 + 1
+    block.data_out = <cnp.uint16_t*>malloc(
+        max_points * 3 * sizeof(cnp.uint16_t))
+    block.points_to_index_out = <cnp.uint64_t*>malloc(
+        (nb_points_in + block.end - block.start) * sizeof(cnp.uint64_t))
+    if block.data_out == NULL or block.points_to_index_out == NULL:
+        block.failed = True
+        return
+
+    pointers.lengths_in = lengths_in + block.start
+    pointers.lengths_in_end = lengths_in + block.end
+    pointers.offsets_in = offsets_in + block.start
+    pointers.data_in = data_in + offsets_in[block.start] * 3
+    pointers.lengths_out = lengths_out + block.start
+    pointers.offsets_out = offsets_out + block.start
+    pointers.data_out = block.data_out
+    pointers.pti_lengths_out = pti_lengths_out + block.start
+    pointers.pti_offsets_out = pti_offsets_out + block.start
+    pointers.points_to_index_out = block.points_to_index_out
+    pointers.output_mode = TRIPLETS_OUTPUT
+
+    while 1:
+        at_point = _uncompress(&pointers, at_point, max_points - 1)
+        if pointers.lengths_in == pointers.lengths_in_end:
+            break
+
+        # Resize, then restart the unfinished streamline
+        max_points += max_points / 3
+        new_data_out = <cnp.uint16_t*>realloc(
+            block.data_out, max_points * 3 * sizeof(cnp.uint16_t))
+        if new_data_out == NULL:
+            block.failed = True
+            return
+        block.data_out = new_data_out
+        pointers.data_out = block.data_out + at_point * 3
+
+        nb_done = pointers.lengths_in - (lengths_in + block.start)
+        if nb_done == 0:
+            pti_position = 0
+        else:
+            pti_position = pti_offsets_out[block.start + nb_done - 1] + \
+                pti_lengths_out[block.start + nb_done - 1]
+        pointers.points_to_index_out = \
+            block.points_to_index_out + pti_position
+
+    block.nb_points_out = at_point
+    block.nb_points_to_index_out = pti_offsets_out[block.end - 1] + \
+        pti_lengths_out[block.end - 1]
+
+
+cdef inline void _write_voxel(Pointers *pointers, cnp.npy_intp x,
+                             cnp.npy_intp y, cnp.npy_intp z) nogil:
+    if pointers.output_mode == TRIPLETS_OUTPUT:
+        pointers.data_out[0] = <cnp.uint16_t>x
+        pointers.data_out[1] = <cnp.uint16_t>y
+        pointers.data_out[2] = <cnp.uint16_t>z
+        pointers.data_out += 3
+    elif pointers.output_mode == FLAT_OUTPUT:
+        pointers.flat_out[0] = <cnp.int32_t>(
+            (x * pointers.dim_y + y) * pointers.dim_z + z)
+        pointers.flat_out += 1
+
+
+cdef inline void _write_point_to_index(Pointers *pointers,
+                                       cnp.npy_intp index) nogil:
+    if pointers.output_mode != COUNT_OUTPUT:
+        pointers.points_to_index_out[0] = index
+        pointers.points_to_index_out += 1
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 cdef inline double norm(double x, double y, double z) nogil:
@@ -151,8 +537,8 @@ cdef cnp.npy_intp _uncompress(
 
         double direction_norm, remaining_distance
         double length_ratio, move_ratio
-        cnp.uint16_t x = 0, y = 0, z = 0
-        cnp.uint16_t last_x, last_y, last_z
+        cnp.npy_intp x = 0, y = 0, z = 0
+        cnp.npy_intp last_x, last_y, last_z
 
     # For each streamline
     while pointers.lengths_in != pointers.lengths_in_end:
@@ -175,24 +561,26 @@ cdef cnp.npy_intp _uncompress(
             prev_index = pointers.offsets_out[-1] + pointers.lengths_out[-1]
 
         # Check the very first point
-        x = <cnp.uint16_t>(pointers.data_in[0])
-        y = <cnp.uint16_t>(pointers.data_in[1])
-        z = <cnp.uint16_t>(pointers.data_in[2])
-        pointers.data_out[0] = x
-        pointers.data_out[1] = y
-        pointers.data_out[2] = z
-        pointers.points_to_index_out[0] = 0
-        pointers.points_to_index_out += 1
-        pointers.data_out += 3
+        x = <cnp.npy_intp>(pointers.data_in[0])
+        y = <cnp.npy_intp>(pointers.data_in[1])
+        z = <cnp.npy_intp>(pointers.data_in[2])
+        _write_voxel(pointers, x, y, z)
+        _write_point_to_index(pointers, 0)
         nb_points_out += 1
         nb_points_out_pti += 1
         at_point += 1
 
         # Make sure we don't already hit the max.
-        if at_point == max_points:
+        if at_point >= max_points:
             pointers.data_in = backup_data_in
             return backup_at_point
 
+        # A single point streamline has no next point, its last point is the
+        # first one.
+        next_pt[0] = pointers.data_in[0]
+        next_pt[1] = pointers.data_in[1]
+        next_pt[2] = pointers.data_in[2]
+
         for point_idx in range(nb_points_in - 1):
             # Only checking the first element since all three should either be
             # set to -1 when no jittering has taken place, or be > 0 if
@@ -279,8 +667,7 @@ cdef cnp.npy_intp _uncompress(
                 remaining_distance -= length_ratio * direction_norm
 
                 if remaining_distance < 0.:
-                    pointers.points_to_index_out[0] = nb_points_out - 1
-                    pointers.points_to_index_out += 1
+                    _write_point_to_index(pointers, nb_points_out - 1)
                     nb_points_out_pti += 1
                     break
 
@@ -291,19 +678,16 @@ cdef cnp.npy_intp _uncompress(
                 current_pt[1] = current_pt[1] + move_ratio * direction[1]
                 current_pt[2] = current_pt[2] + move_ratio * direction[2]
 
-                x = <cnp.uint16_t>(current_pt[0])
-                y = <cnp.uint16_t>(current_pt[1])
-                z = <cnp.uint16_t>(current_pt[2])
-                pointers.data_out[0] = x
-                pointers.data_out[1] = y
-                pointers.data_out[2] = z
-                pointers.data_out += 3
+                x = <cnp.npy_intp>(current_pt[0])
+                y = <cnp.npy_intp>(current_pt[1])
+                z = <cnp.npy_intp>(current_pt[2])
+                _write_voxel(pointers, x, y, z)
                 nb_points_out += 1
 
                 # Are we full yet? We return 1 before the max because we would
                 # still need to add the last point.
                 at_point += 1
-                if at_point == max_points:
+                if at_point >= max_points:
                     pointers.data_in = backup_data_in
                     return backup_at_point
 
@@ -311,23 +695,21 @@ cdef cnp.npy_intp _uncompress(
         pointers.data_in += 3
 
         # Check last point
-        last_x = <cnp.uint16_t>next_pt[0]
-        last_y = <cnp.uint16_t>next_pt[1]
-        last_z = <cnp.uint16_t>next_pt[2]
+        last_x = <cnp.npy_intp>next_pt[0]
+        last_y = <cnp.npy_intp>next_pt[1]
+        last_z = <cnp.npy_intp>next_pt[2]
         if x != last_x or y != last_y or z != last_z:
-            with gil:
-                print('Got inside last')
-
-            pointers.data_out[0] = last_x
-            pointers.data_out[1] = last_y
-            pointers.data_out[2] = last_z
-            pointers.data_out += 3
-            pointers.points_to_index_out[0] = nb_points_out
-            pointers.points_to_index_out += 1
+            _write_voxel(pointers, last_x, last_y, last_z)
+            _write_point_to_index(pointers, nb_points_out)
             nb_points_out += 1
             nb_points_out_pti += 1
             at_point += 1
 
+            # The next streamline must not start past the max
+            if at_point >= max_points:
+                pointers.data_in = backup_data_in
+                return backup_at_point
+
         # Streamline finished, advance
         pointers.lengths_out[0] = nb_points_out
         pointers.pti_lengths_out[0] = nb_points_out_pti
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+from __future__ import division
+
+import hashlib
+
+from dipy.data import get_sphere
+import numpy as np
+
+# Binners are cached per sphere name (or vertices), since building the lookup
+# table is much slower than a query.
+_SPHERE_BINNERS = {}
+
+
+def get_sphere_binner(sphere):
+    """Get the (cached) SphereBinner of a sphere.
+
+    Parameters
+    ----------
+    sphere : str or numpy.ndarray (2D)
+        Name of a Dipy sphere, or vertices of a sphere.
+
+    Returns
+    -------
+    sphere_binner : SphereBinner
+        Binner of the sphere, built on the first call.
+    """
+    if isinstance(sphere, str):
+        key = sphere
+    else:
+        sphere = np.ascontiguousarray(sphere, dtype=np.float64)
+        key = hashlib.sha1(sphere.tobytes()).hexdigest()
+
+    if key not in _SPHERE_BINNERS:
+        if isinstance(sphere, str):
+            vertices = get_sphere(sphere).vertices
+        else:
+            vertices = sphere
+        _SPHERE_BINNERS[key] = SphereBinner(vertices)
+    return _SPHERE_BINNERS[key]
+
+
+class SphereBinner(object):
+    def __init__(self, vertices, grid_size=32):
+        """Lookup table of the closest sphere vertex of any direction.
+
+        Directions are mapped to a cell of a cube map (grid_size x grid_size
+        cells on each of the 6 faces). Each cell keeps every vertex that can
+        be the closest one to a direction of the cell, the closest vertex is
+        then found among these few candidates. The result is the same as a
+        nearest neighbor search on all vertices.
+
+        Parameters
+        ----------
+        vertices : numpy.ndarray (2D)
+            Vertices of the sphere, all with the same norm.
+        grid_size : int, optional
+            Number of cells along each side of a face (default 32).
+        """
+        self.vertices = np.asarray(vertices, dtype=np.float64)
+        self.grid_size = grid_size
+        vertices_dir = self.vertices / \
+            np.linalg.norm(self.vertices, axis=-1, keepdims=True)
+
+        # Cells centers and corners, on each face
+        step = 2.0 / grid_size
+        cell_pos = -1.0 + step * (np.arange(grid_size) + 0.5)
+        a, b = np.meshgrid(cell_pos, cell_pos, indexing='ij')
+        a, b = a.ravel(), b.ravel()
+        centers = np.concatenate([self._face_to_directions(face, a, b)
+                                  for face in range(6)])
+        corners_angle = np.zeros(len(centers))
+        for da in (-0.5 * step, 0.5 * step):
+            for db in (-0.5 * step, 0.5 * step):
+                corners = np.concatenate(
+                    [self._face_to_directions(face, a + da, b + db)
+                     for face in range(6)])
+                corners_angle = np.maximum(
+                    corners_angle,
+                    np.arccos(np.clip(np.sum(centers * corners, axis=1),
+                                      -1.0, 1.0)))
+
+        # For a direction in the cell, its closest vertex is at most
+        # (closest to center + 2 * cell radius) from the cell center.
+        dots = np.dot(centers, vertices_dir.T)
+        closest_angle = np.arccos(np.clip(np.max(dots, axis=1), -1.0, 1.0))
+        max_angle = np.minimum(closest_angle + 2 * corners_angle + 1e-6,
+                               np.pi)
+        is_candidate = dots >= np.cos(max_angle)[:, None]
+
+        # Candidates of each cell, padded with the closest one to the center
+        nb_candidates = np.count_nonzero(is_candidate, axis=1)
+        self.candidates = np.repeat(np.argmax(dots, axis=1)[:, None],
+                                    np.max(nb_candidates), axis=1)
+        cells, vertices_ids = np.nonzero(is_candidate)
+        first = np.concatenate(([0], np.cumsum(nb_candidates)[:-1]))
+        self.candidates[cells, np.arange(len(cells)) - first[cells]] = \
+            vertices_ids
+
+    @staticmethod
+    def _face_to_directions(face, a, b):
+        axis, sign = divmod(face, 2)
+        directions = np.zeros((len(a), 3))
+        directions[:, axis] = -1.0 if sign else 1.0
+        directions[:, (axis + 1) % 3] = a
+        directions[:, (axis + 2) % 3] = b
+        return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
+    def _get_cells(self, vectors):
+        axis = np.argmax(np.abs(vectors), axis=1)
+        rows = np.arange(len(vectors))
+        major = vectors[rows, axis]
+        face = 2 * axis + (major < 0)
+
+        abs_major = np.abs(major)
+        a = vectors[rows, (axis + 1) % 3] / abs_major
+        b = vectors[rows, (axis + 2) % 3] / abs_major
+        i = np.clip(((a + 1.0) * 0.5 * self.grid_size).astype(np.intp),
+                    0, self.grid_size - 1)
+        j = np.clip(((b + 1.0) * 0.5 * self.grid_size).astype(np.intp),
+                    0, self.grid_size - 1)
+        return (face * self.grid_size + i) * self.grid_size + j
+
+    def get_ids(self, vectors, chunk_size=100000):
+        """Find the closest sphere vertex of each vector.
+
+        Parameters
+        ----------
+        vectors : numpy.ndarray (2D)
+            Vectors (x,y,z), they do not need to be normalized.
+        chunk_size : int, optional
+            Number of vectors processed at once (default 100000).
+
+        Returns
+        -------
+        sphere_ids : numpy.ndarray (1D)
+            Index of the closest vertex of each vector.
+        """
+        vectors = np.asarray(vectors, dtype=np.float64).reshape((-1, 3))
+        sphere_ids = np.zeros(len(vectors), dtype=np.intp)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, len(vectors), chunk_size):
+                chunk = vectors[start:start + chunk_size]
+                candidates = self.candidates[self._get_cells(chunk)]
+                dots = np.einsum('ijk,ik->ij', self.vertices[candidates],
+                                 chunk)
+                sphere_ids[start:start + chunk_size] = candidates[
+                    np.arange(len(chunk)), np.argmax(dots, axis=1)]
+
+        return sphere_ids
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Compile the models directories of RecobundlesX in a single atlas file.
+    Each model is resampled and clustered (QBx) in model space at all the
+    model clustering thresholds of the config file, only once.
+
+    The atlas replaces the models directories of
+    scil_recognize_multi_bundles.py, which then only loads and transforms the
+    centroids it needs instead of loading and clustering every model for
+    each execution. Use the same config file and number of points.
+"""
+
+import argparse
+import json
+import logging
+import os
+
+from scilpy.io.utils import (add_overwrite_arg, assert_inputs_exist,
+                             assert_outputs_exist)
+from scilpy.segment.model_atlas import ATLAS_EXTENSIONS, compile_model_atlas
+
+
+def _build_args_parser():
+    p = argparse.ArgumentParser(
+        formatter_class=argparse.RawTextHelpFormatter,
+        description=__doc__)
+
+    p.add_argument('config_file',
+                   help='Path of the config file (json)')
+    p.add_argument('models_directories', nargs='+',
+                   help='Path for the directories containing model.')
+    p.add_argument('out_atlas',
+                   help='Output atlas filename (hdf5).')
+
+    p.add_argument('--nb_points', type=int, default=20,
+                   help='Number of points used for all resampling of '
+                   'streamlines [%(default)s].')
+    p.add_argument('--seed', type=int, default=0,
+                   help='Random number generator seed of the model '
+                   'clustering [%(default)s].')
+    p.add_argument('--log_level', default='INFO',
+                   choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                   help='Log level of the logging class')
+
+    add_overwrite_arg(p)
+
+    return p
+
+
+def main():
+    parser = _build_args_parser()
+    args = parser.parse_args()
+
+    assert_inputs_exist(parser, [args.config_file])
+    assert_outputs_exist(parser, args, [args.out_atlas])
+
+    for directory in args.models_directories:
+        if not os.path.isdir(directory):
+            parser.error('Input folder {0} does not exist'.format(directory))
+
+    if not args.out_atlas.endswith(ATLAS_EXTENSIONS):
+        parser.error('Output atlas must be a {0} file.'.format(
+            ' or '.join(ATLAS_EXTENSIONS)))
+
+    if args.nb_points < 2:
+        parser.error('Number of points cannot be < 2.')
+
+    logging.basicConfig(level=args.log_level)
+
+    with open(args.config_file) as json_data:
+        config = json.load(json_data)
+
+    compile_model_atlas(args.out_atlas, config, args.models_directories,
+                        nb_points=args.nb_points, seed=args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -16,31 +16,48 @@ NOTE: this script can take a while to run. Please be patient.
                - 4 minutes without post-processing, only saving final bundles.
                - 29 minutes with full post-processing, only saving final bundles.
                - 30 minutes with full post-processing, saving all possible files.
+      Use --processes to post-process the connections in parallel.
 """
 
 from __future__ import division
 
-from builtins import zip
 import argparse
 import logging
+import multiprocessing
 import os
 import time
 
-from dipy.tracking.streamlinespeed import length
 import nibabel as nb
 import numpy as np
 
-from scilpy.io.streamlines import (load_trk_in_voxel_space,
-                                   save_from_voxel_space)
+from scilpy.io.streamlines import (ConnectionsHdf5Writer,
+                                   ichunk_trk_in_voxel_space,
+                                   load_trk_in_voxel_space,
+                                   VoxelSpaceStreamlinesWriter)
 from scilpy.io.utils import (add_overwrite_arg,
                              assert_inputs_exist,
                              assert_output_dirs_exist_and_empty)
-from scilpy.tractanalysis.features import (remove_outliers,
-                                           remove_loops_and_sharp_turns)
-from scilpy.tractanalysis.tools import (compute_connectivity,
-                                        compute_streamline_segment,
-                                        extract_longest_segments_from_profile)
-from scilpy.tractanalysis.uncompress import uncompress
+from scilpy.tractanalysis.connectivity import (
+    PROCESSING_STEPS,
+    ConnectivityAccumulator,
+    StreamlinesSpill,
+    compute_streaming_connectivity,
+    get_processing_options,
+    iter_processed_connections)
+from scilpy.tractanalysis.tools import compute_connectivity_from_indices
+from scilpy.tractanalysis.uncompress import uncompress, uncompress_parallel
+from scilpy.utils.filenames import split_name_with_nii
+
+# Saving option controlling each post-processing step output.
+_STEPS_SAVE_TYPE = {'raw': 'raw',
+                    'removed_length': 'discarded',
+                    'pruned': 'intermediate',
+                    'loops': 'discarded',
+                    'no_loops': 'intermediate',
+                    'outliers': 'discarded',
+                    'no_outliers': 'intermediate',
+                    'qb_loops': 'discarded',
+                    'final': 'final'}
 
 
 def _get_output_paths(root_dir):
@@ -52,7 +69,8 @@ def _get_output_paths(root_dir):
              'qb_loops': os.path.join(root_dir, 'qb_loops/'),
              'pruned': os.path.join(root_dir, 'pruned/'),
              'no_loops': os.path.join(root_dir, 'no_loops/'),
-             'no_outliers': os.path.join(root_dir, 'no_outliers/')}
+             'no_outliers': os.path.join(root_dir, 'no_outliers/'),
+             'hdf5': os.path.join(root_dir, 'final_connections.h5')}
 
     return paths
 
@@ -61,13 +79,15 @@ def _get_saving_options(args):
     saving_options = {'raw': args.save_raw_connections,
                       'intermediate': args.save_intermediate,
                       'discarded': args.save_discarded,
-                      'final': True}
+                      'final': not args.hdf5}
 
     return saving_options
 
 
 def _create_required_output_dirs(out_paths, args):
-    os.mkdir(out_paths['final'])
+    if not args.hdf5 and \
+            (not args.chunk_size or args.spill_final_connections):
+        os.mkdir(out_paths['final'])
 
     if args.save_raw_connections:
         os.mkdir(out_paths['raw'])
@@ -84,13 +104,12 @@ def _create_required_output_dirs(out_paths, args):
         os.mkdir(out_paths['no_outliers'])
 
 
-def _save_if_needed(streamlines, args, saving_options, out_paths,
+def _save_if_needed(streamlines, writer, saving_options, out_paths,
                     save_type, step_type, in_label, out_label):
     if saving_options[save_type] and len(streamlines):
-        save_from_voxel_space(streamlines, args.labels, args.tracks,
-                              os.path.join(out_paths[step_type],
-                                           '{}_{}.trk'.format(in_label,
-                                                              out_label)))
+        writer.save(streamlines,
+                    os.path.join(out_paths[step_type],
+                                 '{}_{}.trk'.format(in_label, out_label)))
 
 
 def _symmetrize_con_info(con_info):
@@ -114,17 +133,119 @@ def _symmetrize_con_info(con_info):
     return final_con_info
 
 
-def _prune_segments(segments, min_length, max_length, vox_size):
-    lengths = list(length(segments) * vox_size)
-    valid = []
-    invalid = []
+def _get_metrics_names(metrics_filenames):
+    return [os.path.basename(split_name_with_nii(filename)[0])
+            for filename in metrics_filenames]
 
-    for s, l in zip(segments, lengths):
-        if min_length <= l <= max_length:
-            valid.append(s)
-        else:
-            invalid.append(s)
-    return valid, invalid
+
+def _save_matrices(accumulator, args):
+    # Remove first line and column, since they are index 0 and
+    # would represent a connection to non-label voxels. Only used when
+    # post-processing to avoid unnecessary -1 on labels for each access.
+    np.save(os.path.join(args.output, 'final_matrix.npy'),
+            accumulator.get_count_matrix()[1:, 1:])
+
+    if args.save_length_matrix:
+        np.save(os.path.join(args.output, 'length_matrix.npy'),
+                accumulator.get_length_matrix()[1:, 1:])
+
+    if args.save_volume_matrix:
+        np.save(os.path.join(args.output, 'volume_matrix.npy'),
+                accumulator.get_volume_matrix()[1:, 1:])
+
+    for name in _get_metrics_names(args.metrics or []):
+        np.save(os.path.join(args.output, '{}_matrix.npy'.format(name)),
+                accumulator.get_metric_matrix(name)[1:, 1:])
+
+
+def _compute_streaming_matrices(args, processing_opts, labels_data,
+                                accumulator, out_paths, pool=None):
+    chunks = ichunk_trk_in_voxel_space(args.tracks, args.labels,
+                                       chunk_size=args.chunk_size)
+
+    spill = None
+    if args.hdf5:
+        # Connections are directly appended to the HDF5 file.
+        with ConnectionsHdf5Writer(out_paths['hdf5'], args.labels,
+                                   args.tracks) as hdf5_writer:
+            compute_streaming_connectivity(chunks, labels_data, accumulator,
+                                           processing_opts,
+                                           connections_writer=hdf5_writer,
+                                           nbr_processes=args.processes,
+                                           pool=pool)
+        return
+    elif args.spill_final_connections:
+        spill_dir = os.path.join(args.output, 'spill/')
+        os.mkdir(spill_dir)
+        spill = StreamlinesSpill(spill_dir)
+
+    compute_streaming_connectivity(chunks, labels_data, accumulator,
+                                   processing_opts, connections_writer=spill,
+                                   nbr_processes=args.processes, pool=pool)
+
+    if spill is not None:
+        # Connections are loaded back one at a time, only the few waiting to
+        # be written by the writer thread are in memory.
+        with VoxelSpaceStreamlinesWriter(args.labels, args.tracks) as writer:
+            for in_label, out_label in sorted(spill.pairs):
+                writer.save(spill.load(in_label, out_label),
+                            os.path.join(out_paths['final'],
+                                         '{}_{}.trk'.format(in_label,
+                                                            out_label)))
+                spill.remove(in_label, out_label)
+        os.rmdir(spill_dir)
+
+
+def _process_and_save_connections(args, con_info, streamlines, indices,
+                                  points_to_idx, processing_opts,
+                                  saving_opts, accumulator, out_paths,
+                                  pool=None):
+    hdf5_writer = None
+    if args.hdf5:
+        hdf5_writer = ConnectionsHdf5Writer(out_paths['hdf5'], args.labels,
+                                            args.tracks)
+
+    try:
+        # The reference header and labels are read once, files are then
+        # written by a background thread.
+        with VoxelSpaceStreamlinesWriter(args.labels, args.tracks) as writer:
+            for in_label, out_label, results in iter_processed_connections(
+                    con_info, streamlines, indices, points_to_idx,
+                    processing_opts, pool=pool):
+                for step_type in PROCESSING_STEPS:
+                    if step_type in results:
+                        _save_if_needed(results[step_type], writer,
+                                        saving_opts, out_paths,
+                                        _STEPS_SAVE_TYPE[step_type],
+                                        step_type, in_label, out_label)
+
+                if 'final' in results:
+                    accumulator.add(in_label, out_label, results['final'])
+                    if hdf5_writer is not None:
+                        hdf5_writer.append(in_label, out_label,
+                                           results['final'],
+                                           results['final_strl_idx'])
+    finally:
+        if hdf5_writer is not None:
+            hdf5_writer.close()
+
+
+def _run_with_pool(nbr_processes, func, *args):
+    # The pool is created before any HDF5 file is opened, so the workers
+    # don't inherit its handle. It serves all the connections (and chunks).
+    if nbr_processes == 1:
+        return func(*args, pool=None)
+
+    pool = multiprocessing.Pool(nbr_processes)
+    try:
+        result = func(*args, pool=pool)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return result
 
 
 def build_args_parser():
@@ -190,6 +311,45 @@ def build_args_parser():
                    help='If set, will save discarded streamlines in '
                         'subdirectories.\nIncludes loops, outliers and '
                         'qb_loops')
+    s.add_argument('--hdf5', action='store_true',
+                   help='If set, save the final connections in a single '
+                        'HDF5 file (final_connections.h5)\ninstead of one '
+                        'file per connection in final_connections/.\n'
+                        'It holds the segments of all connections once and, '
+                        'for each connection,\nthe offsets and lengths of '
+                        'its segments and their source streamline indices.')
+
+    w = p.add_argument_group('Weighted matrices options')
+    w.add_argument('--metrics', nargs='+',
+                   help='Metric maps (nifti). For each, save the mean value '
+                        'along the segments of each\nconnection in '
+                        '<metric>_matrix.npy. Each voxel is weighted by the '
+                        'number\nof times it is traversed.')
+    w.add_argument('--save_length_matrix', action='store_true',
+                   help='Save the mean segment length (mm) of each '
+                        'connection in length_matrix.npy.')
+    w.add_argument('--save_volume_matrix', action='store_true',
+                   help='Save the volume (mm^3) of the voxels traversed by '
+                        'each connection\nin volume_matrix.npy.')
+
+    st = p.add_argument_group('Streaming options')
+    st.add_argument('--chunk_size', type=int,
+                    help='If set, the tractogram is read and labelled '
+                         'chunk_size streamlines at a time,\nonly the '
+                         'connectivity matrix is kept in memory.\n'
+                         'Outliers and QuickBundles loops removal need '
+                         'whole connections,\n--no_remove_outliers and '
+                         '--no_remove_loops_again are required.')
+    st.add_argument('--spill_final_connections', action='store_true',
+                    help='In streaming mode, spill the final connections to '
+                         'disk chunk by chunk\nand save them at the end. '
+                         'Otherwise, only the matrix is saved.')
+
+    p.add_argument('--processes', type=int, default=1,
+                   help='Number of processes used to post-process the '
+                        'connections.\nAlso the number of threads used to '
+                        'compute the streamlines intersection. [%(default)s]\n'
+                        'Results do not depend on the number of processes.')
 
     add_overwrite_arg(p)
 
@@ -203,13 +363,34 @@ def main():
     parser = build_args_parser()
     args = parser.parse_args()
 
-    assert_inputs_exist(parser, [args.tracks, args.labels])
+    assert_inputs_exist(parser, [args.tracks, args.labels], args.metrics)
 
     if os.path.abspath(args.output) == os.getcwd():
         parser.error('Do not use the current path as output directory.')
 
     assert_output_dirs_exist_and_empty(parser, args, args.output)
 
+    if args.processes <= 0:
+        parser.error('Number of processes cannot be <= 0.')
+
+    if args.chunk_size is not None:
+        if args.chunk_size <= 0:
+            parser.error('Chunk size cannot be <= 0.')
+        if args.save_raw_connections or args.save_intermediate or \
+                args.save_discarded:
+            parser.error('Only the final connections can be saved when '
+                         'using --chunk_size.')
+        if not (args.no_remove_outliers and args.no_remove_loops_again):
+            parser.error('Outliers and QuickBundles loops removal are not '
+                         'possible with --chunk_size, use '
+                         '--no_remove_outliers and --no_remove_loops_again.')
+    elif args.spill_final_connections:
+        parser.error('--spill_final_connections requires --chunk_size.')
+
+    if args.hdf5 and args.spill_final_connections:
+        parser.error('--spill_final_connections is not needed with --hdf5, '
+                     'connections are directly appended to the HDF5 file.')
+
     log_level = logging.WARNING
     if args.verbose:
         log_level = logging.INFO
@@ -230,6 +411,56 @@ def main():
             np.max(img_labels.get_data()) > args.max_labels:
         parser.error('Invalid labels in labels image')
 
+    metrics = {}
+    if args.metrics:
+        metrics_names = _get_metrics_names(args.metrics)
+        if len(set(metrics_names)) != len(metrics_names):
+            parser.error('Metrics must have different filenames.')
+
+        # Each metric is loaded only once, for all connections.
+        for name, filename in zip(metrics_names, args.metrics):
+            metrics[name] = nb.load(filename).get_data()
+            if metrics[name].shape != img_labels.shape:
+                parser.error('Metric {} is not a 3D volume with the labels '
+                             'shape.'.format(filename))
+
+    # Here, we use nb_labels + 1 since we want the direct mapping from image
+    # label to matrix element. We will remove the first row and column before
+    # saving.
+    accumulator = ConnectivityAccumulator(
+        args.max_labels, img_labels.shape, vox_size=vox_sizes[0],
+        metrics=metrics, compute_length=args.save_length_matrix,
+        compute_volume=args.save_volume_matrix)
+
+    processing_opts = get_processing_options(
+        no_pruning=args.no_pruning,
+        min_length=args.min_length,
+        max_length=args.max_length,
+        vox_size=vox_sizes[0],
+        no_remove_loops=args.no_remove_loops,
+        loop_max_angle=args.loop_max_angle,
+        no_remove_outliers=args.no_remove_outliers,
+        outlier_threshold=args.outlier_threshold,
+        no_remove_loops_again=args.no_remove_loops_again,
+        loop_qb_distance=args.loop_qb_distance)
+
+    if args.chunk_size:
+        out_paths = _get_output_paths(args.output)
+        _create_required_output_dirs(out_paths, args)
+
+        logging.info('*** Computing connectivity matrix in chunks of {} '
+                     'streamlines ***'.format(args.chunk_size))
+        time1 = time.time()
+        _run_with_pool(args.processes, _compute_streaming_matrices, args,
+                       processing_opts, img_labels.get_data(), accumulator,
+                       out_paths)
+        time2 = time.time()
+        logging.info('    Streaming connectivity took %0.3f ms',
+                     (time2 - time1) * 1000.0)
+
+        _save_matrices(accumulator, args)
+        return
+
     logging.info('*** Loading streamlines ***')
     time1 = time.time()
     streamlines = load_trk_in_voxel_space(args.tracks, args.labels)
@@ -244,7 +475,11 @@ def main():
     logging.info('*** Computing streamlines intersection ***')
     time1 = time.time()
 
-    indices, points_to_idx = uncompress(streamlines, return_mapping=True)
+    if args.processes > 1:
+        indices, points_to_idx = uncompress_parallel(
+            streamlines, return_mapping=True, nbr_threads=args.processes)
+    else:
+        indices, points_to_idx = uncompress(streamlines, return_mapping=True)
 
     time2 = time.time()
     logging.info('    Streamlines intersection took %0.3f ms',
@@ -253,8 +488,8 @@ def main():
     # Compute the connectivity mapping
     logging.info('*** Computing connectivity information ***')
     time1 = time.time()
-    con_info = compute_connectivity(indices, img_labels.get_data(),
-                                    extract_longest_segments_from_profile)
+    con_info = compute_connectivity_from_indices(indices,
+                                                 img_labels.get_data())
     time2 = time.time()
     logging.info('    Connectivity computation took %0.3f ms',
                  (time2 - time1) * 1000.0)
@@ -267,114 +502,17 @@ def main():
     out_paths = _get_output_paths(args.output)
     _create_required_output_dirs(out_paths, args)
 
-    # Here, we use nb_labels + 1 since we want the direct mapping from image
-    # label to matrix element. We will remove the first row and column before
-    # saving.
-    # TODO for other metrics
-    # dtype should be adjusted depending on the type of elements
-    # stored in the con_mat
-    nb_labels = args.max_labels
-    con_mat = np.zeros((nb_labels + 1, nb_labels + 1),
-                       dtype=np.uint32)
-
     logging.info('*** Starting connection post-processing and saving. ***')
     logging.info('    This can be long, be patient.')
     time1 = time.time()
-    for in_label in list(final_con_info.keys()):
-        for out_label in list(final_con_info[in_label].keys()):
-            pair_info = final_con_info[in_label][out_label]
-
-            if not len(pair_info):
-                continue
-
-            final_strl = []
-
-            for connection in pair_info:
-                strl_idx = connection['strl_idx']
-                final_strl.append(compute_streamline_segment(streamlines[strl_idx],
-                                                             indices[strl_idx],
-                                                             connection['in_idx'],
-                                                             connection['out_idx'],
-                                                             points_to_idx[strl_idx]))
-
-            _save_if_needed(final_strl, args, saving_opts, out_paths, 'raw',
-                            'raw', in_label, out_label)
-
-            # Doing all post-processing
-            if not args.no_pruning:
-                pruned_strl, invalid_strl = _prune_segments(final_strl,
-                                                            args.min_length,
-                                                            args.max_length,
-                                                            vox_sizes[0])
-
-                _save_if_needed(invalid_strl, args, saving_opts, out_paths,
-                                'discarded', 'removed_length',
-                                in_label, out_label)
-            else:
-                pruned_strl = final_strl
-
-            if not len(pruned_strl):
-                continue
-
-            _save_if_needed(pruned_strl, args, saving_opts, out_paths,
-                            'intermediate', 'pruned', in_label, out_label)
-
-            if not args.no_remove_loops:
-                no_loops, loops = remove_loops_and_sharp_turns(pruned_strl,
-                                                               args.loop_max_angle)
-                _save_if_needed(loops, args, saving_opts, out_paths,
-                                'discarded', 'loops', in_label, out_label)
-            else:
-                no_loops = pruned_strl
-
-            if not len(no_loops):
-                continue
-
-            _save_if_needed(no_loops, args, saving_opts, out_paths,
-                            'intermediate', 'no_loops', in_label, out_label)
-
-            if not args.no_remove_outliers:
-                no_outliers, outliers = remove_outliers(no_loops,
-                                                        args.outlier_threshold)
-                _save_if_needed(outliers, args, saving_opts, out_paths,
-                                'discarded', 'outliers', in_label, out_label)
-            else:
-                no_outliers = no_loops
-
-            if not len(no_outliers):
-                continue
-
-            _save_if_needed(no_outliers, args, saving_opts, out_paths,
-                            'intermediate', 'no_outliers', in_label, out_label)
-
-            if not args.no_remove_loops_again:
-                no_qb_loops_strl, loops2 = remove_loops_and_sharp_turns(
-                    no_outliers,
-                    args.loop_max_angle,
-                    True,
-                    args.loop_qb_distance)
-                _save_if_needed(loops2, args, saving_opts, out_paths,
-                                'discarded', 'qb_loops', in_label, out_label)
-            else:
-                no_qb_loops_strl = no_outliers
-
-            _save_if_needed(no_qb_loops_strl, args, saving_opts, out_paths,
-                            'final', 'final', in_label, out_label)
-
-            # TODO for other metrics
-            # This would be where this is modified and the value
-            # is computed (eg: mean FA in the connection.
-            con_mat[in_label, out_label] += len(no_qb_loops_strl)
-
+    _run_with_pool(args.processes, _process_and_save_connections, args,
+                   final_con_info, streamlines, indices, points_to_idx,
+                   processing_opts, saving_opts, accumulator, out_paths)
     time2 = time.time()
     logging.info('    Connection post-processing and saving took %0.3f ms',
                  (time2 - time1) * 1000.0)
 
-    # Remove first line and column, since they are index 0 and
-    # would represent a connection to non-label voxels. Only used when
-    # post-processing to avoid unnecessary -1 on labels for each access.
-    con_mat = con_mat[1:, 1:]
-    np.save(os.path.join(args.output, 'final_matrix.npy'), con_mat)
+    _save_matrices(accumulator, args)
 
 
 if __name__ == "__main__":
@@ -6,6 +6,10 @@ Compute a density map from a streamlines file.
 
 A specific value can be assigned instead of using the tract count.
 
+Each streamline can instead add its length inside the voxel (in mm, the voxels
+must be isotropic) and/or its weight from the data_per_streamline (e.g. COMMIT
+or SIFT weights), giving a weighted density map.
+
 This script correctly handles compressed streamlines.
 """
 import argparse
@@ -34,6 +38,15 @@ def _build_args_parser():
                    ' voxels, creating a binary map.\n'
                    'When set without a value, 1 is used.\n'
                    'If a value is given, will be used as the stored value.')
+    p.add_argument('--length_weighted', action='store_true',
+                   help='Each streamline adds its length (mm) inside the '
+                        'voxel instead of 1.')
+    p.add_argument('--dps_weights', metavar='KEY',
+                   help='Each streamline value is multiplied by its '
+                        'data_per_streamline of this key.')
+    p.add_argument('--processes', type=int, default=1,
+                   help='Number of threads used to count the streamlines. '
+                        '[%(default)s]')
     add_reference_arg(p)
     add_overwrite_arg(p)
     return p
@@ -52,18 +65,41 @@ def main():
                      'must be greater than 0 and smaller or equal to {}'
                      .format(args.binary, max_))
 
+    if args.processes <= 0:
+        parser.error('Number of processes cannot be <= 0.')
+
     sft = load_tractogram_with_reference(parser, args, args.in_bundle)
     sft.to_vox()
     sft.to_corner()
     streamlines = sft.streamlines
-    transformation, dimensions, _, _ = sft.space_attribute
+    transformation, dimensions, voxel_sizes, _ = sft.space_attribute
+
+    if args.length_weighted and not np.allclose(voxel_sizes,
+                                                voxel_sizes[0]):
+        parser.error('--length_weighted needs isotropic voxels.')
+
+    weights = None
+    if args.dps_weights:
+        if args.dps_weights not in sft.data_per_streamline:
+            parser.error('{} is not a data_per_streamline of {}.'.format(
+                args.dps_weights, args.in_bundle))
+        weights = np.squeeze(sft.data_per_streamline[args.dps_weights])
+
+    streamline_count = compute_tract_counts_map(
+        streamlines, dimensions, nbr_threads=args.processes,
+        length_weighted=args.length_weighted, weights=weights)
 
-    streamline_count = compute_tract_counts_map(streamlines, dimensions)
+    if args.length_weighted:
+        streamline_count *= voxel_sizes[0]
 
     if args.binary is not None:
         streamline_count[streamline_count > 0] = args.binary
 
-    nib.save(nib.Nifti1Image(streamline_count.astype(np.int16), transformation),
+    if args.length_weighted or args.dps_weights:
+        dtype = np.float32
+    else:
+        dtype = np.int16
+    nib.save(nib.Nifti1Image(streamline_count.astype(dtype), transformation),
              args.out_img)
 
 
@@ -7,6 +7,7 @@ import logging
 import nibabel as nib
 import numpy as np
 
+from scilpy.io.image import create_memmap_nifti
 from scilpy.io.streamlines import load_tractogram_with_reference
 from scilpy.io.utils import (add_overwrite_arg, add_reference_arg,
                              add_sh_basis_args,
@@ -55,7 +56,18 @@ def _build_arg_parser():
 
     p.add_argument('--out_lw_todi_sh',
                    help='Output length-weighted TODI map, '
-                   'with SH coefficient.')
+                   'with SH coefficient.\n'
+                   'An uncompressed .nii is written in place, by chunks.')
+
+    p.add_argument('--out_masked_todi',
+                   help='Output the raw masked TODI (.npz or .h5), before '
+                        'smoothing\nand masking. Partial TODIs can be '
+                        'merged with --in_masked_todi.')
+
+    p.add_argument('--in_masked_todi', nargs='+', default=[],
+                   help='Raw masked TODIs (.npz or .h5) summed with the '
+                        'TODI of\nthe streamlines, e.g. from other '
+                        'subjects or processes.')
 
     p.add_argument('--sh_order', type=int, default=8,
                    help='Order of the original SH.')
@@ -66,6 +78,12 @@ def _build_arg_parser():
     p.add_argument('--smooth', action='store_true',
                    help='Smooth todi (angular and spatial).')
 
+    p.add_argument('--chunk_size', type=int,
+                   help='Number of streamlines processed at once. The TODI '
+                        'is then\n'
+                        'accumulated sparsely, lowering the memory '
+                        'usage.')
+
     add_sh_basis_args(p)
     add_overwrite_arg(p)
     return p
@@ -77,7 +95,7 @@ def main():
     logging.basicConfig(level=logging.INFO)
 
     assert_inputs_exist(parser, args.tract_filename,
-                        [args.mask, args.reference])
+                        [args.mask, args.reference] + args.in_masked_todi)
 
     output_file_list = []
     if args.out_mask:
@@ -88,19 +106,37 @@ def main():
         output_file_list.append(args.out_lw_todi)
     if args.out_lw_todi_sh:
         output_file_list.append(args.out_lw_todi_sh)
+    if args.out_masked_todi:
+        output_file_list.append(args.out_masked_todi)
 
     if not output_file_list:
         parser.error('No output to be done')
 
     assert_outputs_exist(parser, args, output_file_list)
 
+    if args.chunk_size is not None and args.chunk_size <= 0:
+        parser.error('--chunk_size must be above 0.')
+
     sft = load_tractogram_with_reference(parser, args, args.tract_filename)
     affine, data_shape, _, _ = sft.space_attribute
     sft.to_vox()
 
     logging.info('Computing length-weighted TODI ...')
     todi_obj = TrackOrientationDensityImaging(tuple(data_shape), args.sphere)
-    todi_obj.compute_todi(sft.streamlines, length_weights=True)
+    todi_obj.compute_todi(sft.streamlines, length_weights=True,
+                          chunk_size=args.chunk_size,
+                          sparse=args.chunk_size is not None)
+
+    for filename in args.in_masked_todi:
+        other_todi_obj = TrackOrientationDensityImaging.load(filename)
+        if other_todi_obj.sphere_type != args.sphere:
+            parser.error('{} does not use the {} sphere.'.format(
+                filename, args.sphere))
+        todi_obj.merge(other_todi_obj)
+        del other_todi_obj
+
+    if args.out_masked_todi:
+        todi_obj.save(args.out_masked_todi)
 
     if args.smooth:
         logging.info('Smoothing ...')
@@ -121,10 +157,18 @@ def main():
     if args.out_lw_todi_sh:
         if args.sh_normed:
             todi_obj.normalize_todi_per_voxel()
-        img = todi_obj.get_sh(args.sh_basis, args.sh_order)
-        img = todi_obj.reshape_to_3d(img)
-        img = nib.Nifti1Image(img.astype(np.float32), affine)
-        img.to_filename(args.out_lw_todi_sh)
+        nb_coeffs = (args.sh_order + 1) * (args.sh_order + 2) // 2
+        sh_shape = tuple(todi_obj.img_shape) + (nb_coeffs,)
+        if args.out_lw_todi_sh.endswith('.nii'):
+            img = create_memmap_nifti(args.out_lw_todi_sh, sh_shape, affine)
+            todi_obj.get_sh(args.sh_basis, args.sh_order, out=img)
+            img.flush()
+            del img
+        else:
+            img = np.zeros(sh_shape, dtype=np.float32)
+            todi_obj.get_sh(args.sh_basis, args.sh_order, out=img)
+            img = nib.Nifti1Image(img, affine)
+            img.to_filename(args.out_lw_todi_sh)
 
     if args.out_lw_tdi:
         img = todi_obj.get_tdi()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+from dipy.io.streamline import load_tractogram
+import nibabel as nib
+import numpy as np
+
+from scilpy.io.utils import (add_overwrite_arg,
+                             add_sh_basis_args,
+                             assert_inputs_exist,
+                             assert_outputs_exist)
+from scilpy.tractanalysis.priors import (compute_endpoints_mask,
+                                         compute_todi_priors_sf,
+                                         generate_priors)
+
+
+DESCRIPTION = """
+    Generation of priors and enhanced-FOD from many example/template bundles,
+    equivalent to scil_generate_priors_from_bundle.py on each bundle.
+    The bundles must have been cleaned thorougly before use. The E-FOD can
+    then be used for bundle-specific tractography, but not for FOD metrics.
+
+    The TODI of the bundles are computed in parallel, then the FOD is read
+    once, by blocks of slices, and evaluated once on the union of the
+    bundles masks. An uncompressed FOD (.nii) is much faster to read by
+    blocks than a compressed one.
+
+    Outputs are named after each bundle, e.g. for AF_L.trk:
+    [prefix]AF_L_efod.nii.gz, [prefix]AF_L_priors.nii.gz,
+    [prefix]AF_L_todi_mask.nii.gz and [prefix]AF_L_endpoints_mask.nii.gz
+"""
+
+EPILOG = """
+    References:
+        [1] Rheault, Francois, et al. "Bundle-specific tractography with
+        incorporated anatomical and orientational priors."
+        NeuroImage 186 (2019): 382-398
+    """
+
+
+def _build_arg_parser():
+    p = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter,
+                                description=DESCRIPTION, epilog=EPILOG,)
+    p.add_argument('in_bundles', nargs='+',
+                   help='Input bundles filenames.')
+
+    p.add_argument('fod_filename',
+                   help='Input FOD filename.')
+
+    p.add_argument('mask_filename',
+                   help='Mask to constrain the TODI spatial smoothing,\n'
+                        'for example a WM mask.')
+    add_sh_basis_args(p)
+    p.add_argument('--todi_sigma', choices=[0, 1, 2, 3, 4],
+                   default=1, type=int,
+                   help='Smooth the orientation histogram.')
+    p.add_argument('--sf_threshold', default=0.2, type=float,
+                   help='Relative threshold for sf masking (0.0-1.0).')
+    p.add_argument('--output_prefix', default='',
+                   help='Add a prefix to all output filename, \n'
+                   'default is no prefix.')
+    p.add_argument('--output_dir', default='./',
+                   help='Output directory for all generated files,\n'
+                   'default is current directory.')
+    p.add_argument('--block_size', type=int, default=8,
+                   help='Number of slices of the FOD processed at once '
+                        '[%(default)s].')
+    p.add_argument('--processes', type=int, default=1,
+                   help='Number of processes used to compute the TODI and '
+                        'to process the blocks [%(default)s].')
+
+    add_overwrite_arg(p)
+
+    return p
+
+
+def _compute_bundle_priors_sf(args):
+    bundle_filename, fod_filename, wm_mask, todi_sigma, sf_threshold, \
+        tmp_dir = args
+
+    sft = load_tractogram(bundle_filename, fod_filename,
+                          trk_header_check=True)
+    sft.to_vox()
+    streamlines = sft.streamlines
+    if len(streamlines) < 1:
+        raise ValueError('The input bundle {0} contains no '
+                         'streamline.'.format(bundle_filename))
+
+    sub_mask_3d, todi_sf = compute_todi_priors_sf(
+        streamlines, wm_mask, todi_sigma=todi_sigma,
+        sf_threshold=sf_threshold)
+    endpoints_mask = compute_endpoints_mask(streamlines, wm_mask)
+
+    # The TODI SF are kept on disk until all bundles are done
+    fd, todi_sf_filename = tempfile.mkstemp(suffix='.npy', dir=tmp_dir)
+    os.close(fd)
+    np.save(todi_sf_filename, todi_sf)
+
+    return sub_mask_3d, todi_sf_filename, endpoints_mask
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = _build_arg_parser()
+    args = parser.parse_args()
+
+    required = args.in_bundles + [args.fod_filename, args.mask_filename]
+    assert_inputs_exist(parser, required)
+
+    if args.block_size <= 0:
+        parser.error('Block size cannot be <= 0.')
+    if args.processes <= 0:
+        parser.error('Number of processes cannot be <= 0.')
+
+    names = [os.path.splitext(os.path.basename(filename))[0]
+             for filename in args.in_bundles]
+    if len(set(names)) != len(names):
+        parser.error('Bundles filenames must be unique, outputs are named '
+                     'after them.')
+
+    outputs = {}
+    for key in ['efod', 'priors', 'todi_mask', 'endpoints_mask']:
+        outputs[key] = [os.path.join(args.output_dir,
+                                     '{0}{1}_{2}.nii.gz'.format(
+                                         args.output_prefix, name, key))
+                        for name in names]
+    assert_outputs_exist(parser, args, sum(outputs.values(), []))
+
+    if args.output_dir and not os.path.isdir(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    img_mask = nib.load(args.mask_filename)
+    wm_mask = img_mask.get_data()
+
+    tmp_dir = tempfile.mkdtemp(dir=args.output_dir)
+    try:
+        # Compute TODI from streamlines, one bundle per process
+        tasks = [(filename, args.fod_filename, wm_mask, args.todi_sigma,
+                  args.sf_threshold, tmp_dir) for filename in args.in_bundles]
+        if args.processes > 1:
+            pool = multiprocessing.Pool(args.processes)
+            try:
+                results = pool.map(_compute_bundle_priors_sf, tasks,
+                                   chunksize=1)
+                pool.close()
+            except BaseException:
+                # Workers still writing in tmp_dir are stopped before it is
+                # removed
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            results = [_compute_bundle_priors_sf(task) for task in tasks]
+        sub_masks, todi_sf_filenames, endpoints_masks = zip(*results)
+
+        for sub_mask_3d, endpoints_mask, out_todi_mask, out_endpoints_mask \
+                in zip(sub_masks, endpoints_masks, outputs['todi_mask'],
+                       outputs['endpoints_mask']):
+            nib.save(nib.Nifti1Image(sub_mask_3d.astype(
+                np.int16), img_mask.affine), out_todi_mask)
+            nib.save(nib.Nifti1Image(endpoints_mask,
+                                     img_mask.affine), out_endpoints_mask)
+        del results, endpoints_masks
+
+        # Priors and E-FOD are written block by block
+        todi_sfs = [np.load(filename, mmap_mode='r')
+                    for filename in todi_sf_filenames]
+        generate_priors(args.fod_filename, sub_masks, todi_sfs,
+                        args.sh_basis, outputs['priors'], outputs['efod'],
+                        block_size=args.block_size,
+                        nbr_processes=args.processes)
+        del todi_sfs
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
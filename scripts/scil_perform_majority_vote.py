@@ -95,8 +95,9 @@ def main():
         bundle = sft.get_streamlines_copy()
         sft.to_vox()
         bundle_vox_space = sft.get_streamlines_copy()
-        binary = compute_tract_counts_map(bundle_vox_space, dimensions)
-        volume[binary > 0] += 1
+        voxels_ids, _ = compute_tract_counts_map(bundle_vox_space, dimensions,
+                                                 sparse=True)
+        volume.flat[voxels_ids] += 1
 
         if args.same_tractogram:
             _, indices = perform_streamlines_operation(intersection,
@@ -7,6 +7,9 @@
     Transform should come from ANTs: (using the --inverse flag)
     AntsRegistration -m MODEL_REF -f SUBJ_REF
     ConvertTransformFile 3 0GenericAffine.mat 0GenericAffine.npy --ras --hm
+
+    The models directories can be replaced by a single atlas compiled by
+    scil_compile_rbx_atlas.py, the models are then not clustered again.
 """
 
 import argparse
@@ -20,6 +23,8 @@ import coloredlogs
 import numpy as np
 
 from scilpy.io.utils import add_overwrite_arg, assert_inputs_exist
+from scilpy.segment.cluster_cache import ClusterCache
+from scilpy.segment.model_atlas import ATLAS_EXTENSIONS
 from scilpy.segment.voting_scheme import VotingScheme
 
 
@@ -37,7 +42,8 @@ def _build_args_parser():
     p.add_argument('config_file',
                    help='Path of the config file (json)')
     p.add_argument('models_directories', nargs='+',
-                   help='Path for the directories containing model.')
+                   help='Path for the directories containing model,\n'
+                   'or a single compiled atlas (hdf5).')
     p.add_argument('transformation',
                    help='Path for the transformation to model space.')
 
@@ -68,6 +74,19 @@ def _build_args_parser():
     p.add_argument('--inverse', action='store_true',
                    help='Use the inverse transformation.')
 
+    c = p.add_argument_group('Cluster cache')
+    c.add_argument('--cluster_cache_dir',
+                   help='Directory where the tractogram clustering (QBx) is\n'
+                   'cached, keyed by the tractogram content, thresholds,\n'
+                   'number of points and seed. Later runs on the same\n'
+                   'tractogram skip the clustering. Requires --seeds.')
+    c.add_argument('--cluster_cache_max_age', type=float,
+                   help='Evict cached clusterings unused for more than\n'
+                   'this number of days.')
+    c.add_argument('--cluster_cache_max_size', type=float,
+                   help='Evict the least recently used clusterings until the\n'
+                   'cache is smaller than this size (MB).')
+
     add_overwrite_arg(p)
 
     return p
@@ -81,9 +100,16 @@ def main():
                                  args.config_file,
                                  args.transformation])
 
-    for directory in args.models_directories:
-        if not os.path.isdir(directory):
-            parser.error('Input folder {0} does not exist'.format(directory))
+    if len(args.models_directories) == 1 and \
+            os.path.isfile(args.models_directories[0]):
+        if not args.models_directories[0].endswith(ATLAS_EXTENSIONS):
+            parser.error('Input atlas must be a {0} file.'.format(
+                ' or '.join(ATLAS_EXTENSIONS)))
+    else:
+        for directory in args.models_directories:
+            if not os.path.isdir(directory):
+                parser.error('Input folder {0} does not exist'.format(
+                    directory))
 
     if args.output_dir:
         if not os.path.isdir(args.output_dir):
@@ -119,8 +145,18 @@ def main():
     else:
         seeds = args.seeds
 
+    cluster_cache = None
+    if args.cluster_cache_dir:
+        if None in seeds:
+            logging.warning('The cluster cache is not used without --seeds.')
+        cluster_cache = ClusterCache(args.cluster_cache_dir,
+                                     max_age=args.cluster_cache_max_age,
+                                     max_size=args.cluster_cache_max_size)
+        cluster_cache.evict()
+
     voting.multi_recognize(args.in_tractogram, args.tractogram_clustering_thr,
-                           nbr_processes=args.processes, seeds=seeds)
+                           nbr_processes=args.processes, seeds=seeds,
+                           cluster_cache=cluster_cache)
 
 
 if __name__ == '__main__':
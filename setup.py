@@ -30,13 +30,17 @@ opts = dict(name=NAME,
 
 extensions = [Extension('scilpy.tractanalysis.uncompress',
                         ['scilpy/tractanalysis/uncompress.pyx'],
-                        include_dirs=[numpy.get_include()]),
+                        include_dirs=[numpy.get_include()],
+                        extra_compile_args=['-fopenmp'],
+                        extra_link_args=['-fopenmp']),
               Extension('scilpy.tractanalysis.quick_tools',
                         ['scilpy/tractanalysis/quick_tools.pyx'],
                         include_dirs=[numpy.get_include()]),
               Extension('scilpy.tractanalysis.streamlines_metrics',
                         ['scilpy/tractanalysis/streamlines_metrics.pyx'],
-                        include_dirs=[numpy.get_include()])]
+                        include_dirs=[numpy.get_include()],
+                        extra_compile_args=['-fopenmp'],
+                        extra_link_args=['-fopenmp'])]
 
 opts['ext_modules'] = cythonize(extensions)
 